@@ -0,0 +1,371 @@
+"""In-process fakes of the jcs cloud and Jenkins clients
+
+The fakes implement the methods of AWSClient, OpenstClient and
+JenkinsClient which the create/delete workflows use. Every call sleeps for
+a random latency (mean and jitter) and fails with the given rate, so the
+orchestration of jcs can be measured without real clouds. install()
+replaces the client factories of jcs.clients with the fakes.
+"""
+
+import itertools
+import random
+import threading
+import time
+
+
+class Backend:
+    """latency (seconds) and failure rate (0..1) of the calls of a fake"""
+    def __init__(self, latency=0.05, jitter=0.2, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call(self, name, latency=None):
+        """simulate an API call (sleep and maybe fail)"""
+        latency = self.latency if latency is None else latency
+        with self._lock:
+            self.calls += 1
+            delay = latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+            fail = self._random.random() < self.failure_rate
+            if fail:
+                self.failures += 1
+        time.sleep(max(delay, 0))
+        if fail:
+            raise Exception('{}: injected failure'.format(name))
+
+
+class FakeAWSClient:
+    def __init__(self, backend, boot_time=1.0):
+        self._backend = backend
+        self._boot_time = boot_time
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # instance id: dict with tags, launched, spot
+        self.instances = {}
+        # spot instances are launched only with spot capacity
+        self.spot_capacity = True
+        # the spot interruptions (dicts with id, jenkins_name, jenkins_url, code)
+        self.interruptions = []
+
+    def ec2_image_lookup(self, image_name):
+        self._backend.call('ec2_image_lookup')
+        return 'ami-{:08x}'.format(hash(image_name) & 0xffffffff)
+
+    def ec2_image_copy(self, image_name, source_region):
+        self._backend.call('ec2_image_copy')
+        return self.ec2_image_lookup(image_name)
+
+    def ec2_instances_run(self, image_id, instance_type, key_name, instance_names,
+                          tags=None, spot=False, spot_max_price=None):
+        from jcs.placement import CapacityError
+        self._backend.call('ec2_instances_run')
+        if spot and not self.spot_capacity:
+            raise CapacityError('EC2 fake {}: no spot capacity'.format(instance_type))
+        ids = []
+        with self._lock:
+            for _ in instance_names:
+                instance_id = 'i-{:017x}'.format(next(self._ids))
+                self.instances[instance_id] = {'tags': dict(tags or {}),
+                                               'launched': time.time(), 'spot': spot}
+                ids.append(instance_id)
+        return ids
+
+    def ec2_instances_tag(self, instance_ids, tags):
+        # one create_tags call per instance (as AWSClient does)
+        for instance_id, instance_tags in zip(instance_ids, tags):
+            self._backend.call('create_tags')
+            with self._lock:
+                self.instances[instance_id]['tags'].update(instance_tags)
+
+    def ec2_instances_wait_running(self, instance_ids):
+        if not instance_ids:
+            return {}
+        with self._lock:
+            launched = max(self.instances[i]['launched'] for i in instance_ids)
+        # one describe call, then the instances boot
+        self._backend.call('ec2_instances_wait_running')
+        time.sleep(max(launched + self._boot_time - time.time(), 0))
+        return {i: self._ip(i) for i in instance_ids}
+
+    @staticmethod
+    def _ip(instance_id):
+        n = int(instance_id[2:], 16)
+        return '10.0.{}.{}'.format(n // 250, n % 250 + 1)
+
+    def ec2_jcs_instances(self, tags=None):
+        self._backend.call('ec2_jcs_instances')
+        # without tags, the instances created by jcs (like AWSClient)
+        tags = tags or {'jcs-jenkins-name': None}
+        with self._lock:
+            return [{'id': instance_id, 'ip': None, 'state': 'running',
+                     'jenkins_name': i['tags'].get('jcs-jenkins-name'),
+                     'jenkins_url': i['tags'].get('jcs-jenkins-url'),
+                     'launched': i['launched']}
+                    for instance_id, i in self.instances.items()
+                    if all(k in i['tags'] and v in (None, i['tags'][k])
+                           for k, v in tags.items())]
+
+    def ec2_pool_instances(self, pool_key=None):
+        self._backend.call('ec2_pool_instances')
+        with self._lock:
+            instances = [{'id': instance_id, 'ip': self._ip(instance_id), 'state': 'running',
+                          'pool': i['tags']['jcs-pool'],
+                          'since': float(i['tags'].get('jcs-pool-since', 0))}
+                         for instance_id, i in self.instances.items()
+                         if 'jcs-pool' in i['tags'] and
+                         pool_key in (None, i['tags']['jcs-pool'])]
+        return sorted(instances, key=lambda i: i['since'])
+
+    def ec2_pool_fill(self, pool_key, size, image_name, instance_type, key_name):
+        missing = size - len(self.ec2_pool_instances(pool_key))
+        if missing <= 0:
+            return []
+        return self.ec2_instances_run(
+            self.ec2_image_lookup(image_name), instance_type, key_name, ['pool'] * missing,
+            tags={'jcs-pool': pool_key, 'jcs-pool-since': str(time.time())})
+
+    def ec2_pool_claim(self, pool_key, count):
+        instances = self.ec2_pool_instances(pool_key)[:count]
+        self._backend.call('delete_tags')
+        with self._lock:
+            for instance in instances:
+                self.instances[instance['id']]['tags'].pop('jcs-pool', None)
+                self.instances[instance['id']]['tags'].pop('jcs-pool-since', None)
+        return [{'id': i['id'], 'name': i['id'], 'ip': i['ip']} for i in instances]
+
+    def ec2_instances_delete(self, instance_ids):
+        self._backend.call('ec2_instances_delete')
+        with self._lock:
+            for instance_id in instance_ids:
+                self.instances.pop(instance_id, None)
+
+    def ec2_spot_interruptions(self):
+        self._backend.call('ec2_spot_interruptions')
+        with self._lock:
+            return list(self.interruptions)
+
+    def ec2_instance_untag(self, instance_id, keys):
+        self._backend.call('delete_tags')
+        with self._lock:
+            for key in keys:
+                self.instances[instance_id]['tags'].pop(key, None)
+
+    def ec2_instances_alive(self, instance_ids):
+        self._backend.call('ec2_instances_alive')
+        with self._lock:
+            return {i for i in instance_ids if i in self.instances}
+
+    def ec2_instance_delete_by_tags(self, tags):
+        self.ec2_instances_delete([i['id'] for i in self.ec2_jcs_instances(tags)])
+
+
+class FakeOpenstClient:
+    def __init__(self, backend, boot_time=1.0):
+        self._backend = backend
+        self._boot_time = boot_time
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # server id: name
+        self.servers = {}
+        # server id: metadata
+        self.metadata = {}
+
+    def os_image_get(self, image_name):
+        self._backend.call('os_image_get')
+        return {'id': image_name, 'name': image_name}
+
+    def os_flavor_get(self, instance_type):
+        self._backend.call('os_flavor_get')
+        return {'id': instance_type, 'name': instance_type}
+
+    def os_network_get(self, network_name):
+        self._backend.call('os_network_get')
+        return {'id': network_name, 'name': network_name}
+
+    def os_server_create(self, instance_name, image, flavor, key_name,
+                         network_fixed, network_public, security_groups, meta=None):
+        # create, boot and floating ip
+        self._backend.call('os_server_create')
+        time.sleep(self._boot_time)
+        self._backend.call('os_floating_ip')
+        with self._lock:
+            n = next(self._ids)
+            server_id = '{:08x}-0000-0000-0000-000000000000'.format(n)
+            self.servers[server_id] = instance_name
+            self.metadata[server_id] = dict(meta or {})
+        return server_id, self._ip(server_id)
+
+    @staticmethod
+    def _ip(server_id):
+        n = int(server_id[:8], 16)
+        return '172.16.{}.{}'.format(n // 250, n % 250 + 1)
+
+    def os_jcs_servers(self):
+        self._backend.call('os_jcs_servers')
+        # the servers of the warm pools are not jcs agents (yet)
+        with self._lock:
+            return [{'id': server_id, 'name': name, 'ip': None,
+                     'jenkins_name': name[len('jcs-'):], 'jenkins_url': None,
+                     'status': 'ACTIVE', 'created': 0}
+                    for server_id, name in self.servers.items()
+                    if 'jcs-pool' not in self.metadata[server_id]]
+
+    def os_pool_servers(self, pool_key=None):
+        self._backend.call('os_pool_servers')
+        with self._lock:
+            servers = [{'id': server_id, 'name': self.servers[server_id], 'status': 'ACTIVE',
+                        'pool': meta['jcs-pool'],
+                        'since': float(meta.get('jcs-pool-since', 0))}
+                       for server_id, meta in self.metadata.items()
+                       if 'jcs-pool' in meta and pool_key in (None, meta['jcs-pool'])]
+        return sorted(servers, key=lambda s: s['since'])
+
+    def os_pool_fill(self, pool_key, size, image_name, instance_type, key_name,
+                     network_fixed, network_public, security_groups):
+        missing = size - len(self.os_pool_servers(pool_key))
+        meta = {'jcs-pool': pool_key, 'jcs-pool-since': str(time.time())}
+        names = ['jcs-pool-{}'.format(i) for i in range(max(missing, 0))]
+        for name in names:
+            self.os_server_create(name, image_name, instance_type, key_name, network_fixed,
+                                  network_public, security_groups, meta)
+        return names
+
+    def os_pool_claim(self, pool_key, instance_names, network_fixed, network_public,
+                      meta=None):
+        servers = self.os_pool_servers(pool_key)[:len(instance_names)]
+        claimed = []
+        for server, instance_name in zip(servers, instance_names):
+            # metadata, rename and floating ip
+            self._backend.call('os_pool_claim')
+            with self._lock:
+                self.metadata[server['id']] = dict(meta or {})
+                self.servers[server['id']] = instance_name
+            claimed.append({'id': server['id'], 'name': instance_name,
+                            'ip': self._ip(server['id'])})
+        return claimed
+
+    def os_servers_delete(self, server_ids, workers=8):
+        for server_id in server_ids:
+            self._backend.call('os_server_delete')
+            with self._lock:
+                self.servers.pop(server_id, None)
+                self.metadata.pop(server_id, None)
+
+    def os_instance_delete(self, instance_name):
+        with self._lock:
+            ids = [i for i, name in self.servers.items() if name == instance_name]
+        self.os_servers_delete(ids)
+
+
+class FakeJenkinsClient:
+    def __init__(self, backend, online_time=0.2):
+        self._backend = backend
+        self._online_time = online_time
+        self._lock = threading.Lock()
+        # node name: dict with description, labels, offline (and idle, default True)
+        self.nodes = {}
+        # the build queue (dicts with id, name, label, since)
+        self.queue = []
+
+    def connect(self):
+        self._backend.call('connect')
+        return self
+
+    def create_node(self, node_hostname, node_name, node_desc, credential_desc,
+                    node_labels, force=True):
+        # create and wait until the agent is online
+        self._backend.call('create_node', self._backend.latency + self._online_time)
+        with self._lock:
+            self.nodes[node_name] = {'description': node_desc, 'labels': node_labels,
+                                     'offline': False}
+
+    def create_nodes(self, nodes, force=True, workers=8):
+        results = {}
+        for node in nodes:
+            try:
+                self._backend.call('create_node')
+            except Exception as e:
+                # like JenkinsClient, only this node fails
+                results[node['name']] = e
+                continue
+            with self._lock:
+                self.nodes[node['name']] = {'description': node['description'],
+                                            'labels': node['labels'], 'offline': False}
+            results[node['name']] = None
+        # one poll of the node list for all nodes
+        self._backend.call('nodes', self._backend.latency + self._online_time)
+        return results
+
+    def _node_toggle(self, node_name, offline):
+        self._backend.call('offline_node' if offline else 'online_node')
+        with self._lock:
+            if node_name not in self.nodes:
+                raise Exception('Jenkins node "{}" not found'.format(node_name))
+            toggled = self.nodes[node_name]['offline'] != offline
+            self.nodes[node_name]['offline'] = offline
+            return toggled
+
+    def offline_node(self, node_name, message=''):
+        return self._node_toggle(node_name, True)
+
+    def online_node(self, node_name):
+        return self._node_toggle(node_name, False)
+
+    def drain_nodes(self, node_names, timeout=3600, workers=8):
+        existing = [name for name in node_names if name in self.node_index()]
+        toggled = [name for name in existing if self.offline_node(name)]
+        # one poll of the node list, the builds of busy agents do not finish
+        self._backend.call('nodes')
+        busy = [name for name, node in self.node_index().items()
+                if name in existing and not node['idle']]
+        for name in busy:
+            if name in toggled:
+                self.online_node(name)
+        return set(node_names) - set(busy)
+
+    def delete_node(self, node_name):
+        # jenkinsapi gets the node list first
+        self._backend.call('nodes')
+        self.delete_nodes([node_name])
+
+    def delete_nodes(self, node_names, workers=8):
+        for node_name in node_names:
+            self._backend.call('delete_node')
+            with self._lock:
+                self.nodes.pop(node_name, None)
+
+    def node_index(self, refresh=False):
+        # cached by JenkinsClient, so no call
+        with self._lock:
+            return {name: {'name': name, 'description': n['description'],
+                           'labels': (n['labels'] or '').split(), 'offline': n['offline'],
+                           'idle': n.get('idle', True), 'executors': 1}
+                    for name, n in self.nodes.items()}
+
+    def nodes_usage(self):
+        self._backend.call('nodes_usage')
+        return list(self.node_index().values())
+
+    def queue_items(self):
+        self._backend.call('queue_items')
+        with self._lock:
+            return list(self.queue)
+
+
+def install(backend, jenkins_backend=None, boot_time=1.0, online_time=0.2):
+    """replace the clients of jcs.clients with fakes (shared by all calls)
+
+    Returns the fakes (aws, openstack, jenkins)."""
+    from jcs import clients
+
+    aws = FakeAWSClient(backend, boot_time)
+    openstack = FakeOpenstClient(backend, boot_time)
+    jenkins = FakeJenkinsClient(jenkins_backend or backend, online_time)
+    clients.aws = lambda args, region_name=None: aws
+    clients.openstack = lambda args, os_cloud=None: openstack
+    clients.jenkins = lambda args: jenkins
+    return aws, openstack, jenkins
@@ -0,0 +1,135 @@
+"""Local HTTP server for OBS-like images
+
+Serves the files of a directory with HEAD, conditional requests (ETag,
+Last-Modified, If-Range) and single byte ranges, which is what OBSImage and the
+RangeDownloader need. make_image() writes a .raw.xz test image with its
+.sha256 file.
+"""
+
+import email.utils
+import hashlib
+import http.server
+import lzma
+import os
+import re
+import sys
+import threading
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        if not self.server.allow_head:
+            self.send_response(405)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self._send(False)
+
+    def do_GET(self):
+        self._send(True)
+
+    def _send(self, body):
+        path = os.path.join(self.server.root, os.path.basename(self.path))
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        st = os.stat(path)
+        etag = '"{:x}-{:x}"'.format(st.st_size, int(st.st_mtime))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        start, end = 0, st.st_size - 1
+        match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+        if self.headers.get('If-Range') not in (None, etag, last_modified):
+            # changed since the client got its validators: the whole file
+            match = None
+        if match:
+            start, end = int(match.group(1)), min(int(match.group(2)), st.st_size - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, st.st_size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        if not body:
+            return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+        with self.server.lock:
+            self.server.bytes_sent += end - start + 1
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # clients that stop reading (an aborted download) are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class ImageServer:
+    """serve root on 127.0.0.1 (a random port) in a background thread
+
+    With allow_head=False HEAD requests are answered with 405 (like some
+    mirrors and object stores)."""
+    def __init__(self, root, allow_head=True):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.root = root
+        self._server.lock = threading.Lock()
+        self._server.bytes_sent = 0
+        self._server.allow_head = allow_head
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    @property
+    def bytes_sent(self):
+        return self._server.bytes_sent
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def make_image(root, name, size):
+    """write root/name (.raw.xz) with size bytes raw image and its .sha256 file
+
+    Half of the raw image are zero blocks (like a real disk image), the
+    rest is random (hardly compressible) data."""
+    block = 1024 * 1024
+    path = os.path.join(root, name)
+    with lzma.open(path, 'wb', preset=0) as f:
+        for i in range(0, size, block):
+            n = min(block, size - i)
+            f.write(bytes(n) if (i // block) % 2 else os.urandom(n))
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            sha256.update(chunk)
+    with open(path + '.sha256', 'w') as f:
+        f.write('{}  {}\n'.format(sha256.hexdigest(), name))
+    return path
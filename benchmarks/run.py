@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+"""Offline benchmark of the jcs workflows with fake clouds and Jenkins
+
+Runs `jcs create`, `jcs delete`, `jcs create --count` and
+`jcs obs-image-download` against in-process fakes of the AWS, OpenStack
+and Jenkins clients (see fakes.py, with --api-latency, --boot-time and
+--failure-rate) and a local HTTP image server (see imageserver.py). Every
+scenario runs in a fresh interpreter with its own ~/.cache/jcs, so the
+wall time, CPU time and peak RSS are per scenario.
+
+The results are appended (per git commit) to --history and compared with
+the last run of another commit (or --baseline). Exits with 1 if a metric
+got worse by more than --threshold percent:
+
+  python3 benchmarks/run.py --count 20 --threshold 20
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY_FILE = os.path.join(ROOT, '.benchmarks', 'history.jsonl')
+SCENARIOS = ['create', 'delete', 'fleet', 'download', 'decompress']
+# compared metrics and if a higher value is better
+METRICS = {
+    'wall_s': False,
+    'agents_per_s': True,
+    'mb_per_s': True,
+    'cpu_s': False,
+    'maxrss_mb': False,
+}
+# options which must match to compare two runs
+CONFIG_OPTIONS = ['cloud', 'runs', 'count', 'workers', 'api_latency', 'boot_time',
+                  'online_time', 'failure_rate', 'image_mb']
+
+
+def _jcs(argv):
+    """run a jcs command in this process. Returns (wall time, CPU time, failed)"""
+    import jcs
+
+    args = jcs._parser().parse_args(argv)
+    start, cpu = time.perf_counter(), time.process_time()
+    failed = False
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            jcs._run(args)
+        except Exception:
+            failed = True
+    return time.perf_counter() - start, time.process_time() - cpu, failed
+
+
+def _agent_argv(args, *argv):
+    # the fake instances have no sshd to wait for
+    return ['create', '--cloud', args.cloud, '--workers', str(args.workers),
+            '--capacity-cooldown', '0', '--ssh-timeout', '0'] + list(argv) + ['image-name']
+
+
+def _scenario(args):
+    """run a single scenario (in the child process). Returns the metrics"""
+    import fakes
+    import imageserver
+
+    backend = fakes.Backend(args.api_latency, failure_rate=args.failure_rate, seed=0)
+    fakes.install(backend, boot_time=args.boot_time, online_time=args.online_time)
+
+    # the CPU time of the measured commands
+    cpu = 0
+    failed = 0
+    if args.scenario in ('create', 'delete'):
+        times = []
+        for run in range(args.runs):
+            name = 'bench-{}'.format(run)
+            measured = _jcs(_agent_argv(args, name))
+            if args.scenario == 'delete':
+                measured = _jcs(['delete', '--cloud', args.cloud, name])
+            times.append(measured[0])
+            cpu += measured[1]
+            failed += measured[2]
+        result = {'wall_s': statistics.median(times), 'max_s': max(times)}
+    elif args.scenario == 'fleet':
+        wall, cpu, failed = _jcs(_agent_argv(args, '--count', str(args.count), 'bench'))
+        result = {'wall_s': wall, 'agents_per_s': args.count / wall}
+    else:
+        with tempfile.TemporaryDirectory() as root:
+            name = 'image.raw.xz'
+            imageserver.make_image(root, name, args.image_mb * 1024 * 1024)
+            size = os.path.getsize(os.path.join(root, name))
+            with imageserver.ImageServer(root) as server:
+                url = '{}/{}'.format(server.url, name)
+                argv = ['obs-image-download', '--workers', str(args.workers)]
+                if args.scenario == 'decompress':
+                    # only the decompression is measured
+                    _jcs(argv + [url])
+                    argv.append('--raw')
+                    size = args.image_mb * 1024 * 1024
+                wall, cpu, failed = _jcs(argv + [url])
+        result = {'wall_s': wall, 'mb_per_s': size / 1024 / 1024 / wall}
+    result.update({
+        'cpu_s': cpu,
+        # kilobytes on Linux
+        'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'failed': int(failed),
+        'api_calls': backend.calls,
+    })
+    return result
+
+
+def _run_scenario(args, scenario):
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home, PYTHONPATH=ROOT,
+                   JENKINS_URL='http://jenkins.invalid')
+        for var in ('JCS_DAEMON_SOCKET', 'JCS_TRACE'):
+            env.pop(var, None)
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                              ['--scenario', scenario], env=env, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise Exception('Scenario {} failed: {}'.format(scenario, proc.stderr.decode().strip()))
+    return json.loads(proc.stdout.decode().splitlines()[-1])
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _history_load(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _baseline(history, entry, commit=None):
+    """the latest entry of commit (default: another commit) with the same config"""
+    for old in reversed(history):
+        if old['config'] != entry['config']:
+            continue
+        if (commit and old['commit'].startswith(commit)) or \
+                (not commit and old['commit'] != entry['commit']):
+            return old
+    return None
+
+
+def compare(baseline, entry, threshold):
+    """print the change per metric. Returns the regressed metrics"""
+    regressions = []
+    for scenario, results in entry['results'].items():
+        for metric, higher_better in METRICS.items():
+            old = baseline['results'].get(scenario, {}).get(metric)
+            new = results.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = -change if higher_better else change
+            regressed = worse > threshold
+            print('{:<12} {:<14} {:>10.3f} -> {:>10.3f} {:>+7.1f}%{}'.format(
+                scenario, metric, old, new, change, '  REGRESSION' if regressed else ''))
+            if regressed:
+                regressions.append('{}.{}'.format(scenario, metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append',
+                        help='Scenario to run (can be given multiple times, default all)')
+    parser.add_argument('--cloud', choices=['ec2', 'openstack'], default='ec2')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Runs of the single agent create/delete')
+    parser.add_argument('--count', type=int, default=20, help='Agents for the fleet scenario')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--api-latency', type=float, default=0.05,
+                        help='Mean latency of a fake API call in seconds')
+    parser.add_argument('--boot-time', type=float, default=1.0,
+                        help='Seconds until a fake instance is running')
+    parser.add_argument('--online-time', type=float, default=0.2,
+                        help='Seconds until a fake Jenkins agent is online')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Rate (0..1) of failing fake API calls')
+    parser.add_argument('--image-mb', type=int, default=64,
+                        help='Size of the raw image for the download scenarios in MB')
+    group_history = parser.add_argument_group('history')
+    group_history.add_argument('--history', default=HISTORY_FILE,
+                               help='JSON lines file with the results per commit')
+    group_history.add_argument('--no-save', action='store_true',
+                               help='Do not append the results to --history')
+    group_history.add_argument('--baseline',
+                               help='Commit to compare with (default the last other commit)')
+    group_history.add_argument('--threshold', type=float, default=20,
+                               help='Max. percent a metric may get worse')
+    args = parser.parse_args()
+
+    if args.scenario and os.environ.get('JCS_BENCHMARK_CHILD'):
+        args.scenario = args.scenario[-1]
+        print(json.dumps(_scenario(args)))
+        return 0
+
+    os.environ['JCS_BENCHMARK_CHILD'] = '1'
+    entry = {
+        'commit': _git_commit(),
+        'time': time.time(),
+        'config': {option: getattr(args, option) for option in CONFIG_OPTIONS},
+        'results': {},
+    }
+    for scenario in args.scenario or SCENARIOS:
+        result = _run_scenario(args, scenario)
+        entry['results'][scenario] = result
+        print('{:<12} {:>8.3f} s {:>8.3f} cpu s {:>7.1f} MB rss {:>5} calls{}{}{}'.format(
+            scenario, result['wall_s'], result['cpu_s'], result['maxrss_mb'],
+            result['api_calls'],
+            '  {:.1f} agents/s'.format(result['agents_per_s'])
+            if 'agents_per_s' in result else '',
+            '  {:.1f} MB/s'.format(result['mb_per_s']) if 'mb_per_s' in result else '',
+            '  {} failed'.format(result['failed']) if result['failed'] else ''))
+
+    history = _history_load(args.history)
+    baseline = _baseline(history, entry, args.baseline)
+    regressions = []
+    if baseline:
+        print('Compared with {} ({}):'.format(
+            baseline['commit'], time.strftime('%Y-%m-%d %H:%M',
+                                              time.localtime(baseline['time']))))
+        regressions = compare(baseline, entry, args.threshold)
+    if not args.no_save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
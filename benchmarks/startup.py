@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+"""Startup time benchmark for the jcs CLI
+
+Measures the wall time of `jcs --help` (and other cheap invocations) in
+fresh interpreters and checks that the heavy cloud/Jenkins libraries are
+not imported for them. Exits with 1 if the median is above --max-ms or a
+heavy module got imported, so it can run in CI:
+
+  python3 benchmarks/startup.py --max-ms 100
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# modules which must only be imported when a code path really needs them
+HEAVY_MODULES = ['boto3', 'botocore', 'openstack', 'jenkinsapi', 'requests']
+COMMANDS = [
+    ['--help'],
+    ['create', '--help'],
+    ['cache', '--help'],
+]
+
+_RUNNER = '''
+import sys
+sys.argv = ['jcs'] + sys.argv[1:]
+import jcs
+try:
+    jcs.main()
+except SystemExit:
+    pass
+heavy = [m for m in {heavy!r} if m in sys.modules]
+if heavy:
+    sys.stderr.write('heavy modules imported: {{}}\\n'.format(', '.join(heavy)))
+    sys.exit(2)
+'''
+
+
+def _run(argv):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', _RUNNER.format(heavy=HEAVY_MODULES)] + argv,
+                          env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return (time.perf_counter() - start) * 1000, proc.returncode, proc.stderr.decode()
+
+
+def _run_bare():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'])
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='Runs per command')
+    parser.add_argument('--max-ms', type=float, default=100,
+                        help='Max. median wall time per command in ms')
+    args = parser.parse_args()
+
+    # the bare interpreter startup, for reference
+    baseline = statistics.median(_run_bare() for _ in range(args.runs))
+    print('{:<20} {:>8.1f} ms'.format('python (baseline)', baseline))
+
+    failed = False
+    for argv in COMMANDS:
+        times = []
+        for _ in range(args.runs):
+            ms, rc, err = _run(argv)
+            if rc != 0:
+                print('jcs {}: {}'.format(' '.join(argv), err.strip()))
+                failed = True
+                break
+            times.append(ms)
+        if not times:
+            continue
+        median = statistics.median(times)
+        print('{:<20} {:>8.1f} ms (max {:.1f} ms)'.format(
+            'jcs ' + ' '.join(argv), median, max(times)))
+        if median > args.max_ms:
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
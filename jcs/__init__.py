@@ -2,9 +2,21 @@
 
 import argparse
 import os
-import random
-import string
 import sys
+import time
+
+
+def _s3_part_size(value):
+    """argparse type for --s3-part-size (S3 needs parts of at least 5 MiB)"""
+    from . import aws, cache
+    try:
+        size = cache.size_parse(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(value))
+    if size < aws.S3_MIN_PART_SIZE:
+        raise argparse.ArgumentTypeError('{} is smaller than the S3 minimum part size '
+                                         '(5M)'.format(value))
+    return size
 
 
 def _parser():
@@ -52,6 +64,29 @@ def _parser():
     group_os.add_argument('--os-security-groups', default=[],
                                            help='Security groups. Default: %(default)s')
 
+    # global image cache vars
+    group_cache = parser.add_argument_group('cache')
+    group_cache.add_argument('--cache-quota',
+                             default=os.getenv('JCS_CACHE_QUOTA'),
+                             help='Max. size of the image cache in ~/.cache/jcs '
+                             '(can be set as env var "JCS_CACHE_QUOTA", None is the '
+                             'default quota shown by "jcs cache stats")')
+
+    # global tracing vars
+    group_trace = parser.add_argument_group('trace')
+    group_trace.add_argument('--trace', default=os.getenv('JCS_TRACE'),
+                             help='Append the timed phases (spans) as JSON lines to this '
+                             'file (can be set as env var "JCS_TRACE")')
+    group_trace.add_argument('--profile', action='store_true',
+                             help='Show a table with the timings of the phases at exit')
+
+    # global daemon vars
+    group_daemon = parser.add_argument_group('daemon')
+    group_daemon.add_argument('--daemon-socket',
+                              default=os.getenv('JCS_DAEMON_SOCKET'),
+                              help='Run the command in the jcs daemon listening on this '
+                              'socket (can be set as env var "JCS_DAEMON_SOCKET")')
+
     ### subparsers
     subparsers = parser.add_subparsers(title='commands')
 
@@ -71,6 +106,43 @@ def _parser():
         '--jenkins-credential', default='storage-automation-for-root-user',
         help='The Jenkins credential description(!) that can be used to access '
         'the instance')
+    parser_create.add_argument(
+        '--labels', default='', help='Jenkins labels of the slave (space separated)')
+    parser_create.add_argument(
+        '--count', type=int, default=1,
+        help='Number of slaves to create. With more than one, the slaves are '
+        'named <jenkins-name>-1 ... <jenkins-name>-<count>')
+    parser_create.add_argument(
+        '--workers', type=int, default=8,
+        help='Number of parallel instance creations and Jenkins node registrations')
+    parser_create.add_argument(
+        '--placement', action='append', default=None,
+        help='Where to create the slaves as cloud:region:instance-type@weight '
+        '(repeatable, omitted parts default to the other options). Slaves which '
+        'fail for lack of capacity are retried on the next target')
+    parser_create.add_argument(
+        '--placement-mode', default='failover', choices=['failover', 'spread'],
+        help='Use the targets in order or spread the slaves over them (by weight)')
+    parser_create.add_argument(
+        '--capacity-cooldown', type=int, default=300,
+        help='Seconds a target is skipped after a capacity error')
+    parser_create.add_argument(
+        '--spot', action='store_true',
+        help='Launch EC2 spot instances (see "jcs spot-watch")')
+    parser_create.add_argument(
+        '--spot-max-price', default=None,
+        help='Max. hourly spot price in USD (default: the on-demand price)')
+    parser_create.add_argument(
+        '--ssh-timeout', type=int, default=300,
+        help='Seconds to wait for sshd on the instances before the Jenkins nodes '
+        'are registered (0: register right away)')
+    parser_create.add_argument(
+        '--from-pool', action='store_true',
+        help='Take ready instances out of the warm pool (see "jcs pool fill") '
+        'and refill it in the background')
+    parser_create.add_argument(
+        '--pool-size', type=int, default=2,
+        help='Size the warm pool is refilled to with --from-pool')
     parser_create.add_argument('image_name', metavar='image-name',
                                help='The image name (must be already available '
                                'in the cloud)')
@@ -80,14 +152,160 @@ def _parser():
 
     ### all-in-one - delete node as jenkins slave
     parser_delete = subparsers.add_parser(
-        'delete', help='Delete a new Jenkins slave')
+        'delete', help='Delete Jenkins slaves')
     parser_delete.add_argument('--cloud', default='ec2',
                                choices=['ec2', 'openstack'],
                                help='On which cloud')
-    parser_delete.add_argument('jenkins_name', metavar='jenkins-name',
-                               help='The name of the new jenkins slave')
+    parser_delete.add_argument('--label',
+                               help='Delete the slaves (created by jcs) with this label')
+    parser_delete.add_argument('--drain-timeout', type=int, default=3600,
+                               help='Seconds to wait for the running builds of the '
+                               'offline slaves. Slaves still busy after that are '
+                               'not deleted')
+    parser_delete.add_argument('--force', action='store_true',
+                               help='Do not wait for running builds (they are killed)')
+    parser_delete.add_argument('--workers', type=int, default=8,
+                               help='Number of parallel Jenkins node and instance deletions')
+    parser_delete.add_argument('jenkins_names', metavar='jenkins-name', nargs='*',
+                               help='The names of the jenkins slaves (or glob patterns '
+                               'matching slaves created by jcs)')
     parser_delete.set_defaults(func=_do_delete)
 
+    ### list the agents of the inventory
+    parser_ls = subparsers.add_parser(
+        'ls', help='List the slaves created by jcs (from the local inventory)')
+    parser_ls.add_argument('--cloud', choices=['ec2', 'openstack'], default=None,
+                           help='Only slaves on this cloud')
+    parser_ls.add_argument('--image', default=None, help='Only slaves with this image')
+    parser_ls.add_argument('--state', default=None, help='Only slaves in this state')
+    parser_ls.add_argument('--reconcile', action='store_true',
+                           help='Sync the inventory with the clouds first')
+    parser_ls.add_argument('pattern', nargs='?', default=None,
+                           help='Only slaves whose name matches this glob pattern')
+    parser_ls.set_defaults(func=_do_ls)
+
+    ### delete orphaned instances and Jenkins nodes
+    parser_gc = subparsers.add_parser(
+        'gc', help='Delete instances without Jenkins node and nodes without instance')
+    parser_gc.add_argument('--cloud', action='append', choices=['ec2', 'openstack'],
+                           help='Which clouds (repeatable, default: ec2 and openstack '
+                           'if --os-cloud is set)')
+    parser_gc.add_argument('--region', action='append',
+                           help='EC2 region to search for instances (repeatable). '
+                           '--aws-region-name and the regions of the agents in the '
+                           'inventory are always searched')
+    parser_gc.add_argument('--dry-run', action='store_true',
+                           help='Only show the orphans')
+    parser_gc.add_argument('--min-age', type=int, default=900,
+                           help='Min. age in seconds of an orphaned instance')
+    parser_gc.add_argument('--workers', type=int, default=8,
+                           help='Number of parallel deletions')
+    parser_gc.set_defaults(func=_do_gc)
+
+    ### daemon with pooled connections
+    parser_daemon = subparsers.add_parser(
+        'daemon', help='Serve commands on a unix socket with pooled connections')
+    parser_daemon.add_argument('--socket', default=None,
+                               help='Socket path (default: --daemon-socket or '
+                               '$XDG_RUNTIME_DIR/jcs.sock)')
+    parser_daemon.set_defaults(func=_do_daemon)
+
+    ### autoscale slaves from the build queue
+    parser_autoscale = subparsers.add_parser(
+        'autoscale', help='Create and delete slaves based on the Jenkins build queue')
+    parser_autoscale.add_argument('--cloud', default='ec2', choices=['ec2', 'openstack'],
+                                  help='On which cloud')
+    parser_autoscale.add_argument('--arch', default='x86_64', choices=['x86_64', 'aarch64'],
+                                  help='Architecture')
+    parser_autoscale.add_argument('--instance-type', default='t2.micro',
+                                  help='Instance type or Flavor')
+    parser_autoscale.add_argument('--key-name', default='storage-automation',
+                                  help='The keypair name')
+    parser_autoscale.add_argument(
+        '--jenkins-credential', default='storage-automation-for-root-user',
+        help='The Jenkins credential description(!) that can be used to access '
+        'the instance')
+    parser_autoscale.add_argument('--label', action='append', required=True,
+                                  help='Jenkins label to create slaves for (repeatable)')
+    parser_autoscale.add_argument('--prefix', default='jcs-auto',
+                                  help='Name prefix of the autoscaled slaves')
+    parser_autoscale.add_argument('--min', type=int, default=0, help='Min. number of slaves')
+    parser_autoscale.add_argument('--max', type=int, default=10, help='Max. number of slaves')
+    parser_autoscale.add_argument('--queue-wait', type=int, default=60,
+                                  help='Seconds a build waits in the queue before '
+                                  'a slave is created for it')
+    parser_autoscale.add_argument('--idle-cooldown', type=int, default=600,
+                                  help='Seconds a slave is idle before it is deleted')
+    parser_autoscale.add_argument('--interval', type=int, default=30,
+                                  help='Seconds between two checks of the queue')
+    parser_autoscale.add_argument('--workers', type=int, default=8,
+                                  help='Number of parallel creations and deletions')
+    parser_autoscale.add_argument('--once', action='store_true',
+                                  help='Check the queue once and exit')
+    parser_autoscale.add_argument('image_name', metavar='image-name',
+                                  help='The image name (must be already available '
+                                  'in the cloud)')
+    parser_autoscale.add_argument('--spot', action='store_true',
+                                  help='Launch EC2 spot instances')
+    parser_autoscale.add_argument('--spot-max-price', default=None,
+                                  help='Max. hourly spot price in USD')
+    parser_autoscale.add_argument('--ssh-timeout', type=int, default=300,
+                                  help='Seconds to wait for sshd on the instances')
+    parser_autoscale.set_defaults(func=_do_autoscale, from_pool=False)
+
+    ### replace interrupted spot slaves
+    parser_spot_watch = subparsers.add_parser(
+        'spot-watch', help='Replace spot slaves which get interrupted')
+    parser_spot_watch.add_argument(
+        '--key-name', default='storage-automation', help='The keypair name')
+    parser_spot_watch.add_argument(
+        '--jenkins-credential', default='storage-automation-for-root-user',
+        help='The Jenkins credential description(!) that can be used to access '
+        'the instance')
+    parser_spot_watch.add_argument('--spot-max-price', default=None,
+                                   help='Max. hourly spot price in USD')
+    parser_spot_watch.add_argument('--ssh-timeout', type=int, default=300,
+                                   help='Seconds to wait for sshd on the instances')
+    parser_spot_watch.add_argument('--interval', type=int, default=15,
+                                   help='Seconds between two checks')
+    parser_spot_watch.add_argument('--workers', type=int, default=8,
+                                   help='Number of parallel replacements')
+    parser_spot_watch.add_argument('--once', action='store_true',
+                                   help='Check once and exit')
+    parser_spot_watch.set_defaults(func=_do_spot_watch)
+
+    ### warm pool of ready instances
+    parser_pool = subparsers.add_parser(
+        'pool', help='Manage the warm pools of ready instances')
+    subparsers_pool = parser_pool.add_subparsers(title='pool commands')
+    parser_pool_fill = subparsers_pool.add_parser(
+        'fill', help='Start instances until the pool has the given size')
+    parser_pool_fill.add_argument('--cloud', default='ec2', choices=['ec2', 'openstack'],
+                                  help='On which cloud')
+    parser_pool_fill.add_argument('--arch', default='x86_64', choices=['x86_64', 'aarch64'],
+                                  help='Architecture')
+    parser_pool_fill.add_argument('--instance-type', default='t2.micro',
+                                  help='Instance type or Flavor')
+    parser_pool_fill.add_argument('--key-name', default='storage-automation',
+                                  help='The keypair name')
+    parser_pool_fill.add_argument('--size', type=int, default=2, help='Pool size')
+    parser_pool_fill.add_argument('image_name', metavar='image-name',
+                                  help='The image name (must be already available '
+                                  'in the cloud)')
+    parser_pool_fill.set_defaults(func=_do_pool_fill)
+    parser_pool_ls = subparsers_pool.add_parser(
+        'ls', help='List the instances of all pools')
+    parser_pool_ls.add_argument('--cloud', default='ec2', choices=['ec2', 'openstack'],
+                                help='On which cloud')
+    parser_pool_ls.set_defaults(func=_do_pool_ls)
+    parser_pool_reap = subparsers_pool.add_parser(
+        'reap', help='Delete instances which are idle in a pool for too long')
+    parser_pool_reap.add_argument('--cloud', default='ec2', choices=['ec2', 'openstack'],
+                                  help='On which cloud')
+    parser_pool_reap.add_argument('--max-idle', type=int, default=4 * 3600,
+                                  help='Max. seconds an instance may wait in a pool')
+    parser_pool_reap.set_defaults(func=_do_pool_reap)
+
     # jenkins add node
     parser_jenkins_node_add = subparsers.add_parser('jenkins-node-add',
                                                     help='Jenkins add node')
@@ -109,15 +327,86 @@ def _parser():
     # OpenBuildService image download
     parser_obs_image_download = subparsers.add_parser(
         'obs-image-download', help='Download a image from the OpenBuildService')
+    parser_obs_image_download.add_argument('--workers', type=int, default=8,
+                                           help='Number of parallel range requests')
+    parser_obs_image_download.add_argument('--raw', action='store_true',
+                                           help='Also decompress a .xz image into a '
+                                           '(sparse) raw file')
     parser_obs_image_download.add_argument('url', help='Image URL')
     parser_obs_image_download.set_defaults(func=_do_obs_image_download)
 
+    # image cache
+    parser_cache = subparsers.add_parser(
+        'cache', help='Manage the local image cache')
+    subparsers_cache = parser_cache.add_subparsers(title='cache commands')
+    parser_cache_ls = subparsers_cache.add_parser(
+        'ls', help='List the cached images')
+    parser_cache_ls.set_defaults(func=_do_cache_ls)
+    parser_cache_prune = subparsers_cache.add_parser(
+        'prune', help='Evict least recently used images until the quota is met')
+    parser_cache_prune.add_argument('--quota', default=None,
+                                    help='Quota to prune to (default: --cache-quota)')
+    parser_cache_prune.set_defaults(func=_do_cache_prune)
+    parser_cache_stats = subparsers_cache.add_parser(
+        'stats', help='Show image cache statistics')
+    parser_cache_stats.set_defaults(func=_do_cache_stats)
+    parser_cache_lookup_clear = subparsers_cache.add_parser(
+        'lookup-clear', help='Forget the cached image/flavor/network ids')
+    parser_cache_lookup_clear.set_defaults(func=_do_cache_lookup_clear)
+
+    ### images on the clouds
+    parser_image = subparsers.add_parser(
+        'image', help='Manage the images on the clouds')
+    subparsers_image = parser_image.add_subparsers(title='image commands')
+    parser_image_sync = subparsers_image.add_parser(
+        'sync', help='Download OBS images once and make them available on all targets')
+    parser_image_sync.add_argument(
+        '--target', action='append', default=None,
+        help='Where the images are needed as cloud:region, eg. ec2:us-east-1 or '
+        'openstack:my-cloud (repeatable, default: ec2 in --aws-region-name)')
+    parser_image_sync.add_argument('--image-arch', default='x86_64',
+                                   help='Image architecture')
+    parser_image_sync.add_argument('--upload-backend', default='ec2uploadimg',
+                                   choices=['ec2uploadimg', 's3', 'ebs'],
+                                   help='How the images are uploaded to EC2 (see '
+                                   '"ec2-image-create"). Other regions get a copy')
+    parser_image_sync.add_argument('--s3-bucket', default=os.getenv('JCS_S3_BUCKET'),
+                                   help='S3 bucket for the s3 backend '
+                                   '(can be set as env var "JCS_S3_BUCKET")')
+    parser_image_sync.add_argument('--s3-part-size', default='32M', type=_s3_part_size,
+                                   help='Multipart upload part size')
+    parser_image_sync.add_argument('--s3-concurrency', type=int, default=8,
+                                   help='Number of parts (or EBS blocks) uploaded in parallel')
+    parser_image_sync.add_argument('--workers', type=int, default=8,
+                                   help='Number of parallel downloads and uploads')
+    parser_image_sync.add_argument('urls', metavar='url', nargs='+', help='OBS image URL')
+    parser_image_sync.set_defaults(func=_do_image_sync, instance_type=None)
+
     # aws image create
     parser_aws_ec2_image_create = subparsers.add_parser(
         'ec2-image-create', help='Create a new EC2 AMI image (requires ec2imgutils)')
     parser_aws_ec2_image_create.add_argument('filepath', help='Image file path')
     parser_aws_ec2_image_create.add_argument('--image-arch', default='x86_64',
                                              help='Image architecture')
+    parser_aws_ec2_image_create.add_argument('--upload-backend', default='ec2uploadimg',
+                                             choices=['ec2uploadimg', 's3', 'ebs'],
+                                             help='ec2uploadimg, a native S3 multipart '
+                                             'upload plus snapshot import or the EBS '
+                                             'direct APIs (raw images, only the blocks '
+                                             'with data are uploaded)')
+    parser_aws_ec2_image_create.add_argument('--s3-bucket',
+                                             default=os.getenv('JCS_S3_BUCKET'),
+                                             help='S3 bucket for the s3 backend '
+                                             '(can be set as env var "JCS_S3_BUCKET")')
+    parser_aws_ec2_image_create.add_argument('--s3-part-size', default='32M',
+                                             type=_s3_part_size,
+                                             help='Multipart upload part size')
+    parser_aws_ec2_image_create.add_argument('--s3-concurrency', type=int, default=8,
+                                             help='Number of parts (or EBS blocks) '
+                                             'uploaded in parallel')
+    parser_aws_ec2_image_create.add_argument('--s3-upload-id', default=None,
+                                             help='Resume this multipart upload '
+                                             '(default: resume an unfinished one)')
     parser_aws_ec2_image_create.set_defaults(func=_do_aws_ec2_image_create)
 
     # aws instance create
@@ -160,67 +449,164 @@ def _parser():
     return parser
 
 
+def _create_jenkins_names(args):
+    if args.count == 1:
+        return [args.jenkins_name]
+    return ['{}-{}'.format(args.jenkins_name, i) for i in range(1, args.count + 1)]
+
+
 def _do_create(args):
-    from . import jen
+    from concurrent.futures import ThreadPoolExecutor
+    from . import placement
 
     if not args.jenkins_url:
         raise Exception('No JENKINS_URL given')
 
-    jen_client = jen.JenkinsClient(args.jenkins_url, args.jenkins_username,
-                                   args.jenkins_password)
-
-    # AWS/EC2
-    if args.cloud == 'ec2':
-        from . import aws
-        # create ec2 ami
-        aws_client = aws.AWSClient(
-            args.aws_access_key_id, args.aws_secret_access_key, args.aws_region_name)
-        instance_name = 'jcs-' + ''.join(random.choice(string.ascii_lowercase) for i in range(10))
-        instance_ip = aws_client.ec2_instance_create(instance_name,
-            args.instance_type, args.image_name, args.key_name,
-            tags={'jcs-jenkins-name': args.jenkins_name,
-                  'jcs-jenkins-url': args.jenkins_url})
-    elif args.cloud == 'openstack':
-        from . import openst
-        client = openst.OpenstClient(args.os_cloud)
-        instance_name = 'jcs-{}'.format(args.jenkins_name)
-        instance_ip = client.os_instance_create(
-            instance_name, args.instance_type, args.image_name, args.key_name,
-            args.os_network_fixed, args.os_network_public, args.os_security_groups)
-
-    # Jenkins
-    jen_client.create_node(
-        instance_ip, args.jenkins_name, 'Running on AWS ({}, {}, {})'.format(
-            instance_ip, instance_name, args.cloud), args.jenkins_credential, '')
+    start = time.time()
+    jenkins_names = _create_jenkins_names(args)
+    targets = [placement.Target(spec, args) for spec in args.placement or [args.cloud]]
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        # images are copied from the default region to other regions
+        results = placement.create(executor, args, jenkins_names, targets,
+                                   mode=args.placement_mode,
+                                   image_source_region=args.aws_region_name,
+                                   cooldown=args.capacity_cooldown)
+    if args.from_pool:
+        from . import warmpool
+        warmpool.fill_background(args, args.pool_size)
+
+    failed = [name for name in jenkins_names if isinstance(results[name], Exception)]
+    for jenkins_name in jenkins_names:
+        if jenkins_name in failed:
+            print('Agent "{}" failed: {}'.format(jenkins_name, results[jenkins_name]))
+        else:
+            instance = results[jenkins_name]
+            print('Agent "{}" created ({}, {})'.format(jenkins_name, instance['name'],
+                                                       instance['ip']))
+    print('Created {} of {} agents in {:.1f}s'.format(
+        len(jenkins_names) - len(failed), len(jenkins_names), time.time() - start))
+    if failed:
+        raise Exception('Failed to create agents: {}'.format(', '.join(failed)))
 
 
 def _do_delete(args):
-    from . import jen
-    # Jenkins
-    try:
-        jen_client = jen.JenkinsClient(args.jenkins_url, args.jenkins_username,
-                                       args.jenkins_password)
-        jen_client.delete_node(args.jenkins_name)
-    except Exception as e:
-        print("Unable to remove jenkins node {}".format(args.jenkins_name))
-
-    if args.cloud == 'ec2':
-        from . import aws
-        aws_client = aws.AWSClient(
-            args.aws_access_key_id, args.aws_secret_access_key, args.aws_region_name)
-        tags={'jcs-jenkins-name': args.jenkins_name,
-              'jcs-jenkins-url': args.jenkins_url}
-        aws_client.ec2_instance_delete_by_tags(tags)
-    if args.cloud == 'openstack':
-        from . import openst
-        client = openst.OpenstClient(args.os_cloud)
-        instance_name = 'jcs-{}'.format(args.jenkins_name)
-        client.os_instance_delete(instance_name)
+    from concurrent.futures import ThreadPoolExecutor
+    from . import orchestrate, workflow
+    if not args.jenkins_names and not args.label:
+        raise Exception('Give the names of the slaves to delete or --label')
+    jenkins_names = workflow.delete_targets(args, args.jenkins_names, args.label)
+    if not jenkins_names:
+        print('No slaves to delete')
+        return
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        graph = orchestrate.Graph(executor)
+        steps = workflow.delete(graph, args, jenkins_names,
+                                drain_timeout=None if args.force else args.drain_timeout)
+        results = orchestrate.run(graph)[0]
+
+    failed = [name for name, step in steps.items() if isinstance(results[step], Exception)]
+    for jenkins_name in jenkins_names:
+        if jenkins_name in failed:
+            print('Agent "{}" failed: {}'.format(jenkins_name, results[steps[jenkins_name]]))
+        else:
+            print('Agent "{}" deleted'.format(jenkins_name))
+    print('Deleted {} of {} agents in {:.1f}s'.format(
+        len(jenkins_names) - len(failed), len(jenkins_names), time.time() - start))
+    if failed:
+        raise Exception('Failed to delete agents: {}'.format(', '.join(failed)))
+
+
+def _do_ls(args):
+    from . import inventory
+    if args.reconcile:
+        _inventory_reconcile(args, [args.cloud] if args.cloud else
+                             (['ec2', 'openstack'] if args.os_cloud else ['ec2']))
+    for agent in inventory.default().ls(args.jenkins_url, args.cloud, args.image, args.state,
+                                        args.pattern):
+        print('{}  {:<9}  {}  {}  {}  {}  {}'.format(
+            agent['jenkins_name'], agent['cloud'], agent['instance_id'], agent['ip'],
+            agent['state'], time.strftime('%Y-%m-%d %H:%M', time.localtime(agent['created'])),
+            agent['image'] or '-'))
+
+
+def _inventory_reconcile(args, clouds):
+    from . import clients, inventory
+    if 'ec2' in clouds:
+        instances = [dict(i, name=i['id'], created=i['launched'])
+                     for i in clients.aws(args).ec2_jcs_instances()
+                     if i['jenkins_url'] == args.jenkins_url]
+        counts = inventory.default().reconcile(args.jenkins_url, 'ec2', instances,
+                                               region=args.aws_region_name)
+        print('Inventory ec2 {}: {added} added, {updated} updated, {removed} removed'.format(
+            args.aws_region_name, **counts))
+    if 'openstack' in clouds:
+        instances = [dict(s, state=s['status'].lower())
+                     for s in clients.openstack(args).os_jcs_servers()
+                     if s['jenkins_url'] == args.jenkins_url]
+        counts = inventory.default().reconcile(args.jenkins_url, 'openstack', instances,
+                                               region=args.os_cloud)
+        print('Inventory openstack {}: {added} added, {updated} updated, '
+              '{removed} removed'.format(args.os_cloud, **counts))
+
+
+def _do_gc(args):
+    from . import gc
+    if not args.jenkins_url:
+        raise Exception('No JENKINS_URL given')
+    clouds = args.cloud or (['ec2', 'openstack'] if args.os_cloud else ['ec2'])
+    found = gc.run(args, clouds, dry_run=args.dry_run, min_age=args.min_age,
+                   workers=args.workers)
+    print('GC {} {} orphaned instance(s) and {} Jenkins node(s)'.format(
+        'found' if args.dry_run else 'deleted',
+        sum(len(found[cloud]) for cloud in clouds), len(found['nodes'])))
+
+
+def _do_daemon(args):
+    from . import daemon
+    daemon.serve(args.socket or args.daemon_socket or daemon.socket_path_default())
+
+
+def _do_autoscale(args):
+    from . import autoscale, clients
+    if not args.jenkins_url:
+        raise Exception('No JENKINS_URL given')
+    # the loop reuses the connections
+    clients.enable_pooling()
+    autoscale.run(args, iterations=1 if args.once else None)
+
+
+def _do_spot_watch(args):
+    from . import clients, spot
+    if not args.jenkins_url:
+        raise Exception('No JENKINS_URL given')
+    clients.enable_pooling()
+    spot.watch(args, iterations=1 if args.once else None)
+
+
+def _do_pool_fill(args):
+    from . import warmpool
+    warmpool.fill(args, args.size)
+
+
+def _do_pool_ls(args):
+    from . import warmpool
+    for instance in warmpool.ls(args):
+        print('{}  {:<10}  {}  {}'.format(
+            instance['id'], instance['state'],
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(instance['since'])),
+            instance['pool']))
+
+
+def _do_pool_reap(args):
+    from . import warmpool
+    reaped = warmpool.reap(args, args.max_idle)
+    print('Pool reaped {} instance(s)'.format(len(reaped)))
 
 
 def _do_os_instance_create(args):
-    from . import openst
-    client = openst.OpenstClient(args.os_cloud)
+    from . import clients
+    client = clients.openstack(args)
     client.os_instance_create(args.name, args.instance_type,
                               args.image_name, args.key_name,
                               args.os_network_fixed, args.os_network_public,
@@ -228,57 +614,119 @@ def _do_os_instance_create(args):
 
 
 def _do_os_instance_delete(args):
-    from . import openst
-    client = openst.OpenstClient(args.os_cloud)
+    from . import clients
+    client = clients.openstack(args)
     client.os_instance_delete(args.id)
 
 
 def _do_aws_ec2_instance_create(args):
-    from . import aws
-    client = aws.AWSClient(args.aws_access_key_id, args.aws_secret_access_key,
-                           args.aws_region_name)
+    from . import clients
+    client = clients.aws(args)
     client.ec2_instance_create(args.name, args.instance_type, args.image_name,
                                args.key_name)
 
 
 def _do_aws_ec2_instance_delete(args):
-    from . import aws
-    client = aws.AWSClient(args.aws_access_key_id, args.aws_secret_access_key,
-                           args.aws_region_name)
+    from . import clients
+    client = clients.aws(args)
     client.ec2_instance_delete(args.id)
 
 
 def _do_aws_ec2_image_create(args):
-    from . import aws
-    client = aws.AWSClient(args.aws_access_key_id, args.aws_secret_access_key,
-                           args.aws_region_name)
-    image = client.ec2_image_create(args.filepath,args.image_arch)
+    from . import clients
+    client = clients.aws(args)
+    image = client.ec2_image_create(args.filepath, args.image_arch,
+                                    backend=args.upload_backend,
+                                    bucket=args.s3_bucket,
+                                    part_size=args.s3_part_size,
+                                    concurrency=args.s3_concurrency,
+                                    upload_id=args.s3_upload_id)
     print('Name: {}, Id: {}'.format(image['image_name'], image['image_id']))
 
 
+def _do_image_sync(args):
+    from . import imagesync
+    results = imagesync.run(args, args.urls, args.target or ['ec2'])
+    failed = [key for key, result in results.items() if isinstance(result, Exception)]
+    for key, result in results.items():
+        print('Image {}: {}'.format(key, 'failed: {}'.format(result) if key in failed
+                                    else result))
+    if failed:
+        raise Exception('Failed to sync {} of {} images'.format(len(failed), len(results)))
+
+
 def _do_obs_image_download(args):
-    from . import obs
-    img = obs.OBSImage(args.url)
-    img.download()
+    from . import cache, obs
+    image_cache = cache.ImageCache(quota=args.cache_quota)
+    img = obs.OBSImage(args.url, workers=args.workers, image_cache=image_cache)
+    path = img.decompress() if args.raw else img.download()
+    print('Image available at {}'.format(path))
+
+
+def _do_cache_ls(args):
+    from . import cache
+    image_cache = cache.ImageCache(quota=args.cache_quota)
+    for blob in image_cache.ls():
+        print('{}  {:>8}  {}  {}'.format(
+            blob['sha256'][:16], cache.size_format(blob['size']),
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(blob['atime'])),
+            ' '.join(blob['urls'])))
+
+
+def _do_cache_prune(args):
+    from . import cache
+    image_cache = cache.ImageCache(quota=args.cache_quota)
+    quota = cache.size_parse(args.quota) if args.quota else None
+    evicted = image_cache.prune(quota)
+    for sha256 in evicted:
+        print('Cache evicted image {}'.format(sha256))
+    print('Cache pruned {} image(s)'.format(len(evicted)))
+
+
+def _do_cache_stats(args):
+    from . import cache
+    image_cache = cache.ImageCache(quota=args.cache_quota)
+    stats = image_cache.stats()
+    print('Images: {}, URLs: {}, Size: {}, Quota: {}'.format(
+        stats['blobs'], stats['urls'], cache.size_format(stats['size']),
+        cache.size_format(stats['quota'])))
+
+
+def _do_cache_lookup_clear(args):
+    from . import lookup
+    lookup.default().invalidate()
+    print('Cache lookups cleared')
 
 
 def _do_jenkins_node_add(args):
-    from . import jen
+    from . import clients
     if not args.jenkins_url:
         raise Exception('No jenkins server url provided.')
-    client = jen.JenkinsClient(args.jenkins_url, args.jenkins_username,
-                               args.jenkins_password)
+    client = clients.jenkins(args)
     client.create_node(args.hostname, args.name, args.desc, args.credential,
                        args.labels)
 
 
 def _do_jenkins_node_delete(args):
-    from . import jen
+    from . import clients
     if not args.jenkins_url:
         raise Exception('No jenkins server url provided.')
-    client = jen.JenkinsClient(args.jenkins_url, args.jenkins_username,
-                               args.jenkins_password)
-    client.node_delete(args.name)
+    client = clients.jenkins(args)
+    client.delete_node(args.name)
+
+
+def _run(args):
+    """run the command of args as traced span"""
+    from . import trace
+    trace.export_to(args.trace)
+    root = None
+    try:
+        with trace.span('jcs', command=args.func.__name__[len('_do_'):]) as root:
+            args.func(args)
+    finally:
+        # the summary is also shown when the command failed
+        if args.profile and root:
+            trace.print_summary(root['trace_id'])
 
 
 def main():
@@ -286,7 +734,13 @@ def main():
     args = parser.parse_args()
     if 'func' not in args:
         sys.exit(parser.print_help())
-    args.func(args)
+    if args.daemon_socket and args.func is not _do_daemon:
+        from . import daemon
+        if args.func.__name__ in daemon.COMMANDS:
+            rc = daemon.call(args.daemon_socket, args)
+            if rc is not None:
+                return rc
+    _run(args)
     return 0
 
 
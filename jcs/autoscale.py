@@ -0,0 +1,120 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from . import clients
+from . import orchestrate
+from . import workflow
+
+
+def decide(queue: List[dict], nodes: List[dict], idle_since: Dict[str, float], now: float,
+           labels: List[str], prefix: str, min_agents: int = 0, max_agents: int = 10,
+           queue_wait: float = 60, idle_cooldown: float = 600
+           ) -> Tuple[Dict[str, int], List[str], Dict[str, float]]:
+    """decide how to scale the agents named prefix-* for the labels
+
+    queue are the queue items and nodes the node usage as returned by
+    JenkinsClient.queue_items() and nodes_usage(). idle_since maps node
+    names to the time they were first seen idle (the state of the last call).
+
+    Scales out for each item that waits longer than queue_wait for one of
+    the labels and has no idle (online) agent. Scales in agents which are
+    idle for idle_cooldown seconds, offline ones included (eg.
+    disconnected), so they do not count towards max_agents forever. The
+    number of agents stays within min_agents and max_agents.
+    Returns (number of agents to create per label, names of agents to
+    delete, new idle_since)."""
+    agents = [n for n in nodes if n['name'].startswith(prefix + '-')]
+    idle = [n for n in agents if n['idle']]
+    idle_since = {n['name']: idle_since.get(n['name'], now) for n in idle}
+
+    # queued items which idle agents do not pick up (yet) are the demand
+    create = {}
+    for label in labels:
+        waiting = [i for i in queue if i['label'] == label and now - i['since'] >= queue_wait]
+        available = [n for n in idle if label in n['labels'] and not n['offline']]
+        if len(waiting) > len(available):
+            create[label] = len(waiting) - len(available)
+
+    total = len(agents)
+    for label in list(create):
+        create[label] = min(create[label], max(max_agents - total, 0))
+        total += create[label]
+        if not create[label]:
+            del create[label]
+    if total < min_agents and labels:
+        create[labels[0]] = create.get(labels[0], 0) + min_agents - total
+        total = min_agents
+
+    delete = []
+    if not create:
+        wanted = {i['label'] for i in queue}
+        for node in sorted(idle, key=lambda n: idle_since[n['name']]):
+            if total <= min_agents:
+                break
+            if now - idle_since[node['name']] < idle_cooldown:
+                continue
+            if wanted.intersection(node['labels']) and not node['offline']:
+                continue
+            delete.append(node['name'])
+            total -= 1
+    for name in delete:
+        del idle_since[name]
+    return create, delete, idle_since
+
+
+def _agent_names(prefix, label, count, now):
+    return ['{}-{}-{}-{}'.format(prefix, label.replace(' ', '_'), int(now), i)
+            for i in range(count)]
+
+
+def scale(args, create: Dict[str, int], delete: List[str], now: float) -> Dict[str, object]:
+    """create and delete the agents with the create/delete flows, concurrently
+
+    Returns the result (or exception) per agent name."""
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        graphs = []
+        steps = {}
+        for label, count in create.items():
+            # one graph per label (the steps of a create flow are per graph)
+            graph = orchestrate.Graph(executor)
+            label_args = argparse.Namespace(**vars(args))
+            label_args.labels = label
+            steps.update(workflow.create(graph, label_args,
+                                         _agent_names(args.prefix, label, count, now)))
+            graphs.append(graph)
+        if delete:
+            graph = orchestrate.Graph(executor)
+            # the agents were idle, but a build might have started since
+            steps.update(workflow.delete(graph, args, delete, drain_timeout=0))
+            graphs.append(graph)
+        results = {}
+        for graph_results in orchestrate.run(*graphs):
+            results.update(graph_results)
+    return {name: results[step] for name, step in steps.items()}
+
+
+def run(args, iterations=None):
+    """scale the agents every args.interval seconds (forever, by default)"""
+    jenkins = clients.jenkins(args)
+    idle_since = {}
+    iteration = 0
+    while iterations is None or iteration < iterations:
+        iteration += 1
+        start = time.time()
+        queue = jenkins.queue_items()
+        nodes = jenkins.nodes_usage()
+        create, delete, idle_since = decide(
+            queue, nodes, idle_since, start, args.label, args.prefix,
+            min_agents=args.min, max_agents=args.max, queue_wait=args.queue_wait,
+            idle_cooldown=args.idle_cooldown)
+        print('Autoscale: {} queued, {} agents, create {}, delete {}'.format(
+            len(queue), len([n for n in nodes if n['name'].startswith(args.prefix + '-')]),
+            sum(create.values()), len(delete)))
+        if create or delete:
+            for name, result in scale(args, create, delete, start).items():
+                if isinstance(result, Exception):
+                    print('Autoscale: agent "{}" failed: {}'.format(name, result))
+        if iterations is None or iteration < iterations:
+            time.sleep(max(args.interval - (time.time() - start), 0))
@@ -1,11 +1,48 @@
+import base64
 import hashlib
-import time
 import os
-import sys
+import time
 import subprocess
-import boto3
-from botocore.exceptions import ClientError
-from botocore.client import Config
+import threading
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait as futures_wait
+
+from . import image
+from . import lookup
+from . import trace
+from . import wait
+from .executor import ThreadPoolExecutor
+from .placement import CapacityError
+
+
+# multipart upload defaults for the s3 backend
+S3_PART_SIZE = 32 * 1024 * 1024
+# S3 rejects smaller parts (except the last one) when the upload is completed
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_CONCURRENCY = 8
+# block size of the EBS direct APIs (put_snapshot_block)
+EBS_BLOCK_SIZE = 512 * 1024
+# seconds to wait for an EBS snapshot to be completed
+EBS_SNAPSHOT_TIMEOUT = 3600
+# max. seconds between two import snapshot task status checks
+IMPORT_SNAPSHOT_POLL = 30
+IMPORT_SNAPSHOT_TIMEOUT = 4 * 3600
+# seconds to wait for new instances to be running
+INSTANCE_RUNNING_TIMEOUT = 600
+# instance states from which an instance never gets running
+INSTANCE_STATES_TERMINAL = ('shutting-down', 'terminated', 'stopping', 'stopped')
+# max. instance ids per terminate_instances call
+TERMINATE_BATCH_SIZE = 1000
+# seconds to wait for a copied image to be available
+IMAGE_COPY_TIMEOUT = 3600
+# run_instances errors which mean that the region has no capacity (for the type)
+CAPACITY_ERRORS = ('InsufficientInstanceCapacity', 'InstanceLimitExceeded',
+                   'VcpuLimitExceeded', 'Unsupported', 'SpotMaxPriceTooLow',
+                   'MaxSpotInstanceCountExceeded')
+# spot request status codes of an interrupted (or soon interrupted) spot instance
+SPOT_INTERRUPTION_CODES = ('marked-for-termination', 'marked-for-stop',
+                           'instance-terminated-by-price', 'instance-terminated-no-capacity',
+                           'instance-terminated-capacity-oversubscribed')
 
 
 class AWSClient:
@@ -13,19 +50,48 @@ class AWSClient:
         self._access_key = access_key
         self._secret_key = secret_key
         self._region_name = region_name
-        self._ec2_client = boto3.client('ec2', aws_access_key_id=self._access_key,
-                                        aws_secret_access_key=self._secret_key,
-                                        region_name=self._region_name)
-        self._ec2 = boto3.resource('ec2', aws_access_key_id=self._access_key,
-                                   aws_secret_access_key=self._secret_key,
-                                   region_name=self._region_name)
-        self._s3_client = boto3.client('s3', aws_access_key_id=self._access_key,
-                                       aws_secret_access_key=self._secret_key,
-                                       region_name=self._region_name,
-                                       config=Config(signature_version='s3v4'))
-        self._iam_client = boto3.client('iam', aws_access_key_id=self._access_key,
-                                        aws_secret_access_key=self._secret_key,
-                                        region_name=self._region_name)
+        # boto3 is imported and the session/clients are created on first use
+        self._session = None
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+    def _client(self, kind, service, **kwargs):
+        """get (and create on first use) a boto3 client or resource"""
+        with self._clients_lock:
+            if (kind, service) not in self._clients:
+                if self._session is None:
+                    import boto3
+                    self._session = boto3.session.Session(
+                        aws_access_key_id=self._access_key,
+                        aws_secret_access_key=self._secret_key,
+                        region_name=self._region_name)
+                factory = self._session.client if kind == 'client' else self._session.resource
+                client = factory(service, **kwargs)
+                trace.botocore_hooks(client if kind == 'client' else client.meta.client)
+                self._clients[(kind, service)] = client
+            return self._clients[(kind, service)]
+
+    @property
+    def _ec2_client(self):
+        return self._client('client', 'ec2')
+
+    @property
+    def _ec2(self):
+        return self._client('resource', 'ec2')
+
+    @property
+    def _ebs_client(self):
+        return self._client('client', 'ebs')
+
+    @property
+    def _s3_client(self):
+        from botocore.client import Config
+        return self._client('client', 's3', config=Config(signature_version='s3v4'))
+
+    def _lookup_key(self, kind, name=''):
+        """the key for name->id resolutions in the lookup cache"""
+        return 'ec2:{}:{}:{}:{}'.format(self._access_key or 'default', self._region_name,
+                                        kind, name)
 
     def _ec2_image_id(self, image_name):
         resp = self._ec2_client.describe_images(
@@ -38,20 +104,239 @@ class AWSClient:
         return resp['Images'][0]['ImageId']
 
     def _ec2_image_name(self, image_path):
-        image_name = os.path.basename(image_path)
-        if image_name.endswith('.xz'):
-            image_name = image_name[:-3]
-        if image_name.endswith('.raw'):
-            image_name = image_name[:-4]
-        return image_name
-
-    def ec2_image_create(self, image_path, image_arch):
+        return image.image_name(image_path)
+
+    def _s3_multipart_upload_find(self, bucket, key):
+        """get the id of an unfinished multipart upload for key (to resume it)"""
+        paginator = self._s3_client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=bucket, Prefix=key):
+            for upload in page.get('Uploads', []):
+                if upload['Key'] == key:
+                    return upload['UploadId']
+        return None
+
+    def _s3_multipart_parts(self, bucket, key, upload_id):
+        """get the already uploaded parts (PartNumber: ETag) of a multipart upload"""
+        parts = {}
+        paginator = self._s3_client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = part['ETag']
+        return parts
+
+    def _s3_upload_part(self, bucket, key, upload_id, part_number, data):
+        resp = self._s3_client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                           PartNumber=part_number, Body=data)
+        return resp['ETag']
+
+    def s3_upload(self, bucket, key, chunks, part_size=S3_PART_SIZE,
+                  concurrency=S3_CONCURRENCY, upload_id=None):
+        """upload the chunks to s3://bucket/key with concurrent multipart parts
+
+        An unfinished upload of the same key is resumed: parts which are
+        already uploaded with the same content (md5) are skipped."""
+        if part_size < S3_MIN_PART_SIZE:
+            raise Exception('S3 part size {} is smaller than the minimum {}'.format(
+                part_size, S3_MIN_PART_SIZE))
+        upload_id = upload_id or self._s3_multipart_upload_find(bucket, key)
+        if upload_id:
+            parts_done = self._s3_multipart_parts(bucket, key, upload_id)
+            print('S3 resuming upload {} of s3://{}/{} ({} parts done)'.format(
+                upload_id, bucket, key, len(parts_done)))
+        else:
+            upload_id = self._s3_client.create_multipart_upload(
+                Bucket=bucket, Key=key)['UploadId']
+            parts_done = {}
+            print('S3 uploading to s3://{}/{} (upload id {}) ...'.format(
+                bucket, key, upload_id))
+
+        def _parts():
+            buf = bytearray()
+            for chunk in chunks:
+                buf += chunk
+                while len(buf) >= part_size:
+                    yield bytes(buf[:part_size])
+                    del buf[:part_size]
+            if buf:
+                yield bytes(buf)
+
+        etags = {}
+        pending = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for part_number, data in enumerate(_parts(), start=1):
+                etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+                if parts_done.get(part_number) == etag:
+                    etags[part_number] = etag
+                    continue
+                # bound the number of parts in memory
+                while len(pending) >= concurrency:
+                    done, _ = futures_wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        etags[pending.pop(future)] = future.result()
+                future = executor.submit(self._s3_upload_part, bucket, key, upload_id,
+                                         part_number, data)
+                pending[future] = part_number
+            for future in list(pending):
+                etags[pending.pop(future)] = future.result()
+
+        self._s3_client.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etags[n]}
+                                       for n in sorted(etags)]})
+        print('S3 upload to s3://{}/{} done ({} parts)'.format(bucket, key, len(etags)))
+
+    def _s3_object_exists(self, bucket, key):
+        from botocore.exceptions import ClientError
+        try:
+            self._s3_client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def ec2_import_snapshot(self, bucket, key, description):
+        """import the raw image s3://bucket/key as EBS snapshot"""
+        resp = self._ec2_client.import_snapshot(
+            Description=description,
+            DiskContainer={'Description': description, 'Format': 'RAW',
+                           'UserBucket': {'S3Bucket': bucket, 'S3Key': key}})
+        task_id = resp['ImportTaskId']
+        print('EC2 importing snapshot from s3://{}/{} (task {}) ...'.format(
+            bucket, key, task_id))
+
+        def _check():
+            resp = self._ec2_client.describe_import_snapshot_tasks(ImportTaskIds=[task_id])
+            detail = resp['ImportSnapshotTasks'][0]['SnapshotTaskDetail']
+            status = detail.get('Status')
+            if status == 'completed':
+                return detail['SnapshotId']
+            if status in ('deleting', 'deleted') or status is None:
+                raise Exception('EC2 import snapshot task {} failed: {}'.format(
+                    task_id, detail.get('StatusMessage', status)))
+            print('EC2 import snapshot task {}: {} {}% {}'.format(
+                task_id, status, detail.get('Progress', 0), detail.get('StatusMessage', '')))
+            return None
+
+        snapshot_id = wait.wait_for('import snapshot task {}'.format(task_id), _check,
+                                    timeout=IMPORT_SNAPSHOT_TIMEOUT, delay=5,
+                                    max_delay=IMPORT_SNAPSHOT_POLL)
+        print('EC2 snapshot {} imported'.format(snapshot_id))
+        return snapshot_id
+
+    def ebs_snapshot_create(self, image_path, description, concurrency=S3_CONCURRENCY):
+        """create an EBS snapshot from the raw image with the EBS direct APIs
+
+        Only the blocks with data are uploaded (see image.ExtentMap), the
+        zero regions of the image are skipped. Returns the snapshot id."""
+        if image_path.endswith('.xz'):
+            raise Exception('The ebs image backend needs a raw image, not {} (see '
+                            '"obs-image-download --raw")'.format(image_path))
+        extent_map = image.analyze(image_path)[1]
+        blocks = list(extent_map.blocks(EBS_BLOCK_SIZE))
+        resp = self._ebs_client.start_snapshot(
+            VolumeSize=max(-(-extent_map.size // 1024 ** 3), 1), Description=description)
+        snapshot_id = resp['SnapshotId']
+        print('EBS uploading {} of {} blocks to snapshot {} ...'.format(
+            len(blocks), -(-extent_map.size // EBS_BLOCK_SIZE), snapshot_id))
+
+        def _put(fd, index):
+            data = os.pread(fd, EBS_BLOCK_SIZE, index * EBS_BLOCK_SIZE)
+            data += bytes(EBS_BLOCK_SIZE - len(data))
+            self._ebs_client.put_snapshot_block(
+                SnapshotId=snapshot_id, BlockIndex=index, BlockData=data,
+                DataLength=EBS_BLOCK_SIZE,
+                Checksum=base64.b64encode(hashlib.sha256(data).digest()).decode(),
+                ChecksumAlgorithm='SHA256')
+
+        fd = os.open(image_path, os.O_RDONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for future in [executor.submit(_put, fd, index) for index in blocks]:
+                    future.result()
+        finally:
+            os.close(fd)
+        self._ebs_client.complete_snapshot(SnapshotId=snapshot_id,
+                                           ChangedBlocksCount=len(blocks))
+
+        def _completed():
+            snapshot = self._ec2_client.describe_snapshots(
+                SnapshotIds=[snapshot_id])['Snapshots'][0]
+            if snapshot['State'] == 'error':
+                raise Exception('EBS snapshot {} failed: {}'.format(
+                    snapshot_id, snapshot.get('StateMessage', '')))
+            return snapshot_id if snapshot['State'] == 'completed' else None
+
+        wait.wait_for('EBS snapshot {}'.format(snapshot_id), _completed,
+                      timeout=EBS_SNAPSHOT_TIMEOUT, delay=2, max_delay=30)
+        print('EBS snapshot {} created ({} bytes uploaded)'.format(
+            snapshot_id, len(blocks) * EBS_BLOCK_SIZE))
+        return snapshot_id
+
+    def ec2_register_image(self, image_name, snapshot_id, image_arch):
+        resp = self._ec2_client.register_image(
+            Name=image_name, Description=image_name,
+            Architecture='arm64' if image_arch == 'aarch64' else image_arch,
+            RootDeviceName='/dev/sda1',
+            BlockDeviceMappings=[{'DeviceName': '/dev/sda1',
+                                  'Ebs': {'SnapshotId': snapshot_id,
+                                          'DeleteOnTermination': True,
+                                          'VolumeType': 'gp3'}}],
+            VirtualizationType='hvm', EnaSupport=True)
+        print('EC2 image {} registered (Id: {})'.format(image_name, resp['ImageId']))
+        return resp['ImageId']
+
+    def _ec2_image_create_s3(self, image_path, image_arch, image_name, bucket,
+                             part_size, concurrency, upload_id):
+        if not bucket:
+            raise Exception('No S3 bucket given for the s3 image backend')
+        key = 'jcs/{}.raw'.format(image_name)
+        if self._s3_object_exists(bucket, key):
+            print('S3 object s3://{}/{} already exists. Skipping upload'.format(bucket, key))
+        else:
+            # the raw image is streamed into the upload (no local raw copy)
+            with trace.span('s3-upload', bucket=bucket, key=key):
+                self.s3_upload(bucket, key, image.raw_chunks(image_path), part_size=part_size,
+                               concurrency=concurrency, upload_id=upload_id)
+        with trace.span('import-snapshot', key=key):
+            snapshot_id = self.ec2_import_snapshot(bucket, key, image_name)
+        with trace.span('register-image', image=image_name):
+            image_id = self.ec2_register_image(image_name, snapshot_id, image_arch)
+        self._s3_client.delete_object(Bucket=bucket, Key=key)
+        lookup.default().set(self._lookup_key('image', image_name), image_id)
+        return image_id
+
+    def _ec2_image_create_ebs(self, image_path, image_arch, image_name, concurrency):
+        with trace.span('ebs-snapshot', image=image_name):
+            snapshot_id = self.ebs_snapshot_create(image_path, image_name, concurrency)
+        with trace.span('register-image', image=image_name):
+            image_id = self.ec2_register_image(image_name, snapshot_id, image_arch)
+        lookup.default().set(self._lookup_key('image', image_name), image_id)
+        return image_id
+
+    def ec2_image_create(self, image_path, image_arch, backend='ec2uploadimg',
+                         bucket=None, part_size=S3_PART_SIZE, concurrency=S3_CONCURRENCY,
+                         upload_id=None, tags=None):
+        """create an AMI from the image file (named after the file)
+
+        tags (dict) are set on a new AMI."""
         image_name = self._ec2_image_name(image_path)
         image_id = self._ec2_image_id(image_name)
         if image_id:
             print('EC2 image {} already exists (Id: {}).'.format(
                 image_name, image_id))
-            return {'image_name': image_name, 'image_id': self._ec2_image_id(image_name)}
+            return {'image_name': image_name, 'image_id': image_id}
+
+        if backend in ('s3', 'ebs'):
+            if backend == 's3':
+                image_id = self._ec2_image_create_s3(image_path, image_arch, image_name,
+                                                     bucket, part_size, concurrency, upload_id)
+            else:
+                image_id = self._ec2_image_create_ebs(image_path, image_arch, image_name,
+                                                      concurrency)
+            if tags:
+                self.ec2_image_tag(image_id, tags)
+            return {'image_name': image_name, 'image_id': image_id}
 
         print('EC2 uploading image {} as new AMI ...'.format(image_name))
         cmd = ['ec2uploadimg',
@@ -66,43 +351,371 @@ class AWSClient:
         try:
             out = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as e:
-            print('Failed to call "{}" (rc: {}): {}'.format(
-                e.cmd, e.returncode, e.output))
-            sys.exit(1)
+            raise Exception('Failed to call "{}" (rc: {}): {}'.format(
+                e.cmd[0], e.returncode, e.output.decode(errors='replace').strip()))
         # now get the imageId and return it
-        return {'image_name': image_name, 'image_id': self._ec2_image_id(image_name)}
+        image_id = self._ec2_image_id(image_name)
+        lookup.default().set(self._lookup_key('image', image_name), image_id)
+        if tags:
+            self.ec2_image_tag(image_id, tags)
+        return {'image_name': image_name, 'image_id': image_id}
+
+    def ec2_image_lookup(self, image_name):
+        """get the id of the image with the given name. Raises if not found
+
+        The result is cached in the lookup cache."""
+        image_id = lookup.default().resolve(self._lookup_key('image', image_name),
+                                            lambda: self._ec2_image_id(image_name))
+        if not image_id:
+            raise Exception('EC2 image "{}" not found'.format(image_name))
+        return image_id
+
+    def ec2_image_find(self, image_name):
+        """get the image with the name (dict with id, state, tags) or None (not cached)"""
+        resp = self._ec2_client.describe_images(
+            Filters=[{'Name': 'name', 'Values': [image_name]}])
+        if len(resp['Images']) > 1:
+            raise Exception('Found multiple ({}) images with name "{}"'.format(
+                len(resp['Images']), image_name))
+        if not resp['Images']:
+            return None
+        found = resp['Images'][0]
+        return {'id': found['ImageId'], 'state': found['State'],
+                'tags': {t['Key']: t['Value'] for t in found.get('Tags', [])}}
+
+    def ec2_image_tag(self, image_id, tags):
+        self._ec2_client.create_tags(Resources=[image_id],
+                                     Tags=[{'Key': k, 'Value': v} for k, v in tags.items()])
+
+    def ec2_image_wait_available(self, image_id, image_name):
+        """wait until the (copied or registered) image is available"""
+        def _available():
+            images = self._ec2_client.describe_images(ImageIds=[image_id])['Images']
+            state = images[0]['State'] if images else None
+            if state in ('invalid', 'deregistered', 'failed', 'error'):
+                raise Exception('EC2 image {} ({}) failed: {}'.format(
+                    image_id, image_name, state))
+            return image_id if state == 'available' else None
+
+        wait.wait_for('EC2 image {} in {}'.format(image_id, self._region_name),
+                      _available, timeout=IMAGE_COPY_TIMEOUT, delay=5, max_delay=30)
+        lookup.default().set(self._lookup_key('image', image_name), image_id)
+        return image_id
+
+    def ec2_image_copy(self, image_name, source_region, tags=None):
+        """copy the image (by name) from source_region into this region
+
+        tags (dict) are set on the copy right away (so others can see what
+        is copied). Waits until the copy is available. Returns the image id."""
+        source = AWSClient(self._access_key, self._secret_key, source_region)
+        source_id = source.ec2_image_lookup(image_name)
+        print('EC2 copying image {} ({}) from {} to {} ...'.format(
+            image_name, source_id, source_region, self._region_name))
+        image_id = self._ec2_client.copy_image(Name=image_name, Description=image_name,
+                                               SourceImageId=source_id,
+                                               SourceRegion=source_region)['ImageId']
+        if tags:
+            self.ec2_image_tag(image_id, tags)
+        return self.ec2_image_wait_available(image_id, image_name)
+
+    def ec2_instances_run(self, image_id, instance_type, key_name, instance_names,
+                          tags=None, spot=False, spot_max_price=None):
+        """launch the instances with a single run_instances call
+
+        tags (dict) are set on all instances at launch. With spot, one-time
+        spot instances (up to spot_max_price, default the on-demand price)
+        are launched. Returns the instance ids. If EC2 can not launch all of
+        them, the list is shorter than instance_names."""
+        from botocore.exceptions import ClientError
+        kwargs = {}
+        if spot:
+            spot_options = {'SpotInstanceType': 'one-time',
+                            'InstanceInterruptionBehavior': 'terminate'}
+            if spot_max_price:
+                spot_options['MaxPrice'] = str(spot_max_price)
+            kwargs['InstanceMarketOptions'] = {'MarketType': 'spot',
+                                               'SpotOptions': spot_options}
+        if tags:
+            kwargs['TagSpecifications'] = [{
+                'ResourceType': 'instance',
+                'Tags': [{'Key': key, 'Value': value} for key, value in tags.items()]}]
+        try:
+            resp = self._ec2_client.run_instances(ImageId=image_id, InstanceType=instance_type,
+                                                  KeyName=key_name, MinCount=1,
+                                                  MaxCount=len(instance_names), **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'].startswith('InvalidAMIID'):
+                # the cached image id is outdated (eg. the image was deregistered)
+                lookup.default().invalidate(self._lookup_key('image'))
+            if e.response['Error']['Code'] in CAPACITY_ERRORS:
+                raise CapacityError('EC2 {} {}: {}'.format(
+                    self._region_name, instance_type, e.response['Error']['Message']))
+            raise
+        instance_ids = [i['InstanceId'] for i in resp['Instances']]
+        if len(instance_ids) < len(instance_names):
+            print('EC2 only launched {} of {} instances'.format(
+                len(instance_ids), len(instance_names)))
+        for instance_id, instance_name in zip(instance_ids, instance_names):
+            print('New EC2 instance is "{}" ({}). Waiting...'.format(instance_id,
+                                                                 instance_name))
+        return instance_ids
+
+    def ec2_instances_wait_running(self, instance_ids):
+        """wait until all instances are running. Returns the public ip for each instance id
+
+        An instance that ends up in a terminal state (e.g. no spot capacity)
+        gets the exception instead of its ip, the others are still waited
+        for. Only the instances that are not running yet are queried again."""
+        from botocore.exceptions import ClientError
+        ips = {}
+        pending = list(instance_ids)
+        if not pending:
+            return ips
+
+        def _check():
+            resp = self._ec2_client.describe_instances(InstanceIds=pending)
+            for reservation in resp['Reservations']:
+                for instance in reservation['Instances']:
+                    state = instance['State']['Name']
+                    if state in INSTANCE_STATES_TERMINAL:
+                        ips[instance['InstanceId']] = Exception('EC2 instance "{}" is {}'.format(
+                            instance['InstanceId'], state))
+                        pending.remove(instance['InstanceId'])
+                    elif state == 'running':
+                        ips[instance['InstanceId']] = instance.get('PublicIpAddress')
+                        pending.remove(instance['InstanceId'])
+            return ips if not pending else None
+
+        def _check_visible():
+            # a just launched instance might not be visible for the API yet
+            try:
+                return _check()
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                    raise
+                return None
+
+        wait.wait_for('EC2 instances {} running'.format(', '.join(instance_ids)),
+                      _check_visible, timeout=INSTANCE_RUNNING_TIMEOUT, delay=2)
+        for instance_id in instance_ids:
+            if isinstance(ips[instance_id], Exception):
+                print(ips[instance_id])
+            else:
+                print('EC2 instance "{}" running. {}'.format(instance_id, ips[instance_id]))
+        return ips
+
+    def ec2_instances_tag(self, instance_ids, tags):
+        """tag each instance with its tags (dict)"""
+        from botocore.exceptions import ClientError
+        for instance_id, instance_tags in zip(instance_ids, tags):
+            tags_all = []
+            for key, value in instance_tags.items():
+                tags_all.append({'Key': key, 'Value': value})
+            if not tags_all:
+                continue
+            # a just launched instance might not be visible for the API yet
+            for retry in range(5):
+                try:
+                    self._ec2_client.create_tags(Resources=[instance_id], Tags=tags_all)
+                    break
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound' or \
+                       retry == 4:
+                        raise
+                    time.sleep(1)
+
+    def ec2_instances_create(self, instance_names, instance_type, image_name, key_name,
+                             tags=None):
+        """create all instances with a single run_instances call
+
+        tags is a list with the tags (dict) for each instance. Returns a list
+        of (instance id, public ip) in the order of instance_names. If EC2
+        can not launch all of them, the list is shorter. An instance that did
+        not start has the exception instead of its ip (see
+        ec2_instances_wait_running())."""
+        tags = tags or [{} for _ in instance_names]
+        image_id = self.ec2_image_lookup(image_name)
+        instance_ids = self.ec2_instances_run(image_id, instance_type, key_name,
+                                              instance_names)
+        self.ec2_instances_tag(instance_ids, tags)
+        ips = self.ec2_instances_wait_running(instance_ids)
+        return [(instance_id, ips[instance_id]) for instance_id in instance_ids]
 
     def ec2_instance_create(self, instance_name, instance_type, image_name, key_name, tags={}):
-        image_id = self._ec2_image_id(image_name)
-        resp = self._ec2_client.run_instances(ImageId=image_id, InstanceType=instance_type,
-                                              KeyName=key_name, MinCount=1, MaxCount=1)
-        instance_id = resp['Instances'][0]['InstanceId']
-        print('New EC2 instance is "{}" ({}). Waiting...'.format(instance_id,
-                                                             instance_name))
-        instance = self._ec2.Instance(instance_id)
-        instance.wait_until_running()
-        instance = self._ec2.Instance(instance_id)
-        print('EC2 instance "{}" running. {}'.format(
-            instance_id, instance.public_ip_address))
-
-        # tags for the resources
-        tags_all = []
-        for key, value in tags.items():
-            tags_all.append({'Key': key, 'Value': value})
-        self._ec2_client.create_tags(Resources=[instance_id], Tags=tags_all)
-
-        return instance.public_ip_address
+        instances = self.ec2_instances_create([instance_name], instance_type, image_name,
+                                              key_name, [tags])
+        if isinstance(instances[0][1], Exception):
+            raise instances[0][1]
+        return instances[0][1]
+
+    def ec2_pool_instances(self, pool_key=None):
+        """get the pending/running instances of a warm pool (or of all pools)
+
+        Returns a list of dicts (id, ip, state, pool, since), oldest first."""
+        filters = [{'Name': 'instance-state-name', 'Values': ['pending', 'running']}]
+        if pool_key:
+            filters.append({'Name': 'tag:jcs-pool', 'Values': [pool_key]})
+        else:
+            filters.append({'Name': 'tag-key', 'Values': ['jcs-pool']})
+        instances = []
+        paginator = self._ec2_client.get_paginator('describe_instances')
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    tags = {t['Key']: t['Value'] for t in instance.get('Tags', [])}
+                    instances.append({
+                        'id': instance['InstanceId'],
+                        'ip': instance.get('PublicIpAddress'),
+                        'state': instance['State']['Name'],
+                        'pool': tags.get('jcs-pool'),
+                        'since': float(tags.get('jcs-pool-since', 0)),
+                    })
+        return sorted(instances, key=lambda i: i['since'])
+
+    def ec2_pool_fill(self, pool_key, size, image_name, instance_type, key_name):
+        """launch instances until the warm pool has size instances"""
+        missing = size - len(self.ec2_pool_instances(pool_key))
+        if missing <= 0:
+            print('EC2 pool {} is full'.format(pool_key))
+            return []
+        image_id = self.ec2_image_lookup(image_name)
+        instance_ids = self.ec2_instances_run(
+            image_id, instance_type, key_name, ['pool'] * missing,
+            tags={'jcs-pool': pool_key, 'jcs-pool-since': str(time.time())})
+        print('EC2 pool {} filled with {} instances'.format(pool_key, len(instance_ids)))
+        return instance_ids
+
+    def ec2_pool_claim(self, pool_key, count):
+        """take up to count running instances out of the warm pool
+
+        The caller must make sure that no one else claims at the same time.
+        Returns a list of dicts (id, name, ip)."""
+        instances = [i for i in self.ec2_pool_instances(pool_key)
+                     if i['state'] == 'running'][:count]
+        if not instances:
+            return []
+        self._ec2_client.delete_tags(Resources=[i['id'] for i in instances],
+                                     Tags=[{'Key': 'jcs-pool'}, {'Key': 'jcs-pool-since'}])
+        for instance in instances:
+            print('EC2 instance "{}" taken from pool {}. {}'.format(
+                instance['id'], pool_key, instance['ip']))
+        return [{'id': i['id'], 'name': i['id'], 'ip': i['ip']} for i in instances]
 
     def ec2_instance_delete(self, instance_id):
         resp = self._ec2_client.terminate_instances(InstanceIds=[instance_id])
         print('EC2 instance "{}" deleted'.format(instance_id))
 
+    def ec2_jcs_instances(self, tags=None):
+        """get the not terminated instances created by jcs (or with the tags)
+
+        Uses paginated describe_instances calls. Returns a list of dicts (id,
+        ip, state, jenkins_name, jenkins_url, launched)."""
+        filters = [{'Name': 'instance-state-name',
+                    'Values': ['pending', 'running', 'stopping', 'stopped']}]
+        if tags:
+            for key, value in tags.items():
+                filters.append({'Name': 'tag:{}'.format(key), 'Values': [value]})
+        else:
+            filters.append({'Name': 'tag-key', 'Values': ['jcs-jenkins-name']})
+        instances = []
+        paginator = self._ec2_client.get_paginator('describe_instances')
+        for page in paginator.paginate(Filters=filters, PaginationConfig={'PageSize': 1000}):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instance_tags = {t['Key']: t['Value'] for t in instance.get('Tags', [])}
+                    instances.append({
+                        'id': instance['InstanceId'],
+                        'ip': instance.get('PublicIpAddress'),
+                        'state': instance['State']['Name'],
+                        'jenkins_name': instance_tags.get('jcs-jenkins-name'),
+                        'jenkins_url': instance_tags.get('jcs-jenkins-url'),
+                        'launched': instance['LaunchTime'].timestamp(),
+                    })
+        return instances
+
+    def ec2_instances_alive(self, instance_ids):
+        """get the ids of the instances which still exist (not terminated)
+
+        Ids of unknown instances are filtered out (no InvalidInstanceID.NotFound)."""
+        instance_ids = list(instance_ids)
+        alive = set()
+        paginator = self._ec2_client.get_paginator('describe_instances')
+        for i in range(0, len(instance_ids), 200):
+            filters = [{'Name': 'instance-id', 'Values': instance_ids[i:i + 200]},
+                       {'Name': 'instance-state-name',
+                        'Values': ['pending', 'running', 'stopping', 'stopped']}]
+            for page in paginator.paginate(Filters=filters):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        alive.add(instance['InstanceId'])
+        return alive
+
+    def ec2_spot_interruptions(self):
+        """get the jcs spot instances which are (about to be) interrupted
+
+        Returns a list of dicts (id, jenkins_name, jenkins_url, code)."""
+        filters = [{'Name': 'instance-state-name', 'Values': ['pending', 'running']},
+                   {'Name': 'tag-key', 'Values': ['jcs-jenkins-name']}]
+        spot_requests = {}
+        paginator = self._ec2_client.get_paginator('describe_instances')
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    if instance.get('InstanceLifecycle') != 'spot' or \
+                       'SpotInstanceRequestId' not in instance:
+                        continue
+                    tags = {t['Key']: t['Value'] for t in instance.get('Tags', [])}
+                    spot_requests[instance['SpotInstanceRequestId']] = {
+                        'id': instance['InstanceId'],
+                        'jenkins_name': tags.get('jcs-jenkins-name'),
+                        'jenkins_url': tags.get('jcs-jenkins-url'),
+                    }
+        interrupted = []
+        request_ids = list(spot_requests)
+        # the interruption notice is the status of the spot request
+        for i in range(0, len(request_ids), 100):
+            resp = self._ec2_client.describe_spot_instance_requests(
+                SpotInstanceRequestIds=request_ids[i:i + 100])
+            for request in resp['SpotInstanceRequests']:
+                code = request.get('Status', {}).get('Code')
+                if code in SPOT_INTERRUPTION_CODES:
+                    interrupted.append(dict(spot_requests[request['SpotInstanceRequestId']],
+                                            code=code))
+        return interrupted
+
+    def ec2_instance_untag(self, instance_id, keys):
+        self._ec2_client.delete_tags(Resources=[instance_id],
+                                     Tags=[{'Key': key} for key in keys])
+
+    def ec2_instances_delete(self, instance_ids):
+        """terminate the instances with batched terminate_instances calls
+
+        A single unknown id fails the whole batch, so the batch is then
+        terminated instance by instance. Unknown instances count as deleted."""
+        from botocore.exceptions import ClientError
+        instance_ids = list(instance_ids)
+        for i in range(0, len(instance_ids), TERMINATE_BATCH_SIZE):
+            batch = instance_ids[i:i + TERMINATE_BATCH_SIZE]
+            try:
+                self._ec2_client.terminate_instances(InstanceIds=batch)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                    raise
+                for instance_id in batch:
+                    try:
+                        self._ec2_client.terminate_instances(InstanceIds=[instance_id])
+                    except ClientError as e:
+                        if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                            raise
+                        print('EC2 instance "{}" not found. Already deleted'.format(
+                            instance_id))
+                        continue
+                    print('EC2 instance "{}" deleted'.format(instance_id))
+                continue
+            for instance_id in batch:
+                print('EC2 instance "{}" deleted'.format(instance_id))
+
     def ec2_instance_delete_by_tags(self, tags):
         # add same default tag as we add in ec2_instance_create()
-        filters_all = []
-        for key, value in tags.items():
-            filters_all.append({'Name': 'tag:{}'.format(key), 'Values': [value]})
-        print('EC2 search for deletable instances with filters: {}'.format(filters_all))
-        for instance in self._ec2.instances.filter(Filters=filters_all):
-            instance.terminate()
-            print('EC2 instance "{}" deleted'.format(instance.id))
+        print('EC2 search for deletable instances with tags: {}'.format(tags))
+        self.ec2_instances_delete([i['id'] for i in self.ec2_jcs_instances(tags)])
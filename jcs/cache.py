@@ -0,0 +1,253 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import time
+from typing import Iterator, List, Optional, Union
+
+from . import image
+
+
+CACHE_DIR='{}/.cache/jcs'.format(os.path.expanduser('~'))
+INDEX_FILE='index.json'
+INDEX_VERSION=1
+# default byte quota for the cached images (can be set as env var "JCS_CACHE_QUOTA")
+QUOTA='50G'
+
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def size_parse(size: str) -> int:
+    """parse a size like "500M" or "50G" into bytes"""
+    size = size.strip().upper().rstrip('B').rstrip('I')
+    unit = size[-1:] if size[-1:] in _SIZE_UNITS else ''
+    return int(float(size[:len(size) - len(unit)]) * _SIZE_UNITS[unit])
+
+
+def size_format(size: int) -> str:
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit) if unit else '{}'.format(size)
+        size /= 1024
+    return '{:.1f}T'.format(size)
+
+
+class ImageCache:
+    """A content addressed store for downloaded images
+
+    Images are stored once per content as blobs/<sha256>. A hardlink with
+    the original file name is kept in names/<sha256 prefix>/ (the file name
+    is used eg. as the EC2 image name). index.json maps every URL to the
+    digest of its content (plus the HTTP validators) and keeps the size and
+    last access time of every blob. When the blobs exceed the byte quota, the
+    least recently used blobs are evicted. Files derived from a blob (eg. the
+    decompressed raw image) live next to the name links and are evicted
+    together with their blob.
+
+    All index changes are done while holding an exclusive lock on the index,
+    so multiple jcs processes on the same host can share the cache."""
+    def __init__(self, cache_dir: Optional[str] = None, quota: Union[int, str, None] = None):
+        self._cache_dir = cache_dir or CACHE_DIR
+        # bytes or a size like "50G"
+        if quota is None:
+            quota = os.getenv('JCS_CACHE_QUOTA', QUOTA)
+        self._quota = size_parse(quota) if isinstance(quota, str) else quota
+        for d in (self.blobs_dir, self.names_dir, self.tmp_dir):
+            os.makedirs(d, exist_ok=True)
+
+    @property
+    def cache_dir(self) -> str:
+        return self._cache_dir
+
+    @property
+    def blobs_dir(self) -> str:
+        return os.path.join(self._cache_dir, 'blobs')
+
+    @property
+    def names_dir(self) -> str:
+        return os.path.join(self._cache_dir, 'names')
+
+    @property
+    def tmp_dir(self) -> str:
+        return os.path.join(self._cache_dir, 'tmp')
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self._cache_dir, INDEX_FILE)
+
+    @property
+    def quota(self) -> int:
+        return self._quota
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.blobs_dir, sha256)
+
+    def name_path(self, sha256: str, name: str) -> str:
+        return os.path.join(self.names_dir, sha256[:16], name)
+
+    def tmp_path(self, url: str) -> str:
+        """the download location for url. Stable, so downloads can be resumed"""
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.tmp_dir, '{}-{}'.format(key, os.path.basename(url)))
+
+    @contextlib.contextmanager
+    def _lock(self, path: str, exclusive: bool = True) -> Iterator[None]:
+        with open(path, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _index_load(self) -> dict:
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        if index.get('version') != INDEX_VERSION:
+            index = {'version': INDEX_VERSION, 'urls': {}, 'blobs': {}}
+        return index
+
+    def _index_save(self, index: dict) -> None:
+        tmp = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.index_path)
+
+    @contextlib.contextmanager
+    def _index(self, write: bool = True) -> Iterator[dict]:
+        """the locked index. Changes are saved when write is True"""
+        with self._lock('{}.lock'.format(self.index_path), exclusive=write):
+            index = self._index_load()
+            yield index
+            if write:
+                self._index_save(index)
+
+    @contextlib.contextmanager
+    def download_lock(self, url: str) -> Iterator[None]:
+        """serialize downloads of the same url across processes"""
+        with self._lock('{}.lock'.format(self.tmp_path(url))):
+            yield
+
+    @staticmethod
+    def _blob_size(blob: dict) -> int:
+        return blob['size'] + sum(blob.get('derived', {}).values())
+
+    def _blob_remove(self, index: dict, sha256: str) -> int:
+        blob = index['blobs'].pop(sha256)
+        for name in blob['names'] + list(blob.get('derived', {})):
+            # with the sidecar (sha256 and extent map) of the image
+            for path in (self.name_path(sha256, name),
+                         self.name_path(sha256, name) + image.SIDECAR_SUFFIX):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+        with contextlib.suppress(OSError):
+            os.rmdir(os.path.dirname(self.name_path(sha256, 'x')))
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.blob_path(sha256))
+        for url in [u for u, e in index['urls'].items() if e['sha256'] == sha256]:
+            del index['urls'][url]
+        return self._blob_size(blob)
+
+    def _evict(self, index: dict, quota: int, keep: Optional[str] = None) -> List[str]:
+        """remove the least recently used blobs until quota is met"""
+        evicted = []
+        total = sum(self._blob_size(b) for b in index['blobs'].values())
+        lru = sorted(index['blobs'].items(), key=lambda item: item[1]['atime'])
+        for sha256, blob in lru:
+            if total <= quota:
+                break
+            if sha256 == keep:
+                continue
+            total -= self._blob_remove(index, sha256)
+            evicted.append(sha256)
+        return evicted
+
+    def lookup(self, url: str) -> Optional[dict]:
+        """get the index entry (with the local path) for url"""
+        with self._index(write=False) as index:
+            entry = index['urls'].get(url)
+            if not entry or entry['sha256'] not in index['blobs']:
+                return None
+            entry = dict(entry)
+            entry['path'] = self.name_path(entry['sha256'], os.path.basename(url))
+        if not os.path.exists(entry['path']):
+            return None
+        return entry
+
+    def touch(self, url: str, validators: Optional[dict] = None) -> None:
+        """mark the content of url as used (and update the HTTP validators)"""
+        with self._index() as index:
+            entry = index['urls'].get(url)
+            if not entry:
+                return
+            if validators:
+                entry.update(validators)
+            index['blobs'][entry['sha256']]['atime'] = time.time()
+
+    def add(self, url: str, path: str, sha256: str, validators: dict) -> str:
+        """move the downloaded file at path into the store"""
+        name = os.path.basename(url)
+        with self._index() as index:
+            blob = index['blobs'].get(sha256)
+            if blob and os.path.exists(self.blob_path(sha256)):
+                os.remove(path)
+            else:
+                os.replace(path, self.blob_path(sha256))
+                blob = {'size': os.path.getsize(self.blob_path(sha256)), 'names': []}
+                index['blobs'][sha256] = blob
+            if name not in blob['names']:
+                os.makedirs(os.path.dirname(self.name_path(sha256, name)), exist_ok=True)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.name_path(sha256, name))
+                os.link(self.blob_path(sha256), self.name_path(sha256, name))
+                blob['names'].append(name)
+            blob['atime'] = time.time()
+            entry = {'sha256': sha256}
+            entry.update(validators)
+            index['urls'][url] = entry
+            for evicted in self._evict(index, self._quota, keep=sha256):
+                print('Cache evicted image {}'.format(evicted))
+        return self.name_path(sha256, name)
+
+    def add_derived(self, sha256: str, name: str) -> None:
+        """account the file name_path(sha256, name) to the blob sha256"""
+        st = os.stat(self.name_path(sha256, name))
+        with self._index() as index:
+            blob = index['blobs'].get(sha256)
+            if not blob:
+                return
+            # derived files are usually sparse. only count the allocated bytes
+            blob.setdefault('derived', {})[name] = st.st_blocks * 512
+            blob['atime'] = time.time()
+
+    def ls(self) -> List[dict]:
+        """all cached blobs, most recently used first"""
+        with self._index(write=False) as index:
+            blobs = []
+            for sha256, blob in index['blobs'].items():
+                blobs.append({
+                    'sha256': sha256,
+                    'size': self._blob_size(blob),
+                    'atime': blob['atime'],
+                    'names': list(blob['names']),
+                    'urls': sorted(u for u, e in index['urls'].items()
+                                   if e['sha256'] == sha256),
+                })
+        return sorted(blobs, key=lambda b: b['atime'], reverse=True)
+
+    def prune(self, quota: Optional[int] = None) -> List[str]:
+        """evict least recently used blobs until the quota is met"""
+        with self._index() as index:
+            return self._evict(index, self._quota if quota is None else quota)
+
+    def stats(self) -> dict:
+        with self._index(write=False) as index:
+            return {
+                'blobs': len(index['blobs']),
+                'urls': len(index['urls']),
+                'size': sum(self._blob_size(b) for b in index['blobs'].values()),
+                'quota': self._quota,
+            }
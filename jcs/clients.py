@@ -0,0 +1,46 @@
+import threading
+
+
+# the pooled clients (None if pooling is disabled)
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def enable_pooling():
+    """reuse the clients (and their authenticated sessions) across commands
+
+    Used by the daemon. By default every call creates a new client."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = {}
+
+
+def _get(key, factory):
+    if _pool is None:
+        return factory()
+    with _pool_lock:
+        if key not in _pool:
+            _pool[key] = factory()
+        return _pool[key]
+
+
+def jenkins(args):
+    from . import jen
+    return _get(('jenkins', args.jenkins_url, args.jenkins_username, args.jenkins_password),
+                lambda: jen.JenkinsClient(args.jenkins_url, args.jenkins_username,
+                                          args.jenkins_password))
+
+
+def aws(args, region_name=None):
+    from . import aws
+    region_name = region_name or args.aws_region_name
+    return _get(('aws', args.aws_access_key_id, args.aws_secret_access_key, region_name),
+                lambda: aws.AWSClient(args.aws_access_key_id, args.aws_secret_access_key,
+                                      region_name))
+
+
+def openstack(args, os_cloud=None):
+    from . import openst
+    os_cloud = os_cloud or args.os_cloud
+    return _get(('openstack', os_cloud), lambda: openst.OpenstClient(os_cloud))
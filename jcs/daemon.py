@@ -0,0 +1,143 @@
+import argparse
+import contextvars
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+
+# commands which are executed by the daemon when the CLI is given a socket
+COMMANDS = ('_do_create', '_do_delete', '_do_gc', '_do_ls',
+            '_do_jenkins_node_add', '_do_jenkins_node_delete',
+            '_do_aws_ec2_instance_create', '_do_aws_ec2_instance_delete',
+            '_do_os_instance_create', '_do_os_instance_delete',
+            '_do_pool_fill', '_do_pool_ls', '_do_pool_reap', '_do_image_sync')
+
+# where the output of the current request goes to
+_output = contextvars.ContextVar('output', default=None)
+
+
+def socket_path_default():
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'jcs')
+    return os.path.join(runtime_dir, 'jcs.sock')
+
+
+class _Stdout:
+    """sys.stdout replacement sending the output to the client of a request"""
+    def __init__(self, stdout):
+        self._stdout = stdout
+
+    def write(self, text):
+        output = _output.get()
+        # the output of threads that outlive their request stays in the daemon
+        if not output or not output(text):
+            self._stdout.write(text)
+        return len(text)
+
+    def flush(self):
+        self._stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stdout, name)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _send(self, msg, last=False):
+        """send msg to the client. Returns False if the client is gone"""
+        with self._lock:
+            if self._done:
+                return False
+            self._done = last
+            try:
+                self.wfile.write(json.dumps(msg).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except OSError:
+                self._done = True
+                return False
+            return True
+
+    def handle(self):
+        import jcs
+
+        self._lock = threading.Lock()
+        self._done = False
+        request = json.loads(self.rfile.readline())
+        command = request['command']
+        if command not in COMMANDS:
+            self._send({'exit': 1, 'error': 'Command {} not supported'.format(command)}, True)
+            return
+        args = argparse.Namespace(**request['args'])
+        args.func = getattr(jcs, command)
+        print('Daemon running {} for pid {}'.format(command, request.get('pid')))
+        _output.set(lambda text: self._send({'output': text}))
+        try:
+            jcs._run(args)
+        except SystemExit as e:
+            # some commands exit with sys.exit()
+            if e.code is None or isinstance(e.code, int):
+                self._send({'exit': e.code or 0}, True)
+            else:
+                self._send({'exit': 1, 'error': str(e.code)}, True)
+        except BaseException as e:
+            # a failed request must never take the daemon down
+            traceback.print_exc(file=sys.__stderr__)
+            self._send({'exit': 1, 'error': str(e) or type(e).__name__}, True)
+        else:
+            self._send({'exit': 0}, True)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path):
+    """serve the commands on a unix socket. Clients are pooled across requests"""
+    from . import clients
+    clients.enable_pooling()
+    sys.stdout = _Stdout(sys.stdout)
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    # the requests contain credentials. only the user may connect
+    old_umask = os.umask(0o077)
+    try:
+        server = _Server(socket_path, _Handler)
+    finally:
+        os.umask(old_umask)
+    print('Daemon listening on {}'.format(socket_path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def call(socket_path, args):
+    """run the command of args in the daemon. Returns the exit code
+
+    Returns None if no daemon listens on socket_path (the caller runs the
+    command itself then)."""
+    data = {k: v for k, v in vars(args).items() if k != 'func'}
+    request = {'command': args.func.__name__, 'args': data, 'pid': os.getpid()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            print('No jcs daemon at {} ({}). Running the command without it'.format(
+                socket_path, e.strerror), file=sys.stderr)
+            return None
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            for line in f:
+                msg = json.loads(line)
+                if 'output' in msg:
+                    sys.stdout.write(msg['output'])
+                    continue
+                if msg.get('error'):
+                    print('Error: {}'.format(msg['error']), file=sys.stderr)
+                return msg['exit']
+    raise Exception('Daemon at {} closed the connection'.format(socket_path))
@@ -0,0 +1,247 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait as futures_wait
+from typing import Set
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .executor import ThreadPoolExecutor
+
+
+# size of a single Range request
+SEGMENT_SIZE = 64 * 1024 * 1024
+# size of the buffers read from the network and written to disk
+BUFFER_SIZE = 1024 * 1024
+# number of parallel Range requests
+WORKERS = 8
+# number of attempts per segment before the download fails
+SEGMENT_RETRIES = 3
+
+
+class RangeDownloader:
+    """Download a URL into a local file with parallel HTTP Range requests
+
+    The data goes into a preallocated `<path>.part` file. Every finished
+    segment is recorded in `<path>.part.journal`, so an interrupted download
+    continues with the missing segments only, as long as the ETag and the
+    Last-Modified header of the url did not change (the Range requests are
+    sent with If-Range, so a file changed in between is not mixed into the
+    download). Servers without Range support are downloaded with a single
+    stream.
+
+    The sha256 of the file is computed while downloading. Segments are hashed
+    in order as soon as they are complete, reading them back while they are
+    still in the page cache."""
+    def __init__(self, url: str, path: str, workers: int = WORKERS,
+                 segment_size: int = SEGMENT_SIZE):
+        self._url = url
+        self._path = path
+        self._workers = max(1, workers)
+        self._segment_size = segment_size
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._journal_lock = threading.Lock()
+        self._sha256 = hashlib.sha256()
+        self._headers = {}
+        # set when a segment failed. stops the running segments
+        self._abort = threading.Event()
+
+    @property
+    def sha256(self) -> str:
+        """the sha256 hexdigest of the downloaded file"""
+        return self._sha256.hexdigest()
+
+    @property
+    def headers(self) -> dict:
+        """the response headers of the url (available after download())"""
+        return self._headers
+
+    @property
+    def part_path(self) -> str:
+        return '{}.part'.format(self._path)
+
+    @property
+    def journal_path(self) -> str:
+        return '{}.part.journal'.format(self._path)
+
+    def _probe(self):
+        """get the final url (after redirects), the size and the range support"""
+        r = self._session.head(self._url, allow_redirects=True)
+        if r.status_code in (405, 501):
+            # HEAD not allowed. the body of the GET is not read
+            r = self._session.get(self._url, stream=True)
+            r.close()
+        if r.status_code != 200:
+            raise Exception('Can not get {} ({})'.format(self._url, r.status_code))
+        size = r.headers.get('Content-Length')
+        size = int(size) if size is not None else None
+        ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        self._headers = dict(r.headers)
+        return r.url, size, ranges
+
+    @property
+    def _validators(self) -> dict:
+        """the ETag and Last-Modified header of the url (from _probe())"""
+        return {'etag': self._headers.get('ETag'),
+                'last_modified': self._headers.get('Last-Modified')}
+
+    @property
+    def _if_range(self) -> dict:
+        """the If-Range header for the segment requests (only strong ETags are allowed)"""
+        validators = self._validators
+        if validators['etag'] and not validators['etag'].startswith('W/'):
+            return {'If-Range': validators['etag']}
+        if validators['last_modified']:
+            return {'If-Range': validators['last_modified']}
+        return {}
+
+    def _journal_load(self, size: int) -> Set[int]:
+        """get the already finished segments of a previous download"""
+        if not os.path.exists(self.part_path) or \
+           os.path.getsize(self.part_path) != size:
+            return set()
+        try:
+            with open(self.journal_path, 'r') as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if journal.get('url') != self._url or journal.get('size') != size or \
+           journal.get('segment_size') != self._segment_size or \
+           journal.get('validators') != self._validators:
+            return set()
+        return set(journal.get('done', []))
+
+    def _journal_save(self, size: int, done: Set[int]) -> None:
+        tmp = '{}.tmp'.format(self.journal_path)
+        with open(tmp, 'w') as f:
+            json.dump({'url': self._url, 'size': size,
+                       'segment_size': self._segment_size,
+                       'validators': self._validators,
+                       'done': sorted(done)}, f)
+        os.replace(tmp, self.journal_path)
+
+    def _preallocate(self, size: int) -> None:
+        with open(self.part_path, 'ab') as f:
+            if os.path.getsize(self.part_path) == size:
+                return
+            f.truncate(size)
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except OSError:
+                    # not supported by all filesystems. the truncate is enough
+                    pass
+
+    def _segment_fetch(self, url: str, fd: int, start: int, end: int) -> None:
+        headers = {'Range': 'bytes={}-{}'.format(start, end)}
+        headers.update(self._if_range)
+        with self._session.get(url, headers=headers, stream=True) as r:
+            if r.status_code == 200 and 'If-Range' in headers:
+                raise Exception('{} changed during the download'.format(url))
+            if r.status_code != 206 or not r.headers.get(
+                    'Content-Range', '').startswith('bytes {}-{}/'.format(start, end)):
+                raise Exception('Range request {}-{} for {} failed ({})'.format(
+                    start, end, url, r.status_code))
+            offset = start
+            for chunk in r.iter_content(BUFFER_SIZE):
+                if self._abort.is_set():
+                    raise Exception('Range request {}-{} for {} aborted'.format(start, end, url))
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+        if offset != end + 1:
+            raise Exception('Range request {}-{} for {} incomplete ({} bytes)'.format(
+                start, end, url, offset - start))
+
+    def _segment_download(self, url: str, fd: int, size: int, index: int,
+                          done: Set[int]) -> None:
+        start = index * self._segment_size
+        end = min(start + self._segment_size, size) - 1
+        for attempt in range(SEGMENT_RETRIES):
+            if self._abort.is_set():
+                raise Exception('Range request {}-{} for {} aborted'.format(start, end, url))
+            try:
+                self._segment_fetch(url, fd, start, end)
+                break
+            except Exception:
+                if attempt == SEGMENT_RETRIES - 1:
+                    self._abort.set()
+                    raise
+        # the journal must never mark a segment done before its data is on disk
+        os.fdatasync(fd)
+        with self._journal_lock:
+            done.add(index)
+            self._journal_save(size, done)
+
+    def _segment_hash(self, fd: int, size: int, index: int) -> None:
+        offset = index * self._segment_size
+        end = min(offset + self._segment_size, size)
+        while offset < end:
+            block = os.pread(fd, min(BUFFER_SIZE, end - offset), offset)
+            if not block:
+                raise Exception('Short read in {} at {}'.format(self.part_path, offset))
+            self._sha256.update(block)
+            offset += len(block)
+
+    def _hash_in_order(self, fd: int, size: int, segments: int, futures: dict) -> None:
+        """hash the segments in order while they finish. raises the first failure of any segment"""
+        pending = set(futures.values())
+        for i in range(segments):
+            if i in futures:
+                while not futures[i].done():
+                    finished, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        future.result()
+                futures[i].result()
+            self._segment_hash(fd, size, i)
+
+    def _download_ranges(self, url: str, size: int) -> None:
+        segments = (size + self._segment_size - 1) // self._segment_size
+        done = self._journal_load(size)
+        if done:
+            print('Resuming download to file {} ({}/{} segments done)'.format(
+                self._path, len(done), segments))
+        self._preallocate(size)
+        self._journal_save(size, done)
+        todo = [i for i in range(segments) if i not in done]
+        fd = os.open(self.part_path, os.O_RDWR)
+        try:
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                futures = {i: executor.submit(self._segment_download, url, fd, size, i, done)
+                           for i in todo}
+                try:
+                    self._hash_in_order(fd, size, segments, futures)
+                except BaseException:
+                    # do not wait for the other segments. the journal keeps the finished ones
+                    self._abort.set()
+                    for future in futures.values():
+                        future.cancel()
+                    raise
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _download_stream(self, url: str) -> None:
+        with self._session.get(url, stream=True) as r:
+            if r.status_code != 200:
+                raise Exception('Can not get {} ({})'.format(url, r.status_code))
+            with open(self.part_path, 'wb', buffering=BUFFER_SIZE) as f:
+                for chunk in r.iter_content(BUFFER_SIZE):
+                    f.write(chunk)
+                    self._sha256.update(chunk)
+
+    def download(self) -> str:
+        url, size, ranges = self._probe()
+        if ranges and size:
+            self._download_ranges(url, size)
+        else:
+            self._download_stream(url)
+        os.replace(self.part_path, self._path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        return self._path
@@ -0,0 +1,17 @@
+import contextvars
+import concurrent.futures
+import threading
+
+
+class ThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    """ThreadPoolExecutor whose tasks run in a copy of the context of submit()
+
+    Like the steps of an orchestrate.Graph, the tasks see the output stream
+    of a daemon request and the current trace span of the caller."""
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def thread(target, name=None) -> threading.Thread:
+    """a (not started) thread running target in a copy of the current context"""
+    return threading.Thread(target=contextvars.copy_context().run, args=(target,), name=name)
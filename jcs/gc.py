@@ -0,0 +1,107 @@
+import re
+import time
+from typing import Dict, List, Optional
+
+from . import clients
+from . import inventory
+
+
+# the description workflow.create gives the Jenkins nodes
+NODE_DESCRIPTION = re.compile(r'^Running on AWS \(.*, .*, (ec2|openstack)\)$')
+# seconds an instance may exist without a Jenkins node (it might be still created)
+MIN_AGE = 900
+
+
+def orphans(instances: Dict[str, List[dict]], nodes: List[dict], jenkins_url: str,
+            now: float, min_age: float = MIN_AGE,
+            created: Optional[Dict[str, float]] = None) -> Dict[str, list]:
+    """join the jcs instances of the clouds with the Jenkins nodes
+
+    instances maps the cloud ('ec2', 'openstack') to its instances (dicts
+    with id, jenkins_name, jenkins_url, created). Instances of jenkins_url
+    older than min_age seconds without a Jenkins node and Jenkins nodes
+    created by jcs on one of the clouds without an instance are orphans.
+    Nodes with running builds and nodes created (see created, node name:
+    time) less than min_age seconds ago are never orphans. Returns a dict
+    with the orphaned instances per cloud and 'nodes'."""
+    created = created or {}
+    node_names = {node['name'] for node in nodes}
+    result = {}
+    for cloud, cloud_instances in instances.items():
+        result[cloud] = [i for i in cloud_instances
+                         if i['jenkins_url'] == jenkins_url and
+                         i['jenkins_name'] not in node_names and
+                         now - i['created'] >= min_age]
+    result['nodes'] = []
+    for node in nodes:
+        match = NODE_DESCRIPTION.match(node['description'])
+        if not match or match.group(1) not in instances:
+            continue
+        if not node['idle'] or now - created.get(node['name'], 0) < min_age:
+            continue
+        if node['name'] not in {i['jenkins_name'] for i in instances[match.group(1)]}:
+            result['nodes'].append(node)
+    return result
+
+
+def regions(args, cloud: str) -> List[str]:
+    """the EC2 regions (or OpenStack clouds) the agents of args.jenkins_url can be in
+
+    These are the default one, the --region ones (EC2) and the ones of the
+    agents in the inventory."""
+    found = [args.aws_region_name if cloud == 'ec2' else args.os_cloud]
+    if cloud == 'ec2':
+        found += getattr(args, 'region', None) or []
+    found += [agent['region'] for agent in inventory.default().ls(args.jenkins_url, cloud)]
+    return [region for region in dict.fromkeys(found) if region]
+
+
+def collect(args, clouds):
+    """list the jcs instances of the clouds and the Jenkins nodes (a few paginated calls)
+
+    Every instance gets the region (EC2) or cloud (OpenStack) it is in."""
+    instances = {}
+    if 'ec2' in clouds:
+        instances['ec2'] = [dict(i, created=i['launched'], region=region)
+                            for region in regions(args, 'ec2')
+                            for i in clients.aws(args, region).ec2_jcs_instances()]
+    if 'openstack' in clouds:
+        instances['openstack'] = [dict(i, region=os_cloud)
+                                  for os_cloud in regions(args, 'openstack')
+                                  for i in clients.openstack(args, os_cloud).os_jcs_servers()]
+    return instances, clients.jenkins(args).nodes_usage()
+
+
+def _by_region(instances: List[dict]) -> Dict[str, List[str]]:
+    ids = {}
+    for instance in instances:
+        ids.setdefault(instance['region'], []).append(instance['id'])
+    return ids
+
+
+def run(args, clouds, dry_run=False, min_age=MIN_AGE, workers=8):
+    """delete the orphaned instances and Jenkins nodes. Returns the orphans"""
+    instances, nodes = collect(args, clouds)
+    created = {agent['jenkins_name']: agent['created']
+               for agent in inventory.default().ls(args.jenkins_url)}
+    found = orphans(instances, nodes, args.jenkins_url, time.time(), min_age, created)
+    for cloud in clouds:
+        for instance in found[cloud]:
+            print('GC orphaned {} instance {} in {} (jenkins name "{}")'.format(
+                cloud, instance['id'], instance['region'], instance['jenkins_name']))
+    for node in found['nodes']:
+        print('GC orphaned Jenkins node "{}" ({})'.format(node['name'], node['description']))
+    if dry_run:
+        return found
+
+    for region, ids in _by_region(found.get('ec2', [])).items():
+        clients.aws(args, region).ec2_instances_delete(ids)
+    for os_cloud, ids in _by_region(found.get('openstack', [])).items():
+        clients.openstack(args, os_cloud).os_servers_delete(ids, workers=workers)
+    if found['nodes']:
+        clients.jenkins(args).delete_nodes([n['name'] for n in found['nodes']],
+                                           workers=workers)
+    for jenkins_name in ([i['jenkins_name'] for cloud in clouds for i in found[cloud]] +
+                         [n['name'] for n in found['nodes']]):
+        inventory.default().remove(args.jenkins_url, jenkins_name)
+    return found
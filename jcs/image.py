@@ -0,0 +1,348 @@
+import errno
+import functools
+import hashlib
+import json
+import lzma
+import mmap
+import os
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+
+# size of the chunks read from an image
+CHUNK_SIZE = 4 * 1024 * 1024
+# granularity of the zero block detection (sparse files and extent maps)
+SPARSE_BLOCK_SIZE = 64 * 1024
+# bytes of an image mapped and scanned for zero blocks at once
+SCAN_WINDOW = 64 * 1024 * 1024
+# the sidecar file next to an image with its sha256 and extent map
+SIDECAR_SUFFIX = '.jcs-sha256'
+# fallocate(2) mode to deallocate a range of a file
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_ZERO_BLOCK = bytes(SPARSE_BLOCK_SIZE)
+
+
+def raw_name(path: str) -> str:
+    """the file name of the raw image (without a .xz suffix)"""
+    name = os.path.basename(path)
+    if name.endswith('.xz'):
+        name = name[:-3]
+    return name
+
+
+def image_name(path: str) -> str:
+    """the name of the image in the clouds (file name without .raw.xz)"""
+    name = raw_name(path)
+    if name.endswith('.raw'):
+        name = name[:-4]
+    return name
+
+
+def file_chunks(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    with open(path, 'rb', buffering=0) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+def xz_chunks(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """decompress the .xz file at path as a stream of raw chunks"""
+    with lzma.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+def raw_chunks(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """the raw content of the image at path (decompressed if it is a .xz file)
+
+    A raw image with a known extent map is read without its zero regions."""
+    if path.endswith('.xz'):
+        return xz_chunks(path, chunk_size)
+    extent_map = extents_cached(path)
+    if extent_map:
+        return extent_map.chunks(path, chunk_size)
+    return file_chunks(path, chunk_size)
+
+
+def hash_chunks(chunks: Iterable[bytes], hasher) -> Iterator[bytes]:
+    """pass the chunks through and feed them into hasher (eg. hashlib.sha256())"""
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    """numpy (optional, for vectorized zero block scans) or None"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def nonzero_blocks(buf, block_size: int = SPARSE_BLOCK_SIZE) -> List[bool]:
+    """check which blocks of buf (bytes, memoryview or mmap) contain non-zero bytes
+
+    With numpy, all blocks are checked in one vectorized operation on 64 bit
+    words (without copying buf). Otherwise every block is compared with a
+    zero block."""
+    numpy = _numpy()
+    if numpy is None or block_size % 8:
+        zero = _ZERO_BLOCK if block_size == SPARSE_BLOCK_SIZE else bytes(block_size)
+        return [bytes(buf[i:i + block_size]) != zero[:min(block_size, len(buf) - i)]
+                for i in range(0, len(buf), block_size)]
+    full = len(buf) - len(buf) % block_size
+    words = numpy.frombuffer(buf, dtype=numpy.uint64, count=full // 8)
+    flags = (words.reshape(-1, block_size // 8).max(axis=1) != 0).tolist() if full else []
+    if full < len(buf):
+        flags.append(bool(numpy.frombuffer(buf, dtype=numpy.uint8, offset=full).any()))
+    return flags
+
+
+class ExtentMap:
+    """the data extents of an image, everything else reads as zeros
+
+    The extents are sorted, merged (offset, length) tuples in bytes. The
+    map is small (a few entries per contiguous data region), so it is kept
+    in the sidecar of the image (see analyze())."""
+    def __init__(self, size: int = 0, extents: Iterable[Tuple[int, int]] = ()):
+        self.size = size
+        self.extents: List[Tuple[int, int]] = []
+        for offset, length in extents:
+            self.add(offset, length)
+
+    def add(self, offset: int, length: int) -> None:
+        """add a data extent (after the existing ones)"""
+        if length <= 0:
+            return
+        if self.extents and sum(self.extents[-1]) == offset:
+            self.extents[-1] = (self.extents[-1][0], self.extents[-1][1] + length)
+        else:
+            self.extents.append((offset, length))
+        self.size = max(self.size, offset + length)
+
+    @property
+    def data_bytes(self) -> int:
+        return sum(length for _, length in self.extents)
+
+    def holes(self) -> List[Tuple[int, int]]:
+        """the zero regions (offset, length) between the data extents"""
+        holes = []
+        offset = 0
+        for start, length in self.extents + [(self.size, 0)]:
+            if start > offset:
+                holes.append((offset, start - offset))
+            offset = start + length
+        return holes
+
+    def blocks(self, block_size: int) -> Iterator[int]:
+        """the indexes of the blocks of block_size bytes with data"""
+        last = -1
+        for offset, length in self.extents:
+            for index in range(max(offset // block_size, last + 1),
+                               (offset + length - 1) // block_size + 1):
+                yield index
+                last = index
+
+    def chunks(self, path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """the content of the image at path. Only the data extents are read"""
+        zeros = bytes(chunk_size)
+        offset = 0
+        with open(path, 'rb', buffering=0) as f:
+            for start, length in self.extents + [(self.size, 0)]:
+                while offset < start:
+                    n = min(chunk_size, start - offset)
+                    yield zeros if n == chunk_size else zeros[:n]
+                    offset += n
+                f.seek(offset)
+                while offset < start + length:
+                    chunk = f.read(min(chunk_size, start + length - offset))
+                    if not chunk:
+                        raise Exception('Image {} is shorter than its extent map'.format(path))
+                    yield chunk
+                    offset += len(chunk)
+
+
+def _allocated(fd: int, size: int) -> List[Tuple[int, int]]:
+    """get the allocated regions (start, end) of the file (SEEK_DATA/SEEK_HOLE)
+
+    Without support by the OS or the file system, the whole file is one
+    region."""
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)]
+    regions = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                # only a hole after offset
+                if e.errno == errno.ENXIO:
+                    break
+                raise
+            offset = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            regions.append((start, offset))
+    except OSError:
+        return [(0, size)]
+    return regions
+
+
+def _hash_zeros(hasher, length: int) -> None:
+    zeros = bytes(min(length, CHUNK_SIZE))
+    while length > 0:
+        hasher.update(zeros if length >= len(zeros) else zeros[:length])
+        length -= len(zeros)
+
+
+def scan(path: str, hasher=None, block_size: int = SPARSE_BLOCK_SIZE) -> ExtentMap:
+    """find the data extents of the image at path, hashing it in the same pass
+
+    Unallocated regions (holes of a sparse file) are not read at all. The
+    allocated regions are mapped with mmap and checked for zero blocks (see
+    nonzero_blocks()). With a hasher (eg. hashlib.sha256()), the whole
+    content is hashed, the holes without reading them."""
+    size = os.path.getsize(path)
+    extent_map = ExtentMap(size)
+    # scanned (and hashed) up to offset
+    offset = 0
+    with open(path, 'rb') as f:
+        regions = _allocated(f.fileno(), size)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if regions else None
+        try:
+            if hasattr(mmap, 'MADV_SEQUENTIAL') and mm is not None:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            for start, end in regions:
+                # the extents are aligned to block_size
+                start = max(start - start % block_size, offset)
+                end = min(-(-end // block_size) * block_size, size)
+                if start >= end:
+                    continue
+                if hasher:
+                    _hash_zeros(hasher, start - offset)
+                for pos in range(start, end, SCAN_WINDOW):
+                    with memoryview(mm)[pos:min(pos + SCAN_WINDOW, end)] as window:
+                        if hasher:
+                            hasher.update(window)
+                        for i, nonzero in enumerate(nonzero_blocks(window, block_size)):
+                            if nonzero:
+                                extent_map.add(pos + i * block_size,
+                                               min(block_size, len(window) - i * block_size))
+                offset = end
+        finally:
+            if mm is not None:
+                mm.close()
+    if hasher:
+        _hash_zeros(hasher, size - offset)
+    return extent_map
+
+
+def _sidecar_path(path: str) -> str:
+    return '{}{}'.format(path, SIDECAR_SUFFIX)
+
+
+def sidecar_load(path: str) -> dict:
+    """get the values stored for the file at path (empty if the file changed)"""
+    try:
+        st = os.stat(path)
+        with open(_sidecar_path(path), 'r') as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if sidecar.get('path') != os.path.abspath(path) or \
+       sidecar.get('size') != st.st_size or sidecar.get('mtime_ns') != st.st_mtime_ns:
+        return {}
+    return sidecar
+
+
+def sidecar_store(path: str, **values) -> None:
+    """store values (eg. sha256) for the file at path in a sidecar file next to it
+
+    The values which are still valid are kept."""
+    sidecar = sidecar_load(path)
+    st = os.stat(path)
+    sidecar.update(values, path=os.path.abspath(path), size=st.st_size,
+                   mtime_ns=st.st_mtime_ns)
+    tmp = '{}.tmp'.format(_sidecar_path(path))
+    with open(tmp, 'w') as f:
+        json.dump(sidecar, f)
+    os.replace(tmp, _sidecar_path(path))
+
+
+def extents_cached(path: str) -> Optional[ExtentMap]:
+    """get the extent map of the image at path from its sidecar (if still valid)"""
+    sidecar = sidecar_load(path)
+    if 'extents' not in sidecar:
+        return None
+    return ExtentMap(sidecar['size'], sidecar['extents'])
+
+
+def analyze(path: str) -> Tuple[str, ExtentMap]:
+    """get the sha256 and the extent map of the raw image at path
+
+    Both are kept in the sidecar of the image, so the image is scanned
+    only once (see scan())."""
+    sidecar = sidecar_load(path)
+    if 'sha256' in sidecar and 'extents' in sidecar:
+        return sidecar['sha256'], ExtentMap(sidecar['size'], sidecar['extents'])
+    sha256 = hashlib.sha256()
+    extent_map = scan(path, sha256)
+    sidecar_store(path, sha256=sha256.hexdigest(), extents=extent_map.extents)
+    return sha256.hexdigest(), extent_map
+
+
+def punch_holes(path: str, extent_map: ExtentMap) -> int:
+    """deallocate the zero regions of the file at path (fallocate PUNCH_HOLE)
+
+    The content stays the same, but the file gets sparse. Returns the
+    number of freed bytes (0 if the OS or file system can not punch holes)."""
+    import ctypes
+
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    except (OSError, AttributeError):
+        return 0
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    before = os.stat(path).st_blocks
+    with open(path, 'r+b') as f:
+        for offset, length in extent_map.holes():
+            if fallocate(f.fileno(), FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                         offset, length) != 0:
+                err = ctypes.get_errno()
+                if err in (errno.EOPNOTSUPP, errno.ENOSYS):
+                    return 0
+                raise OSError(err, os.strerror(err), path)
+    return max(before - os.stat(path).st_blocks, 0) * 512
+
+
+def write_sparse(chunks: Iterable[bytes], path: str,
+                 extent_map: Optional[ExtentMap] = None) -> int:
+    """write the chunks to path, but seek over blocks with only zeros
+
+    The file gets the full size but only the non-zero blocks are allocated
+    on disk. Consecutive non-zero blocks are written at once. The written
+    extents are added to extent_map. Returns the number of written
+    (non-zero) bytes."""
+    written = 0
+    offset = 0
+    with open(path, 'wb', buffering=0) as f:
+        for chunk in chunks:
+            flags = nonzero_blocks(chunk) + [False]
+            run = None
+            for i, nonzero in enumerate(flags):
+                if nonzero and run is None:
+                    run = i
+                elif not nonzero and run is not None:
+                    data = memoryview(chunk)[run * SPARSE_BLOCK_SIZE:i * SPARSE_BLOCK_SIZE]
+                    f.seek(offset + run * SPARSE_BLOCK_SIZE)
+                    f.write(data)
+                    written += len(data)
+                    if extent_map is not None:
+                        extent_map.add(offset + run * SPARSE_BLOCK_SIZE, len(data))
+                    run = None
+            offset += len(chunk)
+        f.truncate(offset)
+    if extent_map is not None:
+        extent_map.size = offset
+    return written
@@ -0,0 +1,150 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from . import cache
+from . import clients
+from . import image
+from . import obs
+from . import orchestrate
+from .placement import Target
+
+
+# tag (EC2) and property (OpenStack) with the sha256 of the OBS image
+SHA256_TAG='jcs-sha256'
+# tag (EC2) and property (OpenStack) with the OBS image url
+SOURCE_TAG='jcs-source-url'
+# max. length of EC2 tag values and Glance properties
+TAG_VALUE_MAX=255
+
+
+def _verify(cloud, name, where, checksum, sha256):
+    """check that an existing image is the downloaded one (raises if not)"""
+    if checksum is None:
+        print('{} image {} in {} exists without {} tag. Not verified'.format(
+            cloud, name, where, SHA256_TAG))
+    elif checksum != sha256:
+        raise Exception('{} image {} in {} has sha256 {} but the OBS image has {}. '
+                        'Delete it to replace it'.format(cloud, name, where, checksum, sha256))
+
+
+def _download(args, url, image_cache):
+    img = obs.OBSImage(url, workers=args.workers, image_cache=image_cache)
+    path = img.download()
+    return {'url': url, 'path': path, 'name': image.image_name(path),
+            'sha256': img.url_local_sha256,
+            'tags': {SHA256_TAG: img.url_local_sha256, SOURCE_TAG: url[:TAG_VALUE_MAX]}}
+
+
+def _ec2_source(args, targets, downloaded, image_cache):
+    """the region to copy the image from. Returns (region, status)
+
+    That is a region which has the image already, otherwise the image is
+    uploaded to the first region (the raw image with the ebs backend)."""
+    name = downloaded['name']
+    for target in targets:
+        client = clients.aws(args, target.region)
+        found = client.ec2_image_find(name)
+        if found:
+            _verify('EC2', name, target.region, found['tags'].get(SHA256_TAG),
+                    downloaded['sha256'])
+            if found['state'] != 'available':
+                client.ec2_image_wait_available(found['id'], name)
+            return target.region, 'exists'
+    region = targets[0].region
+    path = downloaded['path']
+    if args.upload_backend == 'ebs':
+        path = obs.OBSImage(downloaded['url'], workers=args.workers,
+                            image_cache=image_cache).decompress()
+    created = clients.aws(args, region).ec2_image_create(
+        path, args.image_arch, backend=args.upload_backend,
+        bucket=args.s3_bucket, part_size=args.s3_part_size,
+        concurrency=args.s3_concurrency, tags=downloaded['tags'])
+    # the copies need an available source image
+    clients.aws(args, region).ec2_image_wait_available(created['image_id'], name)
+    return region, 'uploaded'
+
+
+def _ec2_region(args, target, downloaded, source):
+    source_region, status = source
+    if target.region == source_region:
+        return status
+    client = clients.aws(args, target.region)
+    name = downloaded['name']
+    found = client.ec2_image_find(name)
+    if found:
+        _verify('EC2', name, target.region, found['tags'].get(SHA256_TAG),
+                downloaded['sha256'])
+        if found['state'] != 'available':
+            client.ec2_image_wait_available(found['id'], name)
+        return 'exists'
+    client.ec2_image_copy(name, source_region, tags=downloaded['tags'])
+    return 'copied'
+
+
+def _os_cloud(args, target, downloaded, raw_path):
+    client = clients.openstack(target.args(args))
+    name = downloaded['name']
+    found = client.os_image_find(name)
+    if found:
+        _verify('OS', name, target.region, found['properties'].get(SHA256_TAG),
+                downloaded['sha256'])
+        if found['status'] != 'active':
+            raise Exception('OS image {} in {} is {}'.format(name, target.region,
+                                                             found['status']))
+        return 'exists'
+    client.os_image_create(name, raw_path, properties=downloaded['tags'])
+    return 'uploaded'
+
+
+def sync(graph: orchestrate.Graph, args, urls: List[str], targets: List[Target],
+         image_cache: cache.ImageCache) -> Dict[str, str]:
+    """add the steps making the OBS images available on the targets
+
+    Every image is downloaded once. On EC2, it is uploaded to one region
+    and copied from there to the other regions concurrently. On OpenStack,
+    it is decompressed once and uploaded to every cloud (Glance)
+    concurrently. Images which exist with the same sha256 tag are skipped,
+    so a sync can be repeated. Returns a dict with "<url> <cloud>:<region>":
+    name of the step (which returns uploaded, copied or exists)."""
+    ec2_targets = [t for t in targets if t.cloud == 'ec2']
+    os_targets = [t for t in targets if t.cloud == 'openstack']
+    steps = {}
+    for url in urls:
+        download = graph.add('download:{}'.format(url),
+                             lambda url=url: _download(args, url, image_cache))
+        if ec2_targets:
+            source = graph.add('ec2-source:{}'.format(url),
+                               lambda d: _ec2_source(args, ec2_targets, d, image_cache),
+                               [download])
+            for target in ec2_targets:
+                where = '{}:{}'.format(target.cloud, target.region)
+                steps['{} {}'.format(url, where)] = graph.add(
+                    'ec2-image:{} {}'.format(url, where),
+                    lambda d, s, target=target: _ec2_region(args, target, d, s),
+                    [download, source])
+        if os_targets:
+            # Glance gets the raw image
+            raw = graph.add('raw:{}'.format(url), lambda d, url=url: obs.OBSImage(
+                url, workers=args.workers, image_cache=image_cache).decompress(), [download])
+            for target in os_targets:
+                where = '{}:{}'.format(target.cloud, target.region)
+                steps['{} {}'.format(url, where)] = graph.add(
+                    'os-image:{} {}'.format(url, where),
+                    lambda d, r, target=target: _os_cloud(args, target, d, r),
+                    [download, raw])
+    return steps
+
+
+def run(args, urls: List[str], target_specs: List[str]) -> Dict[str, object]:
+    """sync the images to the targets ("cloud:region"). Returns the result per step key"""
+    targets = []
+    for spec in target_specs:
+        target = Target(spec, args)
+        if (target.cloud, target.region) not in [(t.cloud, t.region) for t in targets]:
+            targets.append(target)
+    image_cache = cache.ImageCache(quota=args.cache_quota)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        graph = orchestrate.Graph(executor)
+        steps = sync(graph, args, urls, targets, image_cache)
+        results = orchestrate.run(graph)[0]
+    return {key: results[step] for key, step in steps.items()}
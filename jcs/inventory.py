@@ -0,0 +1,133 @@
+import contextlib
+import fnmatch
+import os
+import sqlite3
+import time
+from typing import List, Optional
+
+from . import cache
+
+
+INVENTORY_FILE='inventory.db'
+COLUMNS = ('jenkins_url', 'jenkins_name', 'cloud', 'region', 'instance_id', 'instance_name',
+           'ip', 'image', 'instance_type', 'labels', 'state', 'created', 'updated')
+
+
+class Inventory:
+    """The agents created by jcs (one row per Jenkins url and name)
+
+    Stored in a SQLite db in the cache dir, so deletes and listings go
+    straight to the instance ids instead of searching the clouds. The
+    clouds stay the source of truth, see reconcile()."""
+    def __init__(self, path: Optional[str] = None):
+        self._path = path or os.path.join(cache.CACHE_DIR, INVENTORY_FILE)
+        self._initialized = False
+
+    @contextlib.contextmanager
+    def _db(self):
+        """a connection (per call, the steps of a create run in threads) in a transaction"""
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        conn = sqlite3.connect(self._path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                if not self._initialized:
+                    conn.execute('CREATE TABLE IF NOT EXISTS agents ('
+                                 'jenkins_url TEXT NOT NULL, jenkins_name TEXT NOT NULL, '
+                                 'cloud TEXT NOT NULL, region TEXT, instance_id TEXT, '
+                                 'instance_name TEXT, ip TEXT, image TEXT, '
+                                 'instance_type TEXT, labels TEXT, state TEXT, '
+                                 'created REAL, updated REAL, '
+                                 'PRIMARY KEY (jenkins_url, jenkins_name))')
+                    self._initialized = True
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, jenkins_url: str, jenkins_name: str, cloud: str, **fields) -> None:
+        """add (or replace) the agent. fields are the other columns"""
+        now = time.time()
+        row = dict.fromkeys(COLUMNS)
+        row.update(fields, jenkins_url=jenkins_url, jenkins_name=jenkins_name, cloud=cloud)
+        row['created'] = row['created'] or now
+        row['updated'] = now
+        with self._db() as conn:
+            conn.execute('INSERT OR REPLACE INTO agents ({}) VALUES ({})'.format(
+                ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                [row[c] for c in COLUMNS])
+
+    def update(self, jenkins_url: str, jenkins_name: str, **fields) -> None:
+        fields['updated'] = time.time()
+        with self._db() as conn:
+            conn.execute('UPDATE agents SET {} WHERE jenkins_url = ? AND jenkins_name = ?'.format(
+                ', '.join('{} = ?'.format(c) for c in fields)),
+                list(fields.values()) + [jenkins_url, jenkins_name])
+
+    def remove(self, jenkins_url: str, jenkins_name: str) -> None:
+        with self._db() as conn:
+            conn.execute('DELETE FROM agents WHERE jenkins_url = ? AND jenkins_name = ?',
+                         (jenkins_url, jenkins_name))
+
+    def get(self, jenkins_url: str, jenkins_name: str) -> Optional[dict]:
+        with self._db() as conn:
+            row = conn.execute('SELECT * FROM agents WHERE jenkins_url = ? AND jenkins_name = ?',
+                               (jenkins_url, jenkins_name)).fetchone()
+        return dict(row) if row else None
+
+    def ls(self, jenkins_url: Optional[str] = None, cloud: Optional[str] = None,
+           image: Optional[str] = None, state: Optional[str] = None,
+           pattern: Optional[str] = None) -> List[dict]:
+        """get the agents, filtered by the given columns and a name glob pattern"""
+        where = []
+        params = []
+        for column, value in (('jenkins_url', jenkins_url), ('cloud', cloud),
+                              ('image', image), ('state', state)):
+            if value is not None:
+                where.append('{} = ?'.format(column))
+                params.append(value)
+        sql = 'SELECT * FROM agents'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        with self._db() as conn:
+            rows = [dict(row) for row in conn.execute(sql + ' ORDER BY created', params)]
+        if pattern:
+            rows = [row for row in rows if fnmatch.fnmatchcase(row['jenkins_name'], pattern)]
+        return rows
+
+    def reconcile(self, jenkins_url: str, cloud: str, instances: List[dict],
+                  region: Optional[str] = None) -> dict:
+        """sync the agents of the cloud (and region) with its listed instances
+
+        instances are dicts with jenkins_name, id, name, ip, state, created.
+        Agents without instance are removed, unknown instances are added.
+        Returns the counts of added, updated and removed agents."""
+        counts = {'added': 0, 'updated': 0, 'removed': 0}
+        known = {row['jenkins_name']: row for row in self.ls(jenkins_url, cloud)
+                 if region is None or row['region'] == region}
+        for instance in instances:
+            fields = {'instance_id': instance['id'], 'instance_name': instance['name'],
+                      'ip': instance['ip'], 'state': instance['state']}
+            row = known.pop(instance['jenkins_name'], None)
+            if row is None:
+                self.add(jenkins_url, instance['jenkins_name'], cloud, region=region,
+                         created=instance['created'], **fields)
+                counts['added'] += 1
+            elif any(row[k] != v for k, v in fields.items()):
+                self.update(jenkins_url, instance['jenkins_name'], **fields)
+                counts['updated'] += 1
+        for jenkins_name in known:
+            self.remove(jenkins_url, jenkins_name)
+            counts['removed'] += 1
+        return counts
+
+
+_default = None
+
+
+def default() -> Inventory:
+    """the process wide inventory"""
+    global _default
+    if _default is None:
+        _default = Inventory()
+    return _default
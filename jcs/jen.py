@@ -1,9 +1,32 @@
+import json
+import re
+import threading
+import time
+import urllib.parse
+
 import urllib3
 urllib3.disable_warnings()
-import time
 
-from jenkinsapi.jenkins import Jenkins
-from jenkinsapi.utils.crumb_requester import CrumbRequester
+from . import trace
+from . import wait
+from .executor import ThreadPoolExecutor
+
+
+# seconds to wait for a new node to come online
+NODE_ONLINE_TIMEOUT = 300
+# the label a queue item waits for, from its "why", eg. "Waiting for next
+# available executor on ‘label’" or "There are no nodes with the label ‘label’"
+QUEUE_WHY_LABEL = re.compile(r'(?:executor on|label) [‘\'"]([^’\'"]+)[’\'"]')
+# seconds the node index is used before it is fetched again (other clients
+# change the nodes, too)
+NODE_INDEX_TTL = 60
+# the node fields of the node index
+NODE_TREE = ('computer[displayName,description,offline,idle,numExecutors,'
+             'assignedLabels[name]]')
+# seconds to wait for the running builds of nodes which are deleted
+DRAIN_TIMEOUT = 3600
+# max. keep-alive connections to the Jenkins server (for concurrent requests)
+SESSION_POOL_SIZE = 32
 
 
 class JenkinsClient:
@@ -12,70 +35,348 @@ class JenkinsClient:
         self._username=username
         self._password=password
         self._ssl_verify=False
-        self._client=self._client_init()
+        # connected on first use
+        self.__client=None
+        self._client_lock=threading.Lock()
+        # node name: node (see node_index())
+        self._nodes=None
+        self._nodes_fetched=0
+        self._nodes_lock=threading.Lock()
+        # credential description: credential id
+        self._credentials={}
+
+    @property
+    def _client(self):
+        with self._client_lock:
+            if self.__client is None:
+                self.__client = self._client_init()
+            return self.__client
+
+    def connect(self):
+        """connect to the Jenkins server now (instead of on first use)"""
+        self._client
+        return self
 
     def _client_init(self):
+        from jenkinsapi.jenkins import Jenkins
+        from jenkinsapi.utils.crumb_requester import CrumbRequester
+        from requests.adapters import HTTPAdapter
+
         crumb_requester = CrumbRequester(
             baseurl=self._url,
             username=self._username,
             password=self._password,
             ssl_verify=self._ssl_verify
         )
+        # the concurrent requests (eg. delete_nodes()) reuse the connections
+        for prefix in ('http://', 'https://'):
+            adapter = crumb_requester.session.get_adapter(prefix)
+            crumb_requester.session.mount(prefix, HTTPAdapter(
+                pool_maxsize=SESSION_POOL_SIZE, max_retries=adapter.max_retries))
+        # every request counts, also the ones jenkinsapi sends itself
+        trace.requests_hooks(crumb_requester.session)
         server = Jenkins(self._url, self._username, self._password,
                          requester=crumb_requester, ssl_verify=self._ssl_verify)
         print('Connected to jenkins server {}'.format(server.version))
         return server
 
+    def _api(self, path, tree):
+        """get the JSON API of path, limited to the fields in tree"""
+        url = '{}/{}/api/json'.format(self._url.rstrip('/'), path)
+        return self._client.requester.get_and_confirm_status(
+            url, params={'tree': tree}).json()
+
+    def _post(self, path, params=None, data=None):
+        """POST to path (with the crumb)"""
+        url = '{}/{}'.format(self._url.rstrip('/'), path)
+        return self._client.requester.post_and_confirm_status(url, params=params,
+                                                              data=data or {})
+
+    def queue_items(self):
+        """get the items of the build queue which wait for an executor
+
+        Returns a list of dicts (id, name, label, since). label is None if
+        the item does not wait for a labeled executor."""
+        data = self._api('queue', 'items[id,inQueueSince,why,buildable,task[name]]')
+        items = []
+        for item in data.get('items', []):
+            if not item.get('buildable'):
+                continue
+            match = QUEUE_WHY_LABEL.search(item.get('why') or '')
+            items.append({
+                'id': item['id'],
+                'name': (item.get('task') or {}).get('name'),
+                'label': match.group(1) if match else None,
+                'since': item['inQueueSince'] / 1000.,
+            })
+        return items
+
+    def _nodes_fetch(self):
+        data = self._api('computer', NODE_TREE)
+        nodes = {computer['displayName']: {
+            'name': computer['displayName'],
+            'description': computer.get('description') or '',
+            'labels': [label['name'] for label in computer.get('assignedLabels', [])],
+            'offline': computer['offline'],
+            'idle': computer['idle'],
+            'executors': computer['numExecutors'],
+        } for computer in data.get('computer', [])}
+        with self._nodes_lock:
+            self._nodes = nodes
+            self._nodes_fetched = time.monotonic()
+        return dict(nodes)
+
+    def node_index(self, refresh=False):
+        """get the nodes by name (dicts as in nodes_usage())
+
+        The nodes are fetched with a single request and then updated by the
+        changes of this client. They are fetched again after NODE_INDEX_TTL
+        seconds or with refresh."""
+        with self._nodes_lock:
+            if not refresh and self._nodes is not None and \
+                    time.monotonic() - self._nodes_fetched < NODE_INDEX_TTL:
+                return dict(self._nodes)
+        return self._nodes_fetch()
+
+    def _node_update(self, node_name, node=None):
+        """update the node in the index (None: the node is gone)"""
+        with self._nodes_lock:
+            if self._nodes is None:
+                return
+            if node is None:
+                self._nodes.pop(node_name, None)
+            else:
+                self._nodes[node_name] = dict(self._nodes.get(node_name, {}), **node)
+
+    def nodes_usage(self):
+        """get the state of all nodes with a single request
+
+        Returns a list of dicts (name, description, labels, offline, idle,
+        executors)."""
+        return list(self.node_index(refresh=True).values())
+
+    def _node_offline(self, node_name):
+        """get the offline flag of the node from Jenkins (not from the index)
+
+        Returns None if the node does not exist. The index is updated."""
+        url = '{}/computer/{}/api/json'.format(self._url.rstrip('/'),
+                                               urllib.parse.quote(node_name))
+        response = self._client.requester.get_and_confirm_status(
+            url, params={'tree': 'offline'}, valid=[200, 404])
+        if response.status_code == 404:
+            self._node_update(node_name)
+            return None
+        offline = response.json()['offline']
+        with self._nodes_lock:
+            if self._nodes is not None and node_name in self._nodes:
+                self._nodes[node_name]['offline'] = offline
+        return offline
+
+    def _node_toggle(self, node_name, offline, message=''):
+        """take the node offline or bring it online. Returns True if it was toggled"""
+        # toggleOffline toggles, so the index (up to NODE_INDEX_TTL seconds old)
+        # is not good enough: only this node is fetched
+        current = self._node_offline(node_name)
+        if current is None:
+            raise Exception('Jenkins node "{}" not found'.format(node_name))
+        if current != offline:
+            self._post('computer/{}/toggleOffline'.format(urllib.parse.quote(node_name)),
+                       params={'offlineMessage': message})
+            self._node_update(node_name, {'offline': offline})
+        print('Jenkins node "{}" {}'.format(node_name, 'offline' if offline else 'online'))
+        return current != offline
+
     def offline_node(self, node_name, message=''):
-        node = self._client.get_nodes()[node_name]
-        node.set_offline(message)
-        print('Jenkins node "{}" offline'.format(node_name))
+        """take the node offline. Returns False if it was offline already"""
+        return self._node_toggle(node_name, True, message)
+
+    def online_node(self, node_name):
+        """bring the node (back) online. Returns False if it was online already"""
+        return self._node_toggle(node_name, False)
 
     def delete_node(self, node_name):
         print('Jenkins node "{}" deleting...'.format(node_name))
-        nodes = self._client.get_nodes()
-        if node_name in nodes.keys():
-            self._client.delete_node(node_name)
-            print('Jenkins node "{}" deleted'.format(node_name))
+        if node_name in self.node_index():
+            self.delete_nodes([node_name])
         else:
             print('Jenkins node "{}" not found. Not deleted'.format(node_name))
 
-    def create_node(self, node_hostname, node_name, node_desc, credential_desc,
-                    node_labels, force=True):
-        # does node already exist?
-        if node_name in self._client.nodes.keys() and force:
-            self.offline_node(node_name, 'Node will be deleted soon')
-            self.delete_node(node_name)
-
-        node_dict = {
-            'num_executors': 1,
-            'node_description': node_desc,
-            'remote_fs': '/tmp',
-            'labels': node_labels,
-            'exclusive': True,
+    def delete_nodes(self, node_names, workers=8):
+        """delete the nodes concurrently (one POST per node, no node list)"""
+        def _delete(node_name):
+            self._post('computer/{}/doDelete'.format(urllib.parse.quote(node_name)))
+            self._node_update(node_name)
+            print('Jenkins node "{}" deleted'.format(node_name))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(_delete, n) for n in node_names]:
+                future.result()
+
+    def drain_nodes(self, node_names, timeout=DRAIN_TIMEOUT, workers=8):
+        """take the nodes offline and wait until their running builds are finished
+
+        No new builds start on the nodes. All nodes are checked with a single
+        request. Returns the names of the nodes without running builds after
+        at most timeout seconds (nodes which do not exist count as drained).
+        The nodes which still have running builds are brought back online
+        (unless they were offline before)."""
+        index = self.node_index()
+        existing = [name for name in node_names if name in index]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {name: executor.submit(self.offline_node, name, 'Draining for deletion')
+                       for name in existing}
+            toggled = [name for name, future in futures.items() if future.result()]
+
+        busy = list(existing)
+
+        def _drained():
+            index = self.node_index(refresh=True)
+            busy[:] = [name for name in existing if name in index and not index[name]['idle']]
+            return True if not busy else None
+
+        try:
+            wait.wait_for('{} Jenkins nodes drained'.format(len(existing)), _drained,
+                          timeout=timeout, delay=2, max_delay=30)
+        except wait.WaitTimeout:
+            for name in busy:
+                print('Jenkins node "{}" still has running builds'.format(name))
+            # the nodes are kept, so they should take builds again
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for future in [executor.submit(self.online_node, name)
+                               for name in busy if name in toggled]:
+                    future.result()
+        return set(node_names) - set(busy)
+
+    def _credential_id(self, credential_desc):
+        """get the id of the credential with the description (fetched once)"""
+        if credential_desc not in self._credentials:
+            self._credentials = {description: credential.credential_id for
+                                 description, credential in
+                                 self._client.credentials.iteritems()}
+        if credential_desc not in self._credentials:
+            raise Exception('Jenkins credential with description "{}" not found'.format(
+                credential_desc))
+        return self._credentials[credential_desc]
+
+    def _node_config(self, node_hostname, node_name, node_desc, credential_id,
+                     node_labels):
+        """the form of computer/doCreateItem for a SSH agent (as jenkinsapi sends it)"""
+        retention = {
+            'stapler-class': 'hudson.slaves.RetentionStrategy$Always',
+            '$class': 'hudson.slaves.RetentionStrategy$Always',
+        }
+        launcher = {
+            'stapler-class': 'hudson.plugins.sshslaves.SSHLauncher',
+            '$class': 'hudson.plugins.sshslaves.SSHLauncher',
             'host': node_hostname,
             'port': 22,
-            'credential_description': credential_desc,
-            'jvm_options': '-Xmx2000M',
-            'java_path': '/usr/bin/java',
-            'prefix_start_slave_cmd': '',
-            'suffix_start_slave_cmd': '',
-            'max_num_retries': 0,
-            'retry_wait_time': 0,
-            'retention': 'Always',
-            'ondemand_delay': 1,
-            'ondemand_idle_delay': 5
+            'credentialsId': credential_id,
+            'jvmOptions': '-Xmx2000M',
+            'javaPath': '/usr/bin/java',
+            'prefixStartSlaveCmd': '',
+            'suffixStartSlaveCmd': '',
+            'maxNumRetries': 0,
+            'retryWaitTime': 0,
         }
-        print('Jenkins node "{}" creating ...'.format(node_name))
-        node = self._client.nodes.create_node(node_name, node_dict)
+        return {
+            'name': node_name,
+            'type': 'hudson.slaves.DumbSlave$DescriptorImpl',
+            'json': json.dumps({
+                'name': node_name,
+                'nodeDescription': node_desc,
+                'numExecutors': 1,
+                'remoteFS': '/tmp',
+                'labelString': node_labels,
+                'mode': 'EXCLUSIVE',
+                'retentionStrategy': retention,
+                'type': 'hudson.slaves.DumbSlave',
+                'nodeProperties': {'stapler-class-bag': 'true'},
+                'launcher': launcher,
+            }),
+        }
+
+    def _node_register(self, node_hostname, node_name, node_desc, credential_desc,
+                       node_labels, force):
+        """create the node in Jenkins (replacing an existing one with force)"""
+        config = self._node_config(node_hostname, node_name, node_desc,
+                                   self._credential_id(credential_desc), node_labels)
+        for attempt in range(2):
+            if force and node_name in self.node_index(refresh=attempt > 0):
+                self.offline_node(node_name, 'Node will be deleted soon')
+                self.delete_nodes([node_name])
+            try:
+                self._post('computer/doCreateItem', params=config,
+                           data={'json': urllib.parse.urlencode(config)})
+                break
+            except Exception:
+                # the node might have been created by another client since
+                # the index got fetched
+                if not force or attempt > 0:
+                    raise
+        self._node_update(node_name, {
+            'name': node_name, 'description': node_desc,
+            'labels': (node_labels or '').split(), 'offline': True, 'idle': True,
+            'executors': 1})
         print('Jenkins node "{}" created'.format(node_name))
-        for retry in range(60):
-            node = self._client.get_nodes()[node_name]
-            if node.is_online():
-                print('Jenkins node is online now'.format(node.is_online()))
-                return node
-            else:
-                print('Jenkins node is not online. Waiting...')
-                time.sleep(5)
 
-        raise Exception('Jenkins node "{}" ({}) still not online. abort'.format(node_name, node_hostname))
+    def _node_online(self, node_name):
+        return self._node_offline(node_name) is False
+
+    def create_node(self, node_hostname, node_name, node_desc, credential_desc,
+                    node_labels, force=True):
+        """create the node and wait until it is online
+
+        An existing node with the name is replaced (if force). Existence is
+        checked in the node index, so creating many nodes does not fetch the
+        node list for each of them."""
+        print('Jenkins node "{}" creating ...'.format(node_name))
+        self._node_register(node_hostname, node_name, node_desc, credential_desc,
+                            node_labels, force)
+        # only this node is polled (not the whole node list)
+        try:
+            wait.wait_for('Jenkins node "{}" online'.format(node_name),
+                          lambda: True if self._node_online(node_name) else None,
+                          timeout=NODE_ONLINE_TIMEOUT, delay=1, max_delay=10)
+        except wait.WaitTimeout:
+            raise Exception('Jenkins node "{}" ({}) still not online. abort'.format(
+                node_name, node_hostname))
+        print('Jenkins node is online now')
+
+    def create_nodes(self, nodes, force=True, workers=8):
+        """create many nodes in one pass and wait until they are online
+
+        nodes is a list of dicts (hostname, name, description, credential,
+        labels). The nodes are registered concurrently over the pooled
+        session and then polled together with a single request per check.
+        Returns a dict with node name: None or the exception of the node."""
+        results = {}
+
+        def _register(node):
+            self._node_register(node['hostname'], node['name'], node['description'],
+                                node['credential'], node['labels'], force)
+
+        # one node list and credential list for all nodes
+        self.node_index()
+        if nodes:
+            self._credential_id(nodes[0]['credential'])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {node['name']: executor.submit(_register, node) for node in nodes}
+            for node_name, future in futures.items():
+                results[node_name] = future.exception()
+
+        def _online():
+            index = self.node_index(refresh=True)
+            if all(not index.get(name, {'offline': True})['offline'] for name in pending):
+                return True
+            return None
+
+        pending = [name for name, error in results.items() if error is None]
+        try:
+            wait.wait_for('{} Jenkins nodes online'.format(len(pending)), _online,
+                          timeout=NODE_ONLINE_TIMEOUT, delay=1, max_delay=10)
+        except wait.WaitTimeout:
+            index = self.node_index()
+            for name in pending:
+                if index.get(name, {'offline': True})['offline']:
+                    results[name] = Exception('Jenkins node "{}" still not online'.format(name))
+        return results
@@ -0,0 +1,108 @@
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from . import cache
+
+
+LOOKUP_FILE='lookup.json'
+# seconds a name->id resolution is valid (can be set as env var "JCS_LOOKUP_TTL")
+TTL=3600
+
+
+class LookupCache:
+    """A TTL cache for name->id resolutions of cloud resources
+
+    Entries are kept in memory and in the cache dir, so batch runs and
+    repeated jcs invocations skip the lookups on the cloud APIs. Keys
+    contain the cloud and account/region, eg. "ec2:<key>:<region>:image:<name>".
+    A TTL of 0 disables the cache."""
+    def __init__(self, path: Optional[str] = None, ttl: Optional[float] = None):
+        self._path = path or os.path.join(cache.CACHE_DIR, LOOKUP_FILE)
+        self._ttl = float(os.getenv('JCS_LOOKUP_TTL', TTL)) if ttl is None else ttl
+        self._entries = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open('{}.lock'.format(self._path), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _load(self) -> dict:
+        try:
+            with open(self._path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _update(self, func: Callable[[dict], None]) -> None:
+        """apply func to the entries in memory and on disk"""
+        with self._lock, self._file_lock():
+            entries = self._load()
+            func(entries)
+            tmp = '{}.{}.tmp'.format(self._path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self._path)
+            self._entries = entries
+
+    def get(self, key: str):
+        if self._ttl <= 0:
+            return None
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            entry = self._entries.get(key)
+        if entry and time.time() - entry['time'] < self._ttl:
+            return entry['value']
+        return None
+
+    def set(self, key: str, value) -> None:
+        if self._ttl <= 0:
+            return
+        now = time.time()
+
+        def _set(entries):
+            entries[key] = {'value': value, 'time': now}
+            # drop expired entries
+            for k in [k for k, e in entries.items() if now - e['time'] >= self._ttl]:
+                del entries[k]
+
+        self._update(_set)
+
+    def invalidate(self, prefix: str = '') -> None:
+        """remove all entries whose key starts with prefix"""
+        def _invalidate(entries):
+            for k in [k for k in entries if k.startswith(prefix)]:
+                del entries[k]
+
+        self._update(_invalidate)
+
+    def resolve(self, key: str, func: Callable[[], object]):
+        """get the cached value for key or call func (None results are not cached)"""
+        value = self.get(key)
+        if value is None:
+            value = func()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+
+_default = None
+
+
+def default() -> LookupCache:
+    """the process wide lookup cache"""
+    global _default
+    if _default is None:
+        _default = LookupCache()
+    return _default
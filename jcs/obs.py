@@ -1,81 +1,229 @@
+import contextlib
 import hashlib
+import lzma
 import os
+import re
 from typing import Optional
 
 import requests
 
+from . import cache
+from . import download
+from . import image
+from . import trace
 
-CACHE_DIR='{}/.cache/jcs'.format(os.path.expanduser('~'))
+
+CACHE_DIR=cache.CACHE_DIR
+
+_SHA256_RE = re.compile(r'^([0-9a-fA-F]{64})\s+\*?(\S+)?')
+
+
+def sha256_parse(content: str, filename: Optional[str] = None) -> Optional[str]:
+    """get the checksum from the content of a .sha256 file
+
+    The content is the output of `sha256sum`, optionally wrapped in a PGP
+    signature (as published by OBS). If there are multiple checksums, the
+    one for the given filename is used."""
+    found = None
+    for line in content.splitlines():
+        m = _SHA256_RE.match(line.strip())
+        if not m:
+            continue
+        if filename is None or m.group(2) in (None, filename):
+            return m.group(1).lower()
+        if found is None:
+            found = m.group(1).lower()
+    return found
+
+
+def sha256_cached(path: str) -> Optional[str]:
+    """get the sha256 of path from the sidecar file (if still valid)"""
+    return image.sidecar_load(path).get('sha256')
+
+
+def http_validators(headers) -> dict:
+    """get the HTTP validators that are stored in the cache index"""
+    headers = requests.structures.CaseInsensitiveDict(headers)
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'content_length': headers.get('Content-Length'),
+    }
+
+
+def http_head(url: str, headers: Optional[dict] = None) -> requests.Response:
+    """HEAD request for url. Servers that do not allow HEAD get a GET (the body is not read)"""
+    r = requests.head(url, headers=headers, allow_redirects=True)
+    if r.status_code in (405, 501):
+        r = requests.get(url, headers=headers, stream=True)
+        r.close()
+    return r
+
+
+def http_revalidate(url: str, entry: dict) -> bool:
+    """check with a conditional HEAD request if the cache entry is up to date"""
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    if not headers:
+        return False
+    r = http_head(url, headers)
+    if r.status_code == 304:
+        return True
+    if r.status_code != 200:
+        raise Exception('Can not get {} ({})'.format(url, r.status_code))
+    # not all servers answer conditional HEAD requests with a 304
+    if entry.get('etag'):
+        return r.headers.get('ETag') == entry['etag']
+    return r.headers.get('Last-Modified') == entry['last_modified'] and \
+        r.headers.get('Content-Length') == entry['content_length']
 
 
 class OBSImage:
-    def __init__(self, url: str):
+    def __init__(self, url: str, workers: int = download.WORKERS,
+                 image_cache: Optional[cache.ImageCache] = None):
         # local cache
-        self._cache_dir = CACHE_DIR
-        os.makedirs(self._cache_dir, exist_ok=True)
+        self._cache = image_cache or cache.ImageCache()
         # remote image url
         self._url_remote = url
-        # local image url (path)
-        self._url_local = os.path.join(
-            self.cache_dir,
-            os.path.basename(self.url_remote))
+        # number of parallel range requests for the download
+        self._workers = workers
+        # the parsed remote checksum. fetched only once
+        self._remote_sha256 = None
+        self._remote_sha256_fetched = False
 
     @property
     def cache_dir(self):
-        return self._cache_dir
+        return self._cache.cache_dir
 
     @property
     def url_remote(self) -> str:
         return self._url_remote
 
     @property
-    def url_local(self) -> str:
-        return self._url_local
+    def url_local(self) -> Optional[str]:
+        """local image url (path) in the cache"""
+        entry = self._cache.lookup(self.url_remote)
+        return entry['path'] if entry else None
 
     @property
     def url_remote_sha256(self) -> Optional[str]:
-        """download a .sha256 file from the given url"""
-        r = requests.get('{}.sha256'.format(self.url_remote), stream=True)
-        if r.status_code == 200:
-            # FIXME: this contains the whole file, not just the sha
-            return r.text
-        return None
+        """download and parse the .sha256 file from the given url"""
+        if not self._remote_sha256_fetched:
+            r = requests.get('{}.sha256'.format(self.url_remote))
+            if r.status_code == 200:
+                self._remote_sha256 = sha256_parse(
+                    r.text, os.path.basename(self.url_remote))
+            self._remote_sha256_fetched = True
+        return self._remote_sha256
 
     @property
     def url_local_sha256(self) -> Optional[str]:
-        if os.path.exists(self.url_local):
-            sha256 = hashlib.sha256()
-            with open(self.url_local, 'rb') as f:
-                for block in iter(lambda: f.read(65536), b''):
-                    sha256.update(block)
-                return sha256.hexdigest()
-        return None
-
-    def _do_download(self, response: requests.Response) -> None:
-        with open(self.url_local, 'wb') as f:
-            print('Download to file {} ...'.format(self.url_local))
-            for chunk in response.iter_content(4096):
-                f.write(chunk)
-            print('Download to file {} done'.format(self.url_local))
+        entry = self._cache.lookup(self.url_remote)
+        return entry['sha256'] if entry else None
+
+    def _do_download(self) -> str:
+        path = self._cache.tmp_path(self.url_remote)
+        print('Download to file {} ...'.format(path))
+        downloader = download.RangeDownloader(self.url_remote, path,
+                                              workers=self._workers)
+        with trace.span('obs-download', url=self.url_remote):
+            downloader.download()
+        print('Download to file {} done (sha256 {})'.format(
+            path, downloader.sha256))
+        # the validators go into the cache only with a verified file. otherwise the
+        # next run would revalidate the corrupt file
+        if self.url_remote_sha256 and downloader.sha256 != self.url_remote_sha256:
+            os.remove(path)
+            raise Exception('Downloaded image {} has sha256 {} but {} is expected'.format(
+                self.url_remote, downloader.sha256, self.url_remote_sha256))
+        return self._cache.add(self.url_remote, path, downloader.sha256,
+                               http_validators(downloader.headers))
+
+    def _cached(self, entry: Optional[dict]) -> bool:
+        """check if the cache entry is still the current content of the url"""
+        if not entry:
+            return False
+        if http_revalidate(self.url_remote, entry):
+            print('Skipping download. image unchanged and '
+                  'already local available at {}'.format(entry['path']))
+            self._cache.touch(self.url_remote)
+            return True
+        if self.url_remote_sha256 and entry['sha256'] == self.url_remote_sha256:
+            print('Skipping download. image with sha256 {} '
+                  'already local available at {}'.format(entry['sha256'], entry['path']))
+            r = http_head(self.url_remote)
+            self._cache.touch(self.url_remote,
+                              http_validators(r.headers) if r.status_code == 200 else None)
+            return True
+        print('Outdated image exist local at {} with '
+              'sha256 {}'.format(entry['path'], entry['sha256']))
+        return False
 
     def download(self) -> Optional[str]:
-        r = requests.get(self.url_remote, stream=True)
-        if r.status_code != 200:
-            raise Exception('Can not get {} ({})'.format(
-                self.url_remote, r.status_code))
-
-        if os.path.exists(self.url_local):
-            if self.url_remote_sha256 and \
-               self.url_local_sha256 in self.url_remote_sha256:
-                print('Skipping download. image with sha256 {} '
-                      'already local available at {}'.format(
-                          self.url_local_sha256, self.url_local))
-            else:
-                print('Outdated image exist local at {} with '
-                      'sha256 {}'.format(self.url_local,
-                                         self.url_local_sha256))
-                self._do_download(r)
-        else:
-            self._do_download(r)
-        return self.url_local
+        entry = self._cache.lookup(self.url_remote)
+        if self._cached(entry):
+            return entry['path']
+        with self._cache.download_lock(self.url_remote):
+            # another jcs process might have downloaded it in the meantime
+            current = self._cache.lookup(self.url_remote)
+            if current != entry and self._cached(current):
+                return current['path']
+            return self._do_download()
+
+    def _sparsify(self, path: str) -> None:
+        """punch holes into the zero regions of the raw image in the cache"""
+        with self._cache.download_lock(self.url_remote):
+            sha256, extent_map = image.analyze(path)
+            if os.stat(path).st_blocks * 512 <= extent_map.data_bytes:
+                return
+            with trace.span('obs-sparsify', path=path):
+                freed = image.punch_holes(path, extent_map)
+            if freed:
+                # punching holes changes the mtime, the content is the same
+                image.sidecar_store(path, sha256=sha256, extents=extent_map.extents)
+                print('Punched holes into {} ({} freed, {} of {} bytes data)'.format(
+                    path, cache.size_format(freed), extent_map.data_bytes, extent_map.size))
 
+    def decompress(self) -> str:
+        """get the path of the raw image, decompressing the download if needed
+
+        Tools that can consume the .xz image directly should not use this.
+        The raw file is written sparse (zero blocks are not allocated) and is
+        hashed while it is written. Its extent map is kept next to it (see
+        image.analyze())."""
+        path = self.download()
+        if not path.endswith('.xz'):
+            # a raw download is written fully allocated
+            self._sparsify(path)
+            return path
+        entry = self._cache.lookup(self.url_remote)
+        name = image.raw_name(path)
+        raw = self._cache.name_path(entry['sha256'], name)
+        with self._cache.download_lock(self.url_remote):
+            if os.path.exists(raw) and sha256_cached(raw):
+                print('Skipping decompress. raw image already local available at {}'.format(raw))
+                return raw
+            print('Decompress to file {} ...'.format(raw))
+            tmp = '{}.part'.format(raw)
+            sha256 = hashlib.sha256()
+            extent_map = image.ExtentMap()
+            try:
+                with trace.span('obs-decompress', path=raw):
+                    written = image.write_sparse(
+                        image.hash_chunks(image.xz_chunks(path), sha256), tmp, extent_map)
+            except BaseException as e:
+                # no partial raw image is left behind
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(tmp)
+                if isinstance(e, (lzma.LZMAError, EOFError)):
+                    raise Exception('Image {} is corrupt: {}'.format(path, e))
+                raise
+            os.replace(tmp, raw)
+            image.sidecar_store(raw, sha256=sha256.hexdigest(), extents=extent_map.extents)
+            self._cache.add_derived(entry['sha256'], name)
+            print('Decompress to file {} done ({} of {} bytes allocated)'.format(
+                raw, written, os.path.getsize(raw)))
+        return raw
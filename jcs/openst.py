@@ -1,9 +1,36 @@
-import openstack
+import calendar
+import random
+import string
+import threading
+import time
+
+from . import lookup
+from . import wait
+from .executor import ThreadPoolExecutor
+from .placement import CapacityError
+
+
+# seconds to wait for a new server to become active
+SERVER_ACTIVE_TIMEOUT = 600
+# seconds to wait for an uploaded image to become active
+IMAGE_UPLOAD_TIMEOUT = 3600
+# server faults and API errors which mean that the cloud has no capacity
+CAPACITY_ERRORS = ('No valid host was found', 'Quota exceeded')
 
 class OpenstClient:
     def __init__(self, os_cloud):
         self._os_cloud = os_cloud
-        self._conn = openstack.connect(cloud=os_cloud)
+        # connected on first use
+        self.__conn = None
+        self._conn_lock = threading.Lock()
+
+    @property
+    def _conn(self):
+        with self._conn_lock:
+            if self.__conn is None:
+                import openstack
+                self.__conn = openstack.connect(cloud=self._os_cloud)
+            return self.__conn
 
     def _os_instance_get_floating_ip(self, instance, network_fixed,
                                      network_public):
@@ -21,28 +48,100 @@ class OpenstClient:
             return floating_ip
         return floating_ip
 
-    def os_instance_create(self, instance_name, instance_type, image_name, key_name,
-                           network_fixed, network_public, security_groups):
-        instance = self._conn.get_server(instance_name)
-        if instance:
-            raise Exception('OS instance "{}" ({}) already available'.format(
-                instance_name, instance['id']))
+    def _lookup_key(self, kind, name=''):
+        """the key for name->id resolutions in the lookup cache"""
+        return 'os:{}:{}:{}'.format(self._os_cloud, kind, name)
 
-        image = self._conn.get_image(image_name)
+    def _lookup_invalidate(self):
+        """forget the cached image, flavor and network ids (they might be outdated)"""
+        for kind in ('image', 'flavor', 'network'):
+            lookup.default().invalidate(self._lookup_key(kind))
+
+    def _lookup(self, kind, name, func):
+        """resolve name to {'id', 'name'} with the lookup cache
+
+        openstacksdk uses the id of dict arguments directly (no extra lookup)."""
+        def _resolve():
+            resource = func(name)
+            return {'id': resource['id'], 'name': resource['name']} if resource else None
+
+        return lookup.default().resolve(self._lookup_key(kind, name), _resolve)
+
+    def os_image_get(self, image_name):
+        image = self._lookup('image', image_name, self._conn.get_image)
         if not image:
             raise Exception('OS image "{}" not found'.format(image_name))
+        return image
 
-        instance_type = self._conn.get_flavor(instance_type)
-        if not instance_type:
+    def os_image_find(self, image_name):
+        """get the image with the name (dict with id, status, properties) or None (not cached)"""
+        image = self._conn.get_image(image_name)
+        if not image:
+            return None
+        return {'id': image['id'], 'status': image['status'],
+                'properties': image.get('properties') or {}}
+
+    def os_image_create(self, image_name, path, properties=None):
+        """upload the raw image file to Glance and wait until it is active
+
+        properties (dict) are set on the image. Returns the image id."""
+        print('OS uploading image {} to {} ...'.format(image_name, self._os_cloud))
+        image = self._conn.create_image(image_name, filename=path, disk_format='raw',
+                                        container_format='bare', wait=True,
+                                        timeout=IMAGE_UPLOAD_TIMEOUT, meta=properties or {})
+        print('OS image {} created (Id: {})'.format(image_name, image['id']))
+        lookup.default().set(self._lookup_key('image', image_name),
+                             {'id': image['id'], 'name': image_name})
+        return image['id']
+
+    def os_flavor_get(self, instance_type):
+        flavor = self._lookup('flavor', instance_type, self._conn.get_flavor)
+        if not flavor:
             raise Exception('OS instance type (flavor) "{}" not found'.format(instance_type))
+        return flavor
+
+    def os_network_get(self, network_name):
+        return self._lookup('network', network_name, self._conn.get_network)
+
+    def os_server_create(self, instance_name, image, flavor, key_name,
+                         network_fixed, network_public, security_groups, meta=None):
+        """create the instance from the already resolved image, flavor and network
 
-        network_fixed = self._conn.get_network(network_fixed)
+        Returns (server id, floating ip)."""
+        instance = self._conn.get_server(instance_name)
+        if instance:
+            raise Exception('OS instance "{}" ({}) already available'.format(
+                instance_name, instance['id']))
 
         # create instance
-        instance = self._conn.create_server(
-            instance_name, image=image, flavor=instance_type, key_name=key_name,
-            network=network_fixed, security_groups=security_groups,
-            wait=True, auto_ip=True)
+        try:
+            instance = self._conn.create_server(
+                instance_name, image=image, flavor=flavor, key_name=key_name,
+                network=network_fixed, security_groups=security_groups,
+                meta=meta, wait=False, auto_ip=True)
+        except Exception as e:
+            if any(error in str(e) for error in CAPACITY_ERRORS):
+                raise CapacityError('OS {} {}: {}'.format(self._os_cloud, flavor['name'], e))
+            # the cached ids might be outdated (eg. the image was deleted)
+            self._lookup_invalidate()
+            raise
+
+        def _active():
+            server = self._conn.get_server_by_id(instance['id'])
+            if server and server['status'] == 'ERROR':
+                message = server.get('fault', {}).get('message')
+                if any(error in (message or '') for error in CAPACITY_ERRORS):
+                    # the failed server would count against the quota
+                    self._conn.delete_server(instance['id'], wait=False)
+                    raise CapacityError('OS {} {}: {}'.format(self._os_cloud, flavor['name'],
+                                                              message))
+                self._lookup_invalidate()
+                raise Exception('OS instance "{}" ({}) failed: {}'.format(
+                    instance_name, instance['id'], message))
+            return server if server and server['status'] == 'ACTIVE' else None
+
+        instance = wait.wait_for('OS instance "{}" active'.format(instance_name), _active,
+                                 timeout=SERVER_ACTIVE_TIMEOUT, delay=2)
 
         # add floating ip
         try:
@@ -55,12 +154,117 @@ class OpenstClient:
         print('OS instance {} ({}) created'.format(instance['name'], instance['id']))
 
         # handle floating/public IP
-        floating_ip = self._os_instance_get_floating_ip(instance, network_fixed,
-                                                        network_public)
+        floating_ip = self._os_instance_get_floating_ip(
+            instance, network_fixed['name'] if network_fixed else None, network_public)
         if not floating_ip:
             raise Exception('OS public (floating) IP not found for {}'.format(instance['name']))
         print('OS instance {} has {}'.format(instance['name'], floating_ip))
-        return floating_ip
+        return instance['id'], floating_ip
+
+    def os_instance_create(self, instance_name, instance_type, image_name, key_name,
+                           network_fixed, network_public, security_groups):
+        image = self.os_image_get(image_name)
+        flavor = self.os_flavor_get(instance_type)
+        network_fixed = self.os_network_get(network_fixed)
+        return self.os_server_create(instance_name, image, flavor, key_name,
+                                     network_fixed, network_public, security_groups)
+
+    def os_pool_servers(self, pool_key=None):
+        """get the servers of a warm pool (or of all pools)
+
+        Returns a list of dicts (id, name, status, pool, since, server), oldest first."""
+        servers = []
+        for server in self._conn.list_servers():
+            meta = server.get('metadata') or {}
+            if 'jcs-pool' not in meta or (pool_key and meta['jcs-pool'] != pool_key):
+                continue
+            servers.append({
+                'id': server['id'],
+                'name': server['name'],
+                'status': server['status'],
+                'pool': meta['jcs-pool'],
+                'since': float(meta.get('jcs-pool-since', 0)),
+                'server': server,
+            })
+        return sorted(servers, key=lambda s: s['since'])
+
+    def os_pool_fill(self, pool_key, size, image_name, instance_type, key_name,
+                     network_fixed, network_public, security_groups):
+        """create servers until the warm pool has size servers"""
+        missing = size - len(self.os_pool_servers(pool_key))
+        if missing <= 0:
+            print('OS pool {} is full'.format(pool_key))
+            return []
+        image = self.os_image_get(image_name)
+        flavor = self.os_flavor_get(instance_type)
+        network = self.os_network_get(network_fixed)
+        meta = {'jcs-pool': pool_key, 'jcs-pool-since': str(time.time())}
+        names = ['jcs-pool-' + ''.join(random.choice(string.ascii_lowercase)
+                                       for i in range(10)) for _ in range(missing)]
+        with ThreadPoolExecutor(max_workers=missing) as executor:
+            futures = [executor.submit(self.os_server_create, name, image, flavor, key_name,
+                                       network, network_public, security_groups, meta)
+                       for name in names]
+        for future in futures:
+            future.result()
+        print('OS pool {} filled with {} servers'.format(pool_key, len(names)))
+        return names
+
+    def os_pool_claim(self, pool_key, instance_names, network_fixed, network_public,
+                      meta=None):
+        """take up to len(instance_names) active servers out of the warm pool
+
+        The servers are renamed to instance_names and get the metadata
+        meta. The caller must make sure that no one else claims at the same
+        time. Returns a list of dicts (id, name, ip)."""
+        servers = [s for s in self.os_pool_servers(pool_key)
+                   if s['status'] == 'ACTIVE'][:len(instance_names)]
+        claimed = []
+        for server, instance_name in zip(servers, instance_names):
+            self._conn.delete_server_metadata(server['id'], ['jcs-pool', 'jcs-pool-since'])
+            if meta:
+                self._conn.set_server_metadata(server['id'], meta)
+            self._conn.update_server(server['id'], name=instance_name)
+            floating_ip = self._os_instance_get_floating_ip(server['server'], network_fixed,
+                                                            network_public)
+            print('OS instance {} taken from pool {} as {}. {}'.format(
+                server['name'], pool_key, instance_name, floating_ip))
+            claimed.append({'id': server['id'], 'name': instance_name, 'ip': floating_ip})
+        return claimed
+
+    def os_jcs_servers(self):
+        """get the servers created by jcs create (named jcs-*, not in a warm pool)
+
+        Returns a list of dicts (id, name, ip, jenkins_name, jenkins_url,
+        status, created)."""
+        servers = []
+        for server in self._conn.list_servers():
+            meta = server.get('metadata') or {}
+            if not server['name'].startswith('jcs-') or 'jcs-pool' in meta:
+                continue
+            servers.append({
+                'id': server['id'],
+                'name': server['name'],
+                'ip': next((addr['addr'] for addrs in server['addresses'].values()
+                            for addr in addrs if addr['version'] == 4 and
+                            addr.get('OS-EXT-IPS:type') == 'floating'), None),
+                'jenkins_name': server['name'][len('jcs-'):],
+                'jenkins_url': meta.get('jcs-jenkins-url'),
+                'status': server['status'],
+                'created': calendar.timegm(time.strptime(server['created'],
+                                                         '%Y-%m-%dT%H:%M:%SZ')),
+            })
+        return servers
+
+    def os_servers_delete(self, server_ids, workers=8):
+        """delete the servers concurrently (without waiting for them to be gone)"""
+        def _delete(server_id):
+            self._conn.delete_server(server_id, wait=False, delete_ips=True)
+            print('OS instance "{}" deleted'.format(server_id))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(_delete, i) for i in server_ids]:
+                future.result()
 
     def os_instance_delete(self, instance_name):
         instance = self._conn.get_server(instance_name)
@@ -0,0 +1,84 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import Executor
+from typing import Callable, Dict, Iterable, List, Optional
+
+from . import trace
+
+
+class Graph:
+    """A dependency graph of (blocking) steps, executed with asyncio
+
+    Every step is a function that is called with the results of its
+    dependencies as arguments. It runs on the executor as soon as all its
+    dependencies are done, so independent steps overlap. If a step fails,
+    all steps depending on it fail with the same exception. Every step is
+    traced as a span (named by the step name up to the first ":").
+
+    A step added with partial runs even if dependencies failed and is called
+    with their exceptions instead (eg. to handle many agents in one step).
+
+    Steps must be added after their dependencies, so there are no cycles."""
+    def __init__(self, executor: Optional[Executor] = None):
+        self._executor = executor
+        self._steps = {}
+
+    def add(self, name: str, func: Callable, deps: Iterable[str] = (),
+            partial: bool = False) -> str:
+        if name in self._steps:
+            raise Exception('Step "{}" already exists'.format(name))
+        deps = tuple(deps)
+        for dep in deps:
+            if dep not in self._steps:
+                raise Exception('Step "{}" depends on unknown step "{}"'.format(name, dep))
+        self._steps[name] = (func, deps, partial)
+        return name
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._steps
+
+    async def run(self) -> Dict[str, object]:
+        """run all steps. Returns the result (or the exception) of every step"""
+        loop = asyncio.get_running_loop()
+        tasks = {}
+
+        async def _step(name):
+            func, deps, partial = self._steps[name]
+            if partial and deps:
+                await asyncio.wait([tasks[dep] for dep in deps])
+                args = [tasks[dep].exception() or tasks[dep].result() for dep in deps]
+            else:
+                args = [await tasks[dep] for dep in deps]
+            # steps see the context (eg. the daemon's output stream) of the caller
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(context.run, _traced, name, func, *args))
+
+        # dicts keep the insertion order, so dependencies get their tasks first
+        for name in self._steps:
+            tasks[name] = asyncio.ensure_future(_step(name))
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        results = {}
+        for name, task in tasks.items():
+            results[name] = task.exception() if task.exception() else task.result()
+        return results
+
+
+def _traced(name, func, *args):
+    phase, _, target = name.partition(':')
+    with trace.span(phase, **({'target': target} if target else {})):
+        try:
+            return func(*args)
+        except SystemExit as e:
+            # only this step fails, not the whole run
+            raise Exception('Step {} exited (rc: {})'.format(name, e.code)) from e
+
+
+def run(*graphs: Graph) -> List[Dict[str, object]]:
+    """run the graphs on one event loop. Returns the results of every graph"""
+    async def _run():
+        return await asyncio.gather(*(graph.run() for graph in graphs))
+
+    return asyncio.run(_run())
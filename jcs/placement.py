@@ -0,0 +1,121 @@
+import argparse
+import os
+from typing import Dict, List, Optional
+
+from . import cache
+from . import lookup
+from . import orchestrate
+
+
+CAPACITY_FILE='capacity.json'
+# seconds a target with a capacity error is skipped
+CAPACITY_COOLDOWN=300
+
+
+class CapacityError(Exception):
+    """the cloud/region has no capacity for the instance type (try another target)"""
+    pass
+
+
+class Target:
+    """where to create agents: cloud, region (EC2) or cloud name (OpenStack),
+    instance type and a weight (for spreading agents over targets)
+
+    Parsed from "cloud:region:instance-type@weight". Omitted parts are taken
+    from the CLI arguments, eg. "ec2:us-east-1" or "openstack:my-cloud:m1.large"."""
+    def __init__(self, spec: str, args):
+        spec, _, weight = spec.partition('@')
+        parts = spec.split(':')
+        if parts[0] not in ('ec2', 'openstack') or len(parts) > 3:
+            raise Exception('Invalid placement target "{}"'.format(spec))
+        self.cloud = parts[0]
+        default_region = args.aws_region_name if self.cloud == 'ec2' else args.os_cloud
+        self.region = parts[1] if len(parts) > 1 and parts[1] else default_region
+        self.instance_type = parts[2] if len(parts) > 2 and parts[2] else args.instance_type
+        self.weight = int(weight) if weight else 1
+
+    def __str__(self):
+        return '{}:{}:{}'.format(self.cloud, self.region, self.instance_type)
+
+    def args(self, args):
+        """a copy of args for creating agents on this target"""
+        target_args = argparse.Namespace(**vars(args))
+        target_args.cloud = self.cloud
+        target_args.instance_type = self.instance_type
+        if self.cloud == 'ec2':
+            target_args.aws_region_name = self.region
+        else:
+            target_args.os_cloud = self.region
+        return target_args
+
+
+def _capacity(cooldown: float) -> lookup.LookupCache:
+    """the targets with capacity errors in the last cooldown seconds"""
+    return lookup.LookupCache(os.path.join(cache.CACHE_DIR, CAPACITY_FILE), ttl=cooldown)
+
+
+def assign(names: List[str], targets: List[Target], mode: str) -> Dict[str, List[str]]:
+    """assign the names to the targets
+
+    failover: all to the first target. spread: by the target weights."""
+    if mode == 'failover' or len(targets) == 1:
+        return {str(targets[0]): list(names)}
+    total = sum(t.weight for t in targets)
+    assigned = {str(t): [] for t in targets}
+    counts = {str(t): 0. for t in targets}
+    for name in names:
+        # the target which is furthest behind its share
+        for t in targets:
+            counts[str(t)] += t.weight / total
+        target = max(targets, key=lambda t: counts[str(t)])
+        counts[str(target)] -= 1
+        assigned[str(target)].append(name)
+    return {t: n for t, n in assigned.items() if n}
+
+
+def create(executor, args, jenkins_names: List[str], targets: List[Target],
+           mode: str = 'failover', image_source_region: Optional[str] = None,
+           cooldown: float = CAPACITY_COOLDOWN) -> Dict[str, object]:
+    """create the agents on the targets with the create workflow
+
+    The agents of all used targets are created concurrently. Agents which
+    fail with a CapacityError are retried on the remaining targets and the
+    target is skipped for cooldown seconds (also by other jcs processes).
+    Returns the instance (or the exception) per jenkins name."""
+    # workflow imports CapacityError from here
+    from . import workflow
+
+    capacity = _capacity(cooldown)
+    by_name = {str(t): t for t in targets}
+    # targets with capacity errors in this run
+    exhausted = set()
+    pending = list(jenkins_names)
+    results = {}
+    while pending:
+        available = [t for t in targets
+                     if str(t) not in exhausted and not capacity.get(str(t))]
+        if not available:
+            break
+        graphs = []
+        steps = {}
+        for target, names in assign(pending, available, mode).items():
+            print('Placing {} agent(s) on {}'.format(len(names), target))
+            graph = orchestrate.Graph(executor)
+            steps[target] = workflow.create(graph, by_name[target].args(args), names,
+                                            image_source_region=image_source_region)
+            graphs.append(graph)
+        pending = []
+        for (target, target_steps), graph_results in zip(steps.items(),
+                                                         orchestrate.run(*graphs)):
+            for name, step in target_steps.items():
+                results[name] = graph_results[step]
+                if isinstance(results[name], CapacityError):
+                    exhausted.add(target)
+                    if not capacity.get(target):
+                        print('No capacity on {}: {}'.format(target, results[name]))
+                        capacity.set(target, str(results[name]))
+                    pending.append(name)
+    for name in pending:
+        if name not in results:
+            results[name] = CapacityError('No placement target with capacity left')
+    return results
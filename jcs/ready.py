@@ -0,0 +1,109 @@
+import selectors
+import socket
+import time
+from typing import Iterable, Set
+
+from . import trace
+
+
+SSH_PORT=22
+# seconds to wait until sshd answers on a new instance
+SSH_TIMEOUT=300
+# seconds between two connection attempts to a host
+PROBE_INTERVAL=2
+# seconds a single connection attempt (connect and banner) may take
+CONNECT_TIMEOUT=5
+# max. bytes read while waiting for the SSH banner (servers may send other
+# lines before it)
+BANNER_MAX=4096
+
+
+def _banner(data: bytes) -> bool:
+    """check if data contains the SSH identification line"""
+    return any(line.startswith(b'SSH-') for line in data.split(b'\n')[:-1])
+
+
+def wait_ssh(hosts: Iterable[str], port: int = SSH_PORT, timeout: float = SSH_TIMEOUT,
+             interval: float = PROBE_INTERVAL) -> Set[str]:
+    """wait until sshd answers with its banner on all hosts
+
+    All hosts are probed at once with non-blocking sockets (a single
+    thread). A host is ready when it accepts the connection and sends the
+    SSH identification line, an open port alone is not enough (sshd might
+    not be started yet). Failed attempts are repeated every interval
+    seconds. Returns the ready hosts, the others timed out."""
+    start = time.monotonic()
+    deadline = start + timeout
+    pending = set(hosts)
+    ready = set()
+    next_attempt = {host: start for host in pending}
+    attempts = 0
+    sel = selectors.DefaultSelector()
+
+    def _close(key, ok):
+        sel.unregister(key.fileobj)
+        key.fileobj.close()
+        if ok:
+            ready.add(key.data['host'])
+            pending.discard(key.data['host'])
+        else:
+            next_attempt[key.data['host']] = time.monotonic() + interval
+
+    try:
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            connecting = {key.data['host'] for key in sel.get_map().values()}
+            for host in pending - connecting:
+                if next_attempt[host] > now:
+                    continue
+                attempts += 1
+                sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET,
+                                     socket.SOCK_STREAM)
+                sock.setblocking(False)
+                try:
+                    sock.connect_ex((host, port))
+                except OSError:
+                    sock.close()
+                    next_attempt[host] = now + interval
+                    continue
+                sel.register(sock, selectors.EVENT_WRITE,
+                             {'host': host, 'started': now, 'banner': None})
+
+            # wake up for the next attempt or connection timeout
+            keys = list(sel.get_map().values())
+            wakeups = [deadline] + [key.data['started'] + CONNECT_TIMEOUT for key in keys]
+            wakeups += [next_attempt[host] for host in
+                        pending - {key.data['host'] for key in keys}]
+            for key, events in sel.select(max(min(wakeups) - time.monotonic(), 0)):
+                sock = key.fileobj
+                if key.data['banner'] is None:
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                        _close(key, False)
+                        continue
+                    key.data['banner'] = b''
+                    sel.modify(sock, selectors.EVENT_READ, key.data)
+                    continue
+                try:
+                    data = sock.recv(BANNER_MAX)
+                except OSError:
+                    data = b''
+                key.data['banner'] += data
+                if _banner(key.data['banner']):
+                    _close(key, True)
+                elif not data or len(key.data['banner']) >= BANNER_MAX:
+                    _close(key, False)
+
+            now = time.monotonic()
+            for key in list(sel.get_map().values()):
+                if now - key.data['started'] >= CONNECT_TIMEOUT:
+                    _close(key, False)
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
+        trace.count('polls', attempts)
+        print('Waited {:.1f}s for SSH on {} host(s) ({} ready, {} attempts)'.format(
+            time.monotonic() - start, len(ready) + len(pending), len(ready), attempts))
+    return ready
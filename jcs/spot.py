@@ -0,0 +1,84 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import clients
+from . import inventory
+from . import placement
+
+
+def replace(args, interruption, executor):
+    """take the node of an interrupted spot instance offline and launch a replacement
+
+    The replacement gets the same Jenkins name (the node is replaced when it
+    is online) and the image, type and labels recorded in the inventory. If
+    there is no spot capacity, an on-demand instance is launched. Returns
+    the new instance or None if the agent is not in the inventory."""
+    jenkins_name = interruption['jenkins_name']
+    try:
+        clients.jenkins(args).offline_node(
+            jenkins_name, 'Spot instance {} interrupted ({})'.format(interruption['id'],
+                                                                    interruption['code']))
+    except Exception as e:
+        print('Unable to take jenkins node {} offline: {}'.format(jenkins_name, e))
+    # the interrupted instance does not belong to the agent anymore
+    clients.aws(args, interruption['region']).ec2_instance_untag(
+        interruption['id'], ['jcs-jenkins-name', 'jcs-jenkins-url'])
+
+    agent = inventory.default().get(args.jenkins_url, jenkins_name)
+    if not agent:
+        print('Spot agent "{}" not in the inventory. Not replaced'.format(jenkins_name))
+        return None
+    agent_args = argparse.Namespace(**vars(args))
+    agent_args.cloud = 'ec2'
+    agent_args.aws_region_name = agent['region']
+    agent_args.image_name = agent['image']
+    agent_args.instance_type = agent['instance_type']
+    agent_args.labels = agent['labels'] or ''
+    agent_args.from_pool = False
+    targets = [placement.Target('ec2', agent_args)]
+    for spot in (True, False):
+        agent_args.spot = spot
+        result = placement.create(executor, agent_args, [jenkins_name], targets,
+                                  cooldown=0)[jenkins_name]
+        if not isinstance(result, placement.CapacityError):
+            break
+        print('No spot capacity for "{}". Replacing with an on-demand instance'.format(
+            jenkins_name))
+    if isinstance(result, Exception):
+        raise result
+    print('Spot agent "{}" replaced by {}'.format(jenkins_name, result['id']))
+    return result
+
+
+def watch(args, iterations=None):
+    """replace interrupted spot agents, checking every args.interval seconds
+
+    Checks --aws-region-name and the regions of the agents in the inventory.
+    The agents are replaced concurrently (there are about two minutes
+    between the interruption notice and the termination)."""
+    iteration = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor, \
+            ThreadPoolExecutor(max_workers=args.workers) as replacements:
+        while iterations is None or iteration < iterations:
+            iteration += 1
+            start = time.time()
+            # all regions with agents (see jcs create --placement)
+            regions = {agent['region'] for agent in inventory.default().ls(
+                args.jenkins_url, 'ec2')} | {args.aws_region_name}
+            interruptions = [dict(i, region=region) for region in sorted(regions)
+                             for i in clients.aws(args, region).ec2_spot_interruptions()
+                             if i['jenkins_url'] == args.jenkins_url]
+            futures = {}
+            for interruption in interruptions:
+                print('Spot instance {} of "{}" interrupted: {}'.format(
+                    interruption['id'], interruption['jenkins_name'], interruption['code']))
+                futures[interruption['jenkins_name']] = replacements.submit(
+                    replace, args, interruption, executor)
+            for jenkins_name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    print('Spot agent "{}" not replaced: {}'.format(jenkins_name, e))
+            if iterations is None or iteration < iterations:
+                time.sleep(max(args.interval - (time.time() - start), 0))
@@ -0,0 +1,159 @@
+import contextlib
+import contextvars
+import json
+import random
+import statistics
+import threading
+import time
+from typing import List, Optional
+
+
+# finished spans, oldest first (the daemon only keeps the latest)
+SPANS: List[dict] = []
+SPANS_MAX = 10000
+
+_current = contextvars.ContextVar('span', default=None)
+_lock = threading.Lock()
+# path of the JSON lines file the finished spans are appended to (per
+# context, so every daemon request has its own)
+_export_path = contextvars.ContextVar('export_path', default=None)
+
+
+def export_to(path: Optional[str]) -> None:
+    """append every finished span as JSON line to path (None to stop)"""
+    _export_path.set(path)
+
+
+def _id(bits):
+    return '{:0{}x}'.format(random.getrandbits(bits), bits // 4)
+
+
+def _attribute_value(value):
+    """an OTLP/JSON AnyValue (int64 values are strings in the JSON encoding)"""
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': '' if value is None else str(value)}
+
+
+def _export(span):
+    # field names as in the OpenTelemetry (OTLP/JSON) span format
+    line = json.dumps({
+        'traceId': span['trace_id'],
+        'spanId': span['span_id'],
+        'parentSpanId': span['parent_span_id'] or '',
+        'name': span['name'],
+        'startTimeUnixNano': int(span['start'] * 1e9),
+        'endTimeUnixNano': int((span['start'] + span['duration']) * 1e9),
+        'attributes': [{'key': key, 'value': _attribute_value(value)} for key, value in
+                       dict(span['attributes'], **span['counters']).items()],
+        'status': {'code': 'STATUS_CODE_OK' if span['status'] == 'ok'
+                   else 'STATUS_CODE_ERROR'},
+    })
+    try:
+        with open(_export_path.get(), 'a') as f:
+            f.write(line + '\n')
+    except OSError as e:
+        # tracing must not break the traced command
+        print('Unable to write trace to {}: {}'.format(_export_path.get(), e))
+        _export_path.set(None)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """time the block as a span (child of the current span)
+
+    Backend calls, retries and polls in the block are counted on the span
+    (see count()). The span is current in the block and in the steps of
+    graphs run from it."""
+    parent = _current.get()
+    current = {
+        'trace_id': parent['trace_id'] if parent else _id(128),
+        'span_id': _id(64),
+        'parent_span_id': parent['span_id'] if parent else None,
+        'name': name,
+        'attributes': attributes,
+        'counters': {},
+        'start': time.time(),
+    }
+    token = _current.set(current)
+    status = 'ok'
+    try:
+        yield current
+    except BaseException as e:
+        status = 'error'
+        current['attributes']['error'] = str(e)
+        raise
+    finally:
+        _current.reset(token)
+        current['duration'] = time.time() - current['start']
+        current['status'] = status
+        with _lock:
+            SPANS.append(current)
+            del SPANS[:-SPANS_MAX]
+            if _export_path.get():
+                _export(current)
+
+
+def count(counter: str, n: int = 1) -> None:
+    """add n to a counter (eg. calls) of the current span"""
+    current = _current.get()
+    if current is not None:
+        with _lock:
+            current['counters'][counter] = current['counters'].get(counter, 0) + n
+
+
+def botocore_hooks(client) -> None:
+    """count the API calls and the HTTP attempts (retries) of a boto3 client"""
+    client.meta.events.register('before-call', lambda **kwargs: count('calls'))
+    client.meta.events.register('before-send', lambda **kwargs: count('attempts'))
+
+
+def requests_hooks(session) -> None:
+    """count the HTTP requests of a requests session (eg. of jenkinsapi) as calls"""
+    def _hook(response, *args, **kwargs):
+        count('calls')
+        count('attempts')
+    session.hooks['response'].append(_hook)
+
+
+def summary(trace_id: str) -> List[dict]:
+    """the spans of the trace aggregated by name, slowest first
+
+    Returns a list of dicts (name, count, total, p50, p95, max, calls,
+    retries, polls)."""
+    with _lock:
+        spans = [s for s in SPANS if s['trace_id'] == trace_id]
+    names = {}
+    for s in spans:
+        names.setdefault(s['name'], []).append(s)
+    rows = []
+    for name, named in names.items():
+        durations = sorted(s['duration'] for s in named)
+        counters = {}
+        for s in named:
+            for counter, n in s['counters'].items():
+                counters[counter] = counters.get(counter, 0) + n
+        rows.append({
+            'name': name,
+            'count': len(named),
+            'total': sum(durations),
+            'p50': statistics.median(durations),
+            'p95': durations[min(int(len(durations) * 0.95), len(durations) - 1)],
+            'max': durations[-1],
+            'calls': counters.get('calls', 0),
+            'retries': counters.get('attempts', 0) - counters.get('calls', 0),
+            'polls': counters.get('polls', 0),
+        })
+    return sorted(rows, key=lambda r: r['max'], reverse=True)
+
+
+def print_summary(trace_id: str) -> None:
+    print('{:<24} {:>5} {:>9} {:>9} {:>9} {:>9} {:>6} {:>7} {:>6}'.format(
+        'phase', 'count', 'total s', 'p50 s', 'p95 s', 'max s', 'calls', 'retries', 'polls'))
+    for row in summary(trace_id):
+        print('{name:<24} {count:>5} {total:>9.2f} {p50:>9.2f} {p95:>9.2f} {max:>9.2f} '
+              '{calls:>6} {retries:>7} {polls:>6}'.format(**row))
@@ -0,0 +1,50 @@
+import random
+import time
+from typing import Callable, List, Optional
+
+from . import trace
+
+
+# timings of all finished waits (name, duration, checks, status)
+METRICS: List[dict] = []
+
+
+class WaitTimeout(Exception):
+    pass
+
+
+def wait_for(name: str, check: Callable[[], Optional[object]], timeout: float = 300,
+             delay: float = 1, max_delay: float = 15, factor: float = 2,
+             jitter: float = 0.3):
+    """call check() until it returns something else than None
+
+    The delay between two checks grows exponentially from delay up to
+    max_delay, with a random jitter (fraction of the delay) so that many
+    parallel waits do not poll in lockstep. check() raises to stop waiting
+    early (eg. for a terminal state). Raises WaitTimeout after timeout
+    seconds."""
+    start = time.monotonic()
+    deadline = start + timeout
+    checks = 0
+    status = 'error'
+    try:
+        while True:
+            checks += 1
+            result = check()
+            if result is not None:
+                status = 'ok'
+                return result
+            now = time.monotonic()
+            if now >= deadline:
+                status = 'timeout'
+                raise WaitTimeout('Waiting for {} timed out after {:.0f}s ({} checks)'.format(
+                    name, now - start, checks))
+            sleep = delay * (1 + random.uniform(-jitter, jitter))
+            time.sleep(min(sleep, deadline - now))
+            delay = min(delay * factor, max_delay)
+    finally:
+        duration = time.monotonic() - start
+        METRICS.append({'name': name, 'duration': duration, 'checks': checks,
+                        'status': status})
+        trace.count('polls', checks)
+        print('Waited {:.1f}s for {} ({} checks, {})'.format(duration, name, checks, status))
@@ -0,0 +1,93 @@
+import contextlib
+import fcntl
+import os
+import time
+
+from . import cache
+from . import clients
+from . import executor
+
+
+POOL_LOCK_FILE='pool.lock'
+
+
+def pool_key(args):
+    """the warm pool for the cloud, image, instance type and arch of args"""
+    return '{}:{}:{}:{}'.format(args.cloud, args.image_name, args.instance_type, args.arch)
+
+
+@contextlib.contextmanager
+def claim_lock():
+    """serialize taking instances out of the pools between jcs processes on this host"""
+    os.makedirs(cache.CACHE_DIR, exist_ok=True)
+    with open(os.path.join(cache.CACHE_DIR, POOL_LOCK_FILE), 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def claim(args, instance_names):
+    """take up to len(instance_names) ready instances out of the warm pool of args
+
+    Returns a list of dicts (id, name, ip)."""
+    with claim_lock():
+        if args.cloud == 'ec2':
+            return clients.aws(args).ec2_pool_claim(pool_key(args), len(instance_names))
+        if args.cloud == 'openstack':
+            return clients.openstack(args).os_pool_claim(
+                pool_key(args), instance_names, args.os_network_fixed, args.os_network_public,
+                meta={'jcs-jenkins-url': args.jenkins_url})
+
+
+def fill(args, size):
+    """start instances until the warm pool of args has size instances"""
+    if args.cloud == 'ec2':
+        return clients.aws(args).ec2_pool_fill(pool_key(args), size, args.image_name,
+                                               args.instance_type, args.key_name)
+    if args.cloud == 'openstack':
+        return clients.openstack(args).os_pool_fill(
+            pool_key(args), size, args.image_name, args.instance_type, args.key_name,
+            args.os_network_fixed, args.os_network_public, args.os_security_groups)
+
+
+def fill_background(args, size):
+    """refill the warm pool in a thread (the process waits for it before exiting)"""
+    def _fill():
+        try:
+            fill(args, size)
+        except Exception as e:
+            print('Pool {} refill failed: {}'.format(pool_key(args), e))
+
+    # the output goes where the output of the command goes (eg. a daemon client)
+    thread = executor.thread(_fill, name='jcs-pool-refill')
+    thread.start()
+    return thread
+
+
+def ls(args):
+    """get all instances of all warm pools of the cloud
+
+    Returns a list of dicts (pool, id, state, since)."""
+    if args.cloud == 'ec2':
+        return [{'pool': i['pool'], 'id': i['id'], 'state': i['state'], 'since': i['since']}
+                for i in clients.aws(args).ec2_pool_instances()]
+    if args.cloud == 'openstack':
+        return [{'pool': s['pool'], 'id': s['name'], 'state': s['status'], 'since': s['since']}
+                for s in clients.openstack(args).os_pool_servers()]
+
+
+def reap(args, max_idle):
+    """delete the instances which are idle in a warm pool for more than max_idle seconds"""
+    now = time.time()
+    idle = [i for i in ls(args) if now - i['since'] > max_idle]
+    if not idle:
+        return []
+    if args.cloud == 'ec2':
+        clients.aws(args).ec2_instances_delete([i['id'] for i in idle])
+    elif args.cloud == 'openstack':
+        client = clients.openstack(args)
+        for instance in idle:
+            client.os_instance_delete(instance['id'])
+    return idle
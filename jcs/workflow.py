@@ -0,0 +1,376 @@
+import fnmatch
+import random
+import string
+from typing import Dict, List, Optional
+
+from . import clients
+from . import gc
+from . import inventory
+from . import jen
+from . import orchestrate
+from . import ready
+from . import warmpool
+from .placement import CapacityError
+
+
+def _instance_name_random():
+    return 'jcs-' + ''.join(random.choice(string.ascii_lowercase) for i in range(10))
+
+
+def jenkins_connect(graph: orchestrate.Graph, args) -> str:
+    """add the step connecting to Jenkins (once per graph)"""
+    if 'jenkins' not in graph:
+        graph.add('jenkins', lambda: clients.jenkins(args).connect())
+    return 'jenkins'
+
+
+def aws_connect(graph: orchestrate.Graph, args) -> str:
+    if 'ec2-client' not in graph:
+        graph.add('ec2-client', lambda: clients.aws(args))
+    return 'ec2-client'
+
+
+def openstack_connect(graph: orchestrate.Graph, args) -> str:
+    if 'os-client' not in graph:
+        graph.add('os-client', lambda: clients.openstack(args))
+    return 'os-client'
+
+
+def _ssh_ready(args, hosts):
+    """wait for sshd on the hosts (if --ssh-timeout). Returns the ready hosts"""
+    hosts = [host for host in hosts if host]
+    if not args.ssh_timeout:
+        return set(hosts)
+    return ready.wait_ssh(hosts, timeout=args.ssh_timeout)
+
+
+def _ssh_check(args, instance, ready_hosts, terminate):
+    """fail the agent if sshd does not answer on the instance (and terminate it)"""
+    # Jenkins does not retry launching the agent (max_num_retries 0)
+    if instance['ip'] and instance['ip'] not in ready_hosts:
+        # the agent is not in the inventory, so nothing would delete the instance
+        try:
+            terminate([instance['id']])
+            print('Instance {} terminated'.format(instance['name']))
+        except Exception as e:
+            print('Unable to terminate instance {}: {}'.format(instance['name'], e))
+        raise Exception('SSH on instance {} ({}) not reachable after {}s'.format(
+            instance['name'], instance['ip'], args.ssh_timeout))
+    return instance
+
+
+def _raise_failed(*results):
+    """raise the first exception of the results of partial dependencies"""
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+def _pool_claim(graph, args, instance_names, name):
+    """add the step taking instances out of the warm pool (if --from-pool)"""
+    def _claim():
+        if not args.from_pool:
+            return []
+        return warmpool.claim(args, instance_names)
+
+    return graph.add(name, _claim)
+
+
+def _create_instances_ec2(graph, args, jenkins_names, image_source_region=None):
+    client = aws_connect(graph, args)
+    instance_names = [_instance_name_random() for _ in jenkins_names]
+    tags = [{'jcs-jenkins-name': jenkins_name, 'jcs-jenkins-url': args.jenkins_url}
+            for jenkins_name in jenkins_names]
+    _pool_claim(graph, args, instance_names, 'ec2-pool')
+
+    def _image(c):
+        try:
+            return c.ec2_image_lookup(args.image_name)
+        except Exception:
+            if not image_source_region or image_source_region == args.aws_region_name:
+                raise
+        return c.ec2_image_copy(args.image_name, image_source_region)
+
+    graph.add('ec2-image', _image, [client])
+
+    def _run(c, image_id, pooled):
+        # only launch the instances the pool could not provide
+        if len(pooled) >= len(instance_names):
+            return []
+        return c.ec2_instances_run(image_id, args.instance_type, args.key_name,
+                                   instance_names[len(pooled):], spot=args.spot,
+                                   spot_max_price=args.spot_max_price)
+
+    graph.add('ec2-run', _run, [client, 'ec2-image', 'ec2-pool'])
+    # the claimed instances are not in the pool anymore. They are tagged even if
+    # launching the others fails, so they are not lost (gc, inventory)
+    graph.add('ec2-pool-tags', lambda c, pooled: c.ec2_instances_tag(
+        [p['id'] for p in pooled], tags), [client, 'ec2-pool'])
+    # tagging does not need to wait for the instances to be running
+    graph.add('ec2-tags', lambda c, pooled, ids: c.ec2_instances_tag(
+        ids, tags[len(pooled):]), [client, 'ec2-pool', 'ec2-run'])
+    graph.add('ec2-running', lambda c, ids: c.ec2_instances_wait_running(ids),
+              [client, 'ec2-run'])
+
+    def _ssh(pooled, ips):
+        _raise_failed(pooled)
+        # all instances are probed at once (only the pooled ones if launching failed)
+        launched = [] if isinstance(ips, Exception) else [
+            ip for ip in ips.values() if not isinstance(ip, Exception)]
+        return _ssh_ready(args, [p['ip'] for p in pooled] + launched)
+
+    graph.add('ec2-ssh', _ssh, ['ec2-pool', 'ec2-running'], partial=True)
+
+    steps = {}
+    for i, jenkins_name in enumerate(jenkins_names):
+        def _instance(c, pooled, ids, ips, tagged, pool_tagged, ready_hosts, i=i):
+            _raise_failed(c, pooled, ready_hosts)
+            if i < len(pooled):
+                _raise_failed(pool_tagged)
+                return _ssh_check(args, pooled[i], ready_hosts, c.ec2_instances_delete)
+            _raise_failed(ids, ips, tagged)
+            if i - len(pooled) >= len(ids):
+                raise CapacityError('EC2 {} {}: instance not launched'.format(
+                    args.aws_region_name, args.instance_type))
+            instance_id = ids[i - len(pooled)]
+            if isinstance(ips[instance_id], Exception):
+                # only this agent fails, the other instances are running
+                raise ips[instance_id]
+            return _ssh_check(args, {'id': instance_id, 'name': instance_id,
+                                     'ip': ips[instance_id]}, ready_hosts,
+                              c.ec2_instances_delete)
+
+        # the agents of pooled instances do not fail if launching the others fails
+        steps[jenkins_name] = graph.add('instance:{}'.format(jenkins_name), _instance,
+                                        [client, 'ec2-pool', 'ec2-run', 'ec2-running', 'ec2-tags',
+                                         'ec2-pool-tags', 'ec2-ssh'], partial=True)
+    return steps
+
+
+def _create_instances_openstack(graph, args, jenkins_names):
+    client = openstack_connect(graph, args)
+    instance_names = ['jcs-{}'.format(jenkins_name) for jenkins_name in jenkins_names]
+    _pool_claim(graph, args, instance_names, 'os-pool')
+    # the lookups are independent of each other
+    graph.add('os-image', lambda c: c.os_image_get(args.image_name), [client])
+    graph.add('os-flavor', lambda c: c.os_flavor_get(args.instance_type), [client])
+    graph.add('os-network', lambda c: c.os_network_get(args.os_network_fixed), [client])
+
+    steps = {}
+    for i, jenkins_name in enumerate(jenkins_names):
+        def _instance(c, pooled, image, flavor, network, i=i):
+            if i < len(pooled):
+                instance = pooled[i]
+            else:
+                instance_id, instance_ip = c.os_server_create(
+                    instance_names[i], image, flavor, args.key_name, network,
+                    args.os_network_public, args.os_security_groups,
+                    meta={'jcs-jenkins-url': args.jenkins_url})
+                instance = {'id': instance_id, 'name': instance_names[i], 'ip': instance_ip}
+            # every server is ready at another time
+            return _ssh_check(args, instance, _ssh_ready(args, [instance['ip']]),
+                              c.os_servers_delete)
+
+        steps[jenkins_name] = graph.add('instance:{}'.format(jenkins_name), _instance,
+                                        [client, 'os-pool', 'os-image', 'os-flavor',
+                                         'os-network'])
+    return steps
+
+
+def create(graph: orchestrate.Graph, args, jenkins_names, image_source_region=None):
+    """add the steps to create an agent (instance and Jenkins node) per jenkins name
+
+    Returns a dict with jenkins name: name of the final step. The final step
+    returns the instance (dict with id, name, ip). The Jenkins nodes of all
+    instances are registered together once sshd answers on them (see
+    --ssh-timeout). The agents are recorded in the inventory. On EC2, an image which is missing
+    in the region is copied from image_source_region."""
+    jenkins = jenkins_connect(graph, args)
+    if args.cloud == 'ec2':
+        instances = _create_instances_ec2(graph, args, jenkins_names, image_source_region)
+    elif args.cloud == 'openstack':
+        instances = _create_instances_openstack(graph, args, jenkins_names)
+
+    def _nodes(jen_client, *created):
+        if isinstance(jen_client, Exception):
+            raise jen_client
+        # the agents of failed instances fail in their own steps
+        nodes = [{'hostname': instance['ip'], 'name': jenkins_name,
+                  'description': 'Running on AWS ({}, {}, {})'.format(
+                      instance['ip'], instance['name'], args.cloud),
+                  'credential': args.jenkins_credential, 'labels': args.labels}
+                 for jenkins_name, instance in zip(jenkins_names, created)
+                 if not isinstance(instance, Exception)]
+        return jen_client.create_nodes(nodes)
+
+    # all nodes of the graph are registered and polled together
+    nodes = graph.add('nodes-create', _nodes,
+                      [jenkins] + [instances[jenkins_name] for jenkins_name in jenkins_names],
+                      partial=True)
+
+    steps = {}
+    for jenkins_name in jenkins_names:
+        def _node(instance, results, jenkins_name=jenkins_name):
+            if results[jenkins_name] is not None:
+                raise results[jenkins_name]
+            inventory.default().add(
+                args.jenkins_url, jenkins_name, args.cloud,
+                region=args.aws_region_name if args.cloud == 'ec2' else args.os_cloud,
+                instance_id=instance['id'], instance_name=instance['name'],
+                ip=instance['ip'], image=args.image_name, instance_type=args.instance_type,
+                labels=args.labels, state='running')
+            return instance
+
+        steps[jenkins_name] = graph.add('node:{}'.format(jenkins_name), _node,
+                                        [instances[jenkins_name], nodes])
+    return steps
+
+
+def delete_targets(args, patterns, label=None) -> List[str]:
+    """get the names of the agents to delete
+
+    Names without wildcards are taken as they are. Glob patterns (see
+    fnmatch) and the label match the agents of args.jenkins_url which were
+    created by jcs (in the inventory or with a jcs node description), so
+    other Jenkins nodes are never deleted by a pattern."""
+    names = [p for p in patterns if not any(c in p for c in '*?[')]
+    globs = [p for p in patterns if p not in names]
+    if globs or label:
+        agents = {}
+        for agent in inventory.default().ls(args.jenkins_url):
+            agents[agent['jenkins_name']] = (agent['labels'] or '').split()
+        for node in clients.jenkins(args).nodes_usage():
+            if node['name'] in agents or gc.NODE_DESCRIPTION.match(node['description']):
+                agents[node['name']] = node['labels']
+        for name, labels in agents.items():
+            if name in names:
+                continue
+            if (not globs or any(fnmatch.fnmatchcase(name, g) for g in globs)) and \
+                    (not label or label in labels):
+                names.append(name)
+    return names
+
+
+def _instances_delete(graph, args, jenkins_names, drain):
+    """add the steps terminating the instances of the agents (batched per region)
+
+    Agents in the inventory are deleted by their instance id in the region
+    (or OpenStack cloud) they were created in. If that instance is gone, the
+    agent is searched by tags (EC2) or name (OpenStack) there, as it might
+    have been recreated by jcs on another host. Returns a dict with jenkins
+    name: name of the step. The steps return the set of jenkins names with a
+    deleted instance and skip the agents which are not drained."""
+    agents = {name: inventory.default().get(args.jenkins_url, name) for name in jenkins_names}
+    steps = {}
+
+    def _ec2_region(drained, region, names):
+        c = clients.aws(args, region)
+        names = [n for n in names if n in drained]
+        alive = c.ec2_instances_alive([agents[n]['instance_id'] for n in names])
+        found = {n: agents[n]['instance_id'] for n in names
+                 if agents[n]['instance_id'] in alive}
+        missing = set(names) - set(found)
+        if missing:
+            for i in c.ec2_jcs_instances({'jcs-jenkins-url': args.jenkins_url}):
+                if i['jenkins_name'] in missing:
+                    found[i['jenkins_name']] = i['id']
+        c.ec2_instances_delete(list(found.values()))
+        return set(found)
+
+    def _os_cloud(drained, cloud, names):
+        c = clients.openstack(args, cloud)
+        names = [n for n in names if n in drained]
+        servers = c.os_jcs_servers()
+        ids = {s['id'] for s in servers}
+        found = {n: agents[n]['instance_id'] for n in names if agents[n]['instance_id'] in ids}
+        missing = {'jcs-{}'.format(n): n for n in names if n not in found}
+        for server in servers:
+            if server['name'] in missing:
+                found[missing[server['name']]] = server['id']
+        c.os_servers_delete(list(found.values()))
+        return set(found)
+
+    def _ec2_search(c, drained, names):
+        instances = c.ec2_jcs_instances({'jcs-jenkins-url': args.jenkins_url})
+        found = [i for i in instances if i['jenkins_name'] in set(names) & drained]
+        c.ec2_instances_delete([i['id'] for i in found])
+        return {i['jenkins_name'] for i in found}
+
+    def _os_search(c, drained, names):
+        servers = {'jcs-{}'.format(n): n for n in names if n in drained}
+        found = [s for s in c.os_jcs_servers() if s['name'] in servers]
+        c.os_servers_delete([s['id'] for s in found])
+        return {servers[s['name']] for s in found}
+
+    regions = {}
+    for name, agent in agents.items():
+        if agent:
+            regions.setdefault((agent['cloud'], agent['region']), []).append(name)
+    for (cloud, region), names in regions.items():
+        if cloud == 'ec2':
+            step = graph.add('instances-delete:ec2 {}'.format(region),
+                             lambda d, region=region, names=names: _ec2_region(d, region, names),
+                             [drain])
+        else:
+            step = graph.add('instances-delete:openstack {}'.format(region),
+                             lambda d, region=region, names=names: _os_cloud(d, region, names),
+                             [drain])
+        steps.update({name: step for name in names})
+
+    # agents which are not in the inventory, searched by tags (EC2) or name (OpenStack)
+    names = [n for n, agent in agents.items() if not agent]
+    if names and args.cloud == 'ec2':
+        step = graph.add('instances-delete:ec2 search',
+                         lambda c, d: _ec2_search(c, d, names),
+                         [aws_connect(graph, args), drain])
+        steps.update({name: step for name in names})
+    if names and args.cloud == 'openstack':
+        step = graph.add('instances-delete:openstack search',
+                         lambda c, d: _os_search(c, d, names),
+                         [openstack_connect(graph, args), drain])
+        steps.update({name: step for name in names})
+    return steps
+
+
+def delete(graph: orchestrate.Graph, args, jenkins_names,
+           drain_timeout: Optional[float] = jen.DRAIN_TIMEOUT) -> Dict[str, str]:
+    """add the steps to delete the agents (Jenkins nodes and instances)
+
+    The Jenkins nodes are taken offline first and the running builds are
+    waited for (at most drain_timeout seconds, None does not drain). Agents
+    with running builds after that are kept (back online). Then all instances
+    are terminated at once, without waiting for them to be gone, and the
+    Jenkins nodes are removed (best effort). Agents in the inventory are
+    deleted by their instance id, others are searched by tags (EC2) or name
+    (OpenStack). Returns a dict with jenkins name: name of the final step."""
+    jenkins_names = list(jenkins_names)
+    jenkins = jenkins_connect(graph, args)
+    if drain_timeout is None:
+        drain = graph.add('drain', lambda: set(jenkins_names))
+    else:
+        drain = graph.add('drain', lambda c: c.drain_nodes(jenkins_names, drain_timeout),
+                          [jenkins])
+
+    def _nodes(jen_client, drained):
+        index = jen_client.node_index()
+        try:
+            jen_client.delete_nodes([n for n in jenkins_names if n in drained and n in index])
+        except Exception as e:
+            print('Unable to remove jenkins nodes: {}'.format(e))
+
+    graph.add('nodes-delete', _nodes, [jenkins, drain])
+
+    instances = _instances_delete(graph, args, jenkins_names, drain)
+    steps = {}
+    for jenkins_name in jenkins_names:
+        def _forget(drained, deleted, jenkins_name=jenkins_name):
+            if jenkins_name not in drained:
+                raise Exception('Jenkins node "{}" has running builds. Not deleted'.format(
+                    jenkins_name))
+            if jenkins_name not in deleted:
+                print('No instance found for agent "{}"'.format(jenkins_name))
+            inventory.default().remove(args.jenkins_url, jenkins_name)
+
+        steps[jenkins_name] = graph.add('instance-delete:{}'.format(jenkins_name), _forget,
+                                        [drain, instances[jenkins_name]])
+    return steps
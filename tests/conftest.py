@@ -0,0 +1,76 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the fake clients and the image server of the benchmarks
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import fakes  # noqa: E402
+import imageserver  # noqa: E402
+
+import jcs  # noqa: E402
+from jcs import cache, clients, inventory, lookup, obs  # noqa: E402
+from tests import jenkinsserver  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    """a fresh ~/.cache/jcs (image cache, inventory and lookup cache) per test"""
+    cache_dir = str(tmp_path / 'cache')
+    monkeypatch.setenv('HOME', str(tmp_path))
+    for var in ('JCS_CACHE_QUOTA', 'JCS_DAEMON_SOCKET', 'JCS_TRACE', 'JENKINS_URL'):
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.setattr(cache, 'CACHE_DIR', cache_dir)
+    monkeypatch.setattr(obs, 'CACHE_DIR', cache_dir)
+    monkeypatch.setattr(inventory, '_default', inventory.Inventory(
+        os.path.join(cache_dir, inventory.INVENTORY_FILE)))
+    monkeypatch.setattr(lookup, '_default', lookup.LookupCache(
+        os.path.join(cache_dir, lookup.LOOKUP_FILE)))
+    return tmp_path
+
+
+@pytest.fixture
+def aws_env(monkeypatch):
+    """fake credentials for moto"""
+    for var, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                       ('AWS_SESSION_TOKEN', 'testing'), ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(var, value)
+
+
+@pytest.fixture
+def fake_clouds(monkeypatch):
+    """the fake AWS, OpenStack and Jenkins clients (no latency)
+
+    Returns the fakes (aws, openstack, jenkins)."""
+    for name in ('aws', 'openstack', 'jenkins'):
+        monkeypatch.setattr(clients, name, getattr(clients, name))
+    return fakes.install(fakes.Backend(latency=0, jitter=0, seed=0), boot_time=0,
+                         online_time=0)
+
+
+@pytest.fixture
+def image_server(tmp_path):
+    """a local HTTP server for images in tmp_path/images"""
+    root = tmp_path / 'images'
+    root.mkdir()
+    with imageserver.ImageServer(str(root)) as server:
+        server.root = str(root)
+        yield server
+
+
+@pytest.fixture
+def jenkins_server():
+    """a local fake Jenkins HTTP server"""
+    with jenkinsserver.JenkinsServer() as server:
+        yield server
+
+
+def parse(*argv):
+    """the parsed jcs command line (with a Jenkins url)"""
+    return jcs._parser().parse_args(['--jenkins-url', 'http://jenkins.invalid'] + list(argv))
+
+
+def run(*argv):
+    jcs._run(parse(*argv))
@@ -0,0 +1,165 @@
+"""Local HTTP server for the Jenkins API used by JenkinsClient
+
+Answers what jenkinsapi needs to connect (version header, crumb, plugins,
+credentials) and the computer API: the node list, single nodes, doCreateItem,
+toggleOffline and doDelete. POSTs need the crumb. New nodes come online
+after online_polls polls of the node.
+"""
+
+import collections
+import http.server
+import json
+import threading
+import urllib.parse
+
+CRUMB = 'crumb'
+CREDENTIAL_ID = 'credential-id'
+CREDENTIAL_DESCRIPTION = 'credential'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, data=None):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Jenkins', '2.400')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, request):
+        with self.server.lock:
+            self.server.requests[request] += 1
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        server = self.server
+        if path == '/':
+            return self._reply(200)
+        if path == '/api/python':
+            return self._reply(200, {'jobs': [], 'views': [],
+                                     'primaryView': {'name': 'all', 'url': ''}})
+        if path in ('/crumbIssuer/api/json', '/crumbIssuer/api/python'):
+            return self._reply(200, {'crumbRequestField': 'Jenkins-Crumb', 'crumb': CRUMB})
+        if path == '/pluginManager/api/python':
+            return self._reply(200, {'plugins': [{
+                'shortName': 'credentials', 'longName': 'Credentials', 'version': '2.3',
+                'url': '', 'active': True, 'enabled': True, 'hasUpdate': False,
+                'pinned': False, 'bundled': False, 'deleted': False, 'downgradable': False,
+                'dependencies': [], 'backupVersion': None, 'supportsDynamicLoad': 'MAYBE'}]})
+        if path == '/credentials/store/system/domain/_/api/python':
+            return self._reply(200, {'credentials': [{
+                'id': CREDENTIAL_ID, 'description': CREDENTIAL_DESCRIPTION,
+                'typeName': 'SSH Username with private key', 'displayName': '',
+                'fullName': ''}]})
+        if path == '/computer/api/json':
+            self._count('nodes')
+            with server.lock:
+                for node in server.nodes.values():
+                    server.poll(node)
+                return self._reply(200, {'computer': [{
+                    'displayName': name, 'description': node['description'],
+                    'offline': node['offline'], 'idle': node['idle'], 'numExecutors': 1,
+                    'assignedLabels': [{'name': label} for label in node['labels'].split()],
+                } for name, node in server.nodes.items()]})
+        parts = path.split('/')
+        if len(parts) == 5 and parts[1] == 'computer' and parts[3:] == ['api', 'json']:
+            self._count('node')
+            with server.lock:
+                node = server.nodes.get(urllib.parse.unquote(parts[2]))
+                if node is None:
+                    return self._reply(404)
+                server.poll(node)
+                return self._reply(200, {'offline': node['offline']})
+        self._reply(404)
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Jenkins-Crumb') != CRUMB:
+            return self._reply(403)
+        server = self.server
+        if url.path == '/computer/doCreateItem':
+            self._count('create')
+            params = urllib.parse.parse_qs(url.query)
+            config = json.loads(params['json'][0])
+            with server.lock:
+                if params['name'][0] in server.nodes:
+                    return self._reply(400)
+                server.nodes[params['name'][0]] = {
+                    'description': config['nodeDescription'],
+                    'labels': config['labelString'] or '', 'offline': True, 'idle': True,
+                    'host': config['launcher']['host'],
+                    'credential': config['launcher']['credentialsId'], 'polls': 0}
+            return self._reply(200)
+        parts = url.path.split('/')
+        if len(parts) == 4 and parts[1] == 'computer' and \
+                parts[3] in ('doDelete', 'toggleOffline'):
+            self._count(parts[3])
+            name = urllib.parse.unquote(parts[2])
+            with server.lock:
+                if name not in server.nodes:
+                    return self._reply(404)
+                if parts[3] == 'doDelete':
+                    del server.nodes[name]
+                else:
+                    server.nodes[name]['offline'] = not server.nodes[name]['offline']
+            return self._reply(200)
+        self._reply(404)
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    def poll(self, node):
+        # new nodes come online after some polls (like a launching agent)
+        if node['polls'] is not None:
+            node['polls'] += 1
+            if node['polls'] >= self.online_polls:
+                node['offline'] = False
+                node['polls'] = None
+
+
+class JenkinsServer:
+    """serve a fake Jenkins on 127.0.0.1 (a random port) in a background thread
+
+    nodes are the Jenkins nodes by name (dicts with description, labels,
+    offline, idle), requests counts the requests by kind (nodes, node,
+    create, toggleOffline, doDelete)."""
+    def __init__(self, online_polls=2):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.lock = threading.Lock()
+        self._server.nodes = {}
+        self._server.requests = collections.Counter()
+        self._server.online_polls = online_polls
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    @property
+    def nodes(self):
+        return self._server.nodes
+
+    @property
+    def requests(self):
+        return self._server.requests
+
+    def add_node(self, name, description='', labels='', offline=False, idle=True):
+        """add a node (as another client would)"""
+        with self._server.lock:
+            self._server.nodes[name] = {'description': description, 'labels': labels,
+                                        'offline': offline, 'idle': idle, 'polls': None}
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,101 @@
+import time
+
+from jcs import autoscale
+
+from tests.conftest import parse
+
+
+def _node(name, label='label', idle=True, offline=False):
+    return {'name': name, 'labels': [label], 'idle': idle, 'offline': offline}
+
+
+def _item(label='label', since=0):
+    return {'id': 1, 'name': 'job', 'label': label, 'since': since}
+
+
+def test_decide_scale_out():
+    create, delete, _ = autoscale.decide([_item()] * 3, [_node('jcs-auto-1')], {}, 100,
+                                         ['label'], 'jcs-auto', queue_wait=60)
+    # one of the items is picked up by the idle agent
+    assert create == {'label': 2} and delete == []
+
+
+def test_decide_queue_wait_and_max():
+    assert autoscale.decide([_item(since=90)], [], {}, 100, ['label'], 'jcs-auto',
+                            queue_wait=60)[0] == {}
+    nodes = [_node('jcs-auto-{}'.format(i), idle=False) for i in range(3)]
+    assert autoscale.decide([_item()] * 5, nodes, {}, 100, ['label'], 'jcs-auto',
+                            max_agents=4)[0] == {'label': 1}
+
+
+def test_decide_scale_in():
+    nodes = [_node('jcs-auto-1'), _node('jcs-auto-2'), _node('other')]
+    create, delete, idle_since = autoscale.decide([], nodes, {}, 100, ['label'], 'jcs-auto',
+                                                  min_agents=1, idle_cooldown=600)
+    assert delete == [] and idle_since == {'jcs-auto-1': 100, 'jcs-auto-2': 100}
+    create, delete, idle_since = autoscale.decide([], nodes, idle_since, 700, ['label'],
+                                                  'jcs-auto', min_agents=1, idle_cooldown=600)
+    assert create == {} and len(delete) == 1
+
+
+def test_decide_offline_agents():
+    # an offline agent is no capacity for the queue, but is deleted after the cooldown
+    nodes = [_node('jcs-auto-1', offline=True)]
+    create, delete, idle_since = autoscale.decide([_item()], nodes, {}, 100, ['label'],
+                                                  'jcs-auto', max_agents=1, idle_cooldown=0)
+    assert create == {} and delete == ['jcs-auto-1']
+    create, delete, _ = autoscale.decide([_item()], [], idle_since, 100, ['label'],
+                                         'jcs-auto', max_agents=1)
+    assert create == {'label': 1}
+
+
+def _autoscale(*argv):
+    return parse('autoscale', '--label', 'label', '--queue-wait', '0', '--idle-cooldown', '0',
+                 '--interval', '0', '--ssh-timeout', '0', *argv, 'image-name')
+
+
+def test_converge(fake_clouds):
+    aws, _, jenkins = fake_clouds
+    jenkins.queue = [_item(since=time.time()) for _ in range(5)]
+    start = time.time()
+    autoscale.run(_autoscale('--max', '3'), iterations=1)
+    assert len(jenkins.nodes) == 3 and len(aws.instances) == 3
+    # the agents took three builds, the other two wait
+    for node in jenkins.nodes.values():
+        node['idle'] = False
+    jenkins.queue = jenkins.queue[3:]
+    autoscale.run(_autoscale('--max', '3'), iterations=1)
+    assert len(jenkins.nodes) == 3
+    # all builds are done: the agents are deleted
+    jenkins.queue = []
+    for node in jenkins.nodes.values():
+        node['idle'] = True
+    autoscale.run(_autoscale('--max', '3'), iterations=1)
+    assert not jenkins.nodes and not aws.instances
+    # without latency the fakes converge at once
+    assert time.time() - start < 5
+
+
+def test_offline_agents_replaced(fake_clouds):
+    aws, _, jenkins = fake_clouds
+    jenkins.queue = [_item(since=time.time())]
+    autoscale.run(_autoscale('--max', '1'), iterations=1)
+    instance_ids = set(aws.instances)
+    for node in jenkins.nodes.values():
+        node['offline'] = True
+    autoscale.run(_autoscale('--max', '1'), iterations=2)
+    # the offline agent was deleted and a new one created for the item
+    assert len(jenkins.nodes) == 1 and len(aws.instances) == 1
+    assert not instance_ids & set(aws.instances)
+
+
+def test_busy_agent_kept_online(fake_clouds):
+    aws, _, jenkins = fake_clouds
+    jenkins.queue = [_item(since=time.time())]
+    autoscale.run(_autoscale('--max', '1'), iterations=1)
+    name, = jenkins.nodes
+    # a build started after the agent was seen idle
+    jenkins.nodes[name]['idle'] = False
+    results = autoscale.scale(_autoscale(), {}, [name], time.time())
+    assert isinstance(results[name], Exception)
+    assert not jenkins.nodes[name]['offline'] and len(aws.instances) == 1
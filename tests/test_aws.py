@@ -0,0 +1,101 @@
+import os
+
+import pytest
+from moto import mock_aws
+
+from jcs import aws
+
+
+@pytest.fixture
+def client(aws_env):
+    with mock_aws():
+        c = aws.AWSClient(None, None, 'us-east-1')
+        c._ec2_client.create_key_pair(KeyName='key')
+        yield c
+
+
+def _image_id(client):
+    return client._ec2_client.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+
+
+def _instances(client, count):
+    resp = client._ec2_client.run_instances(ImageId=_image_id(client), InstanceType='t3.micro',
+                                            KeyName='key', MinCount=count, MaxCount=count)
+    return [i['InstanceId'] for i in resp['Instances']]
+
+
+def test_wait_running_per_instance(client):
+    ids = _instances(client, 3)
+    client._ec2_client.terminate_instances(InstanceIds=[ids[1]])
+    ips = client.ec2_instances_wait_running(ids)
+    assert isinstance(ips[ids[1]], Exception) and 'terminated' in str(ips[ids[1]])
+    assert all(isinstance(ips[i], str) for i in (ids[0], ids[2]))
+
+
+def test_instance_create_terminated(client, monkeypatch):
+    tag = client.ec2_instances_tag
+
+    def _tag(instance_ids, tags):
+        tag(instance_ids, tags)
+        client._ec2_client.terminate_instances(InstanceIds=instance_ids)
+    monkeypatch.setattr(client, 'ec2_instances_tag', _tag)
+    monkeypatch.setattr(client, 'ec2_image_lookup', lambda name: _image_id(client))
+    with pytest.raises(Exception, match='is terminated'):
+        client.ec2_instance_create('name', 't3.micro', 'image', 'key')
+
+
+def test_instances_alive(client):
+    ids = _instances(client, 3)
+    client._ec2_client.terminate_instances(InstanceIds=[ids[0]])
+    assert client.ec2_instances_alive(ids + ['i-00000000000000000']) == set(ids[1:])
+
+
+def test_instances_delete_unknown(client, capsys):
+    ids = _instances(client, 3)
+    # a stale inventory id fails the whole terminate_instances batch
+    client.ec2_instances_delete(ids[:2] + ['i-00000000000000000'])
+    assert 'EC2 instance "i-00000000000000000" not found' in capsys.readouterr().out
+    assert client.ec2_instances_alive(ids) == {ids[2]}
+
+
+def _raw_image(path, size, data_at):
+    """a sparse raw image with random data at the offsets. Returns its content"""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        for offset in data_at:
+            f.seek(offset)
+            f.write(os.urandom(1000))
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_ebs_snapshot_create(client, tmp_path):
+    block = aws.EBS_BLOCK_SIZE
+    path = str(tmp_path / 'image.raw')
+    # the second block ends with data, the last block is shorter
+    data = _raw_image(path, 5 * block + 4096, [2 * block - 10, 5 * block])
+    snapshot_id = client.ebs_snapshot_create(path, 'image')
+    blocks = client._ebs_client.list_snapshot_blocks(SnapshotId=snapshot_id)['Blocks']
+    # only the blocks with data are uploaded
+    assert sorted(b['BlockIndex'] for b in blocks) == [1, 2, 5]
+    for b in blocks:
+        index = b['BlockIndex']
+        resp = client._ebs_client.get_snapshot_block(
+            SnapshotId=snapshot_id, BlockIndex=b['BlockIndex'], BlockToken=b['BlockToken'])
+        expected = data[index * block:(index + 1) * block]
+        assert resp['BlockData'].read() == expected + bytes(block - len(expected))
+    snapshot = client._ec2_client.describe_snapshots(SnapshotIds=[snapshot_id])['Snapshots'][0]
+    assert snapshot['State'] == 'completed' and snapshot['VolumeSize'] == 1
+
+
+def test_ec2_image_create_ebs(client, tmp_path):
+    path = str(tmp_path / 'image.raw')
+    _raw_image(path, aws.EBS_BLOCK_SIZE, [0])
+    created = client.ec2_image_create(path, 'x86_64', backend='ebs', tags={'k': 'v'})
+    assert created['image_name'] == 'image'
+    assert client.ec2_image_lookup('image') == created['image_id']
+    assert client.ec2_image_find('image')['tags'] == {'k': 'v'}
+    # the image exists now
+    assert client.ec2_image_create(path, 'x86_64', backend='ebs') == created
+    with pytest.raises(Exception, match='needs a raw image'):
+        client.ebs_snapshot_create(path + '.xz', 'image')
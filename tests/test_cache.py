@@ -0,0 +1,140 @@
+import fcntl
+import hashlib
+import itertools
+import os
+import threading
+
+import pytest
+
+from jcs import cache
+
+from tests.conftest import run
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """a time.time() of the cache which ticks one second per call"""
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(cache.time, 'time', lambda: next(ticks))
+
+
+def _add(image_cache, url, data):
+    path = os.path.join(image_cache.tmp_dir, 'download')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return image_cache.add(url, path, hashlib.sha256(data).hexdigest(), {'etag': '"e"'})
+
+
+def test_quota_parse():
+    assert cache.ImageCache(quota='1K').quota == 1024
+    assert cache.ImageCache(quota=10).quota == 10
+    assert cache.ImageCache().quota == cache.size_parse(cache.QUOTA)
+
+
+def test_same_content_hardlinked():
+    image_cache = cache.ImageCache()
+    path1 = _add(image_cache, 'http://a/x/image.raw.xz', b'content')
+    path2 = _add(image_cache, 'http://b/y/other.raw.xz', b'content')
+    assert os.path.basename(path1) == 'image.raw.xz'
+    assert os.path.basename(path2) == 'other.raw.xz'
+    st = os.stat(image_cache.blob_path(hashlib.sha256(b'content').hexdigest()))
+    # the blob and both names share the inode
+    assert st.st_nlink == 3 and os.stat(path1).st_ino == os.stat(path2).st_ino == st.st_ino
+    assert not os.listdir(image_cache.tmp_dir)
+    assert image_cache.stats() == {'blobs': 1, 'urls': 2, 'size': 7,
+                                   'quota': image_cache.quota}
+    assert image_cache.lookup('http://b/y/other.raw.xz')['path'] == path2
+
+
+def test_lru_eviction(clock, capsys):
+    image_cache = cache.ImageCache(quota=250)
+    for name in 'abc':
+        _add(image_cache, 'http://host/{}'.format(name), name.encode() * 100)
+    # c did not fit: a (least recently used) is evicted
+    assert image_cache.lookup('http://host/a') is None
+    assert 'Cache evicted image {}'.format(
+        hashlib.sha256(b'a' * 100).hexdigest()) in capsys.readouterr().out
+    image_cache.touch('http://host/b')
+    _add(image_cache, 'http://host/d', b'd' * 100)
+    # b was used after c
+    assert image_cache.lookup('http://host/c') is None
+    assert [b['urls'] for b in image_cache.ls()] == [['http://host/d'], ['http://host/b']]
+    assert image_cache.stats()['size'] == 200
+
+
+def test_newest_kept_over_quota(clock):
+    image_cache = cache.ImageCache(quota=50)
+    path = _add(image_cache, 'http://host/big', b'x' * 100)
+    assert os.path.exists(path) and image_cache.stats()['blobs'] == 1
+
+
+def test_derived_evicted(clock):
+    image_cache = cache.ImageCache(quota=10 ** 6)
+    path = _add(image_cache, 'http://host/image.raw.xz', b'xz')
+    sha256 = hashlib.sha256(b'xz').hexdigest()
+    raw = image_cache.name_path(sha256, 'image.raw')
+    with open(raw, 'wb') as f:
+        f.write(os.urandom(8192))
+    with open(raw + '.jcs-sha256', 'w') as f:
+        f.write('{}')
+    image_cache.add_derived(sha256, 'image.raw')
+    assert image_cache.ls()[0]['size'] == 2 + os.stat(raw).st_blocks * 512
+    assert image_cache.prune(0) == [sha256]
+    for p in (path, raw, raw + '.jcs-sha256', image_cache.blob_path(sha256)):
+        assert not os.path.exists(p)
+    assert not os.listdir(image_cache.names_dir)
+
+
+def test_index_locked():
+    image_cache = cache.ImageCache()
+    with image_cache._index():
+        with open(image_cache.index_path + '.lock', 'a') as f:
+            # another process (another open file) can not lock the index now
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+    with image_cache._index(write=False):
+        with open(image_cache.index_path + '.lock', 'a') as f:
+            # readers share the lock
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+
+
+def test_concurrent_adds():
+    def _add_own(i):
+        # every process has its own cache object (and lock file descriptors)
+        image_cache = cache.ImageCache()
+        path = os.path.join(image_cache.tmp_dir, 'download-{}'.format(i))
+        data = str(i).encode() * 1000
+        with open(path, 'wb') as f:
+            f.write(data)
+        image_cache.add('http://host/{}'.format(i), path, hashlib.sha256(data).hexdigest(),
+                        {})
+
+    threads = [threading.Thread(target=_add_own, args=(i,)) for i in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # no index update got lost
+    assert cache.ImageCache().stats()['urls'] == 16
+
+
+def test_cli(clock, capsys):
+    image_cache = cache.ImageCache()
+    for name in 'abc':
+        _add(image_cache, 'http://host/{}'.format(name), name.encode() * 1024)
+    capsys.readouterr()
+    run('cache', 'ls')
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[-1] for line in lines] == ['http://host/c', 'http://host/b',
+                                                   'http://host/a']
+    assert lines[0].split()[1] == '1.0K'
+    run('--cache-quota', '2K', 'cache', 'stats')
+    assert capsys.readouterr().out == 'Images: 3, URLs: 3, Size: 3.0K, Quota: 2.0K\n'
+    run('cache', 'prune', '--quota', '2K')
+    assert 'Cache pruned 1 image(s)' in capsys.readouterr().out
+    assert image_cache.lookup('http://host/a') is None
+    run('--cache-quota', '1K', 'cache', 'prune')
+    assert 'Cache pruned 1 image(s)' in capsys.readouterr().out
+    assert [b['urls'] for b in image_cache.ls()] == [['http://host/c']]
@@ -0,0 +1,114 @@
+import io
+import json
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+import jcs
+from jcs import daemon, executor
+
+
+@pytest.fixture
+def socket_path(tmp_path, monkeypatch):
+    """a daemon serving in a thread. Returns its socket path"""
+    path = str(tmp_path / 'jcs.sock')
+    server = daemon._Server(path, daemon._Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+    os.remove(path)
+
+
+def _call(socket_path, monkeypatch, func):
+    """run func as the ls command in the daemon. Returns the messages to the client
+
+    The output of the daemon itself goes to a buffer (sys.stdout._stdout)."""
+    if not isinstance(sys.stdout, daemon._Stdout):
+        # not in the fixture, pytest sets sys.stdout for every test phase
+        monkeypatch.setattr(sys, 'stdout', daemon._Stdout(io.StringIO()))
+    monkeypatch.setattr(jcs, '_do_ls', func)
+    request = {'command': '_do_ls', 'args': {'trace': None, 'profile': False}}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            return [json.loads(line) for line in f]
+
+
+def _output(messages):
+    return ''.join(m['output'] for m in messages if 'output' in m).splitlines()
+
+
+def test_worker_output(socket_path, monkeypatch):
+    def _ls(args):
+        with executor.ThreadPoolExecutor(max_workers=2) as e:
+            for i in range(4):
+                # a single write per line (print writes the end separately)
+                e.submit(print, 'worker {}\n'.format(i), end='')
+        thread = executor.thread(lambda: print('background'))
+        thread.start()
+        thread.join()
+    messages = _call(socket_path, monkeypatch, _ls)
+    assert messages[-1] == {'exit': 0}
+    assert sorted(_output(messages)) == ['background'] + ['worker {}'.format(i)
+                                                          for i in range(4)]
+
+
+def test_output_after_the_request(socket_path, monkeypatch):
+    done = threading.Event()
+
+    def _ls(args):
+        def _late():
+            done.wait()
+            print('late')
+        executor.thread(_late).start()
+    assert _call(socket_path, monkeypatch, _ls) == [{'exit': 0}]
+    done.set()
+    for _ in range(100):
+        if 'late' in sys.stdout._stdout.getvalue():
+            break
+        threading.Event().wait(0.01)
+    assert 'late' in sys.stdout._stdout.getvalue()
+
+
+def test_exit(socket_path, monkeypatch):
+    def _ls(args):
+        print('failing')
+        sys.exit(3)
+    messages = _call(socket_path, monkeypatch, _ls)
+    assert _output(messages) == ['failing'] and messages[-1] == {'exit': 3}
+
+
+def test_base_exception(socket_path, monkeypatch, capfd):
+    def _ls(args):
+        raise KeyboardInterrupt()
+    messages = _call(socket_path, monkeypatch, _ls)
+    assert messages[-1] == {'exit': 1, 'error': 'KeyboardInterrupt'}
+    # the daemon still serves
+    assert _call(socket_path, monkeypatch, lambda args: None) == [{'exit': 0}]
+
+
+@pytest.mark.parametrize('stale', [False, True])
+def test_no_daemon(tmp_path, monkeypatch, capsys, stale):
+    path = str(tmp_path / 'jcs.sock')
+    if stale:
+        # left behind by a daemon which is gone (connection refused)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.close()
+    monkeypatch.setattr(sys, 'argv', ['jcs', '--jenkins-url', 'http://jenkins.invalid',
+                                      '--daemon-socket', path, 'ls'])
+
+    def _do_ls(args):
+        print('ran locally')
+    monkeypatch.setattr(jcs, '_do_ls', _do_ls)
+    assert jcs.main() == 0
+    captured = capsys.readouterr()
+    assert captured.out == 'ran locally\n'
+    assert captured.err == 'No jcs daemon at {} ({}). Running the command without it\n'.format(
+        path, 'Connection refused' if stale else 'No such file or directory')
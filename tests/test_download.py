@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from jcs import download
+
+SEGMENT = 64 * 1024
+SIZE = 16 * SEGMENT + 123
+
+
+def _image(server, data=None):
+    data = os.urandom(SIZE) if data is None else data
+    with open(os.path.join(server.root, 'image.raw'), 'wb') as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _downloader(server, tmp_path, workers=4):
+    return download.RangeDownloader(server.url + '/image.raw', str(tmp_path / 'image.raw'),
+                                    workers=workers, segment_size=SEGMENT)
+
+
+def _fail_segment(monkeypatch, index):
+    """let the Range request of one segment fail"""
+    fetch = download.RangeDownloader._segment_fetch
+
+    def _fetch(self, url, fd, start, end):
+        if start == index * SEGMENT:
+            raise Exception('segment {} failed'.format(index))
+        return fetch(self, url, fd, start, end)
+    monkeypatch.setattr(download.RangeDownloader, '_segment_fetch', _fetch)
+
+
+def test_download(image_server, tmp_path):
+    sha256 = _image(image_server)
+    d = _downloader(image_server, tmp_path)
+    assert d.download() == str(tmp_path / 'image.raw')
+    assert d.sha256 == sha256
+    assert image_server.bytes_sent == SIZE
+    assert not os.path.exists(d.part_path) and not os.path.exists(d.journal_path)
+
+
+def test_failed_segment_cancels_the_others(image_server, tmp_path, monkeypatch):
+    _image(image_server)
+    _fail_segment(monkeypatch, 0)
+    d = _downloader(image_server, tmp_path, workers=1)
+    with pytest.raises(Exception, match='segment 0 failed'):
+        d.download()
+    # segment 0 is retried, the queued segments never run
+    assert image_server.bytes_sent <= SEGMENT
+    with open(d.journal_path) as f:
+        journal = json.load(f)
+    assert journal['validators']['etag']
+
+
+def test_resume(image_server, tmp_path, monkeypatch):
+    sha256 = _image(image_server)
+    with monkeypatch.context() as m:
+        _fail_segment(m, 10)
+        with pytest.raises(Exception):
+            _downloader(image_server, tmp_path, workers=1).download()
+    sent = image_server.bytes_sent
+    assert sent == 10 * SEGMENT
+    d = _downloader(image_server, tmp_path)
+    d.download()
+    assert d.sha256 == sha256
+    assert image_server.bytes_sent - sent == SIZE - sent
+
+
+def test_resume_changed_file(image_server, tmp_path, monkeypatch):
+    _image(image_server)
+    with monkeypatch.context() as m:
+        _fail_segment(m, 10)
+        with pytest.raises(Exception):
+            _downloader(image_server, tmp_path, workers=1).download()
+    sent = image_server.bytes_sent
+    # same size, new content and ETag: the finished segments are useless
+    sha256 = _image(image_server)
+    path = os.path.join(image_server.root, 'image.raw')
+    os.utime(path, (os.path.getmtime(path) + 10,) * 2)
+    d = _downloader(image_server, tmp_path)
+    d.download()
+    assert d.sha256 == sha256
+    assert image_server.bytes_sent - sent == SIZE
+
+
+def test_if_range(image_server, tmp_path):
+    _image(image_server)
+    d = _downloader(image_server, tmp_path)
+    d._probe()
+    d._headers['ETag'] = '"outdated"'
+    d._preallocate(SIZE)
+    fd = os.open(d.part_path, os.O_RDWR)
+    try:
+        with pytest.raises(Exception, match='changed during the download'):
+            d._segment_fetch(image_server.url + '/image.raw', fd, 0, SEGMENT - 1)
+    finally:
+        os.close(fd)
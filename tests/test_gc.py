@@ -0,0 +1,66 @@
+import fakes
+from jcs import clients, gc, inventory
+
+from tests.conftest import run
+
+URL = 'http://jenkins.invalid'
+
+
+def _node(name, idle=True):
+    return {'name': name, 'description': 'Running on AWS (10.0.0.1, i-1, ec2)',
+            'labels': [], 'offline': False, 'idle': idle, 'executors': 1}
+
+
+def _instance(jenkins_name, created=0):
+    return {'id': 'i-{}'.format(jenkins_name), 'jenkins_name': jenkins_name,
+            'jenkins_url': URL, 'created': created}
+
+
+def test_orphans():
+    instances = {'ec2': [_instance('agent'), _instance('orphan'), _instance('young', 950)]}
+    nodes = [_node('agent'), _node('node-orphan'), _node('busy', idle=False), _node('new')]
+    found = gc.orphans(instances, nodes, URL, 1000, min_age=100, created={'new': 950})
+    assert [i['jenkins_name'] for i in found['ec2']] == ['orphan']
+    assert [n['name'] for n in found['nodes']] == ['node-orphan']
+
+
+def _regions(monkeypatch):
+    """a fake EC2 per region. Returns a dict region: fake"""
+    backend = fakes.Backend(latency=0, jitter=0)
+    regions = {}
+
+    def _aws(args, region_name=None):
+        region_name = region_name or args.aws_region_name
+        return regions.setdefault(region_name, fakes.FakeAWSClient(backend, boot_time=0))
+    monkeypatch.setattr(clients, 'aws', _aws)
+    return regions
+
+
+def test_agents_in_other_regions(monkeypatch, fake_clouds):
+    _, _, jenkins = fake_clouds
+    regions = _regions(monkeypatch)
+    run('--aws-region-name', 'us-west-2', 'create', '--ssh-timeout', '0', 'image-name', 'agent')
+    regions['us-west-2'].instances['i-orphan'] = {
+        'tags': {'jcs-jenkins-name': 'gone', 'jcs-jenkins-url': URL}, 'launched': 0}
+    regions['ap-south-1'] = fakes.FakeAWSClient(fakes.Backend(latency=0, jitter=0))
+    regions['ap-south-1'].instances['i-other'] = {
+        'tags': {'jcs-jenkins-name': 'other', 'jcs-jenkins-url': URL}, 'launched': 0}
+    # the node of the agent in us-west-2 (from the inventory) is no orphan
+    inventory.default().update(URL, 'agent', created=0)
+    run('gc')
+    assert list(jenkins.nodes) == ['agent']
+    assert len(regions['us-west-2'].instances) == 1
+    assert 'i-orphan' not in regions['us-west-2'].instances
+    assert 'i-other' in regions['ap-south-1'].instances
+    # other regions are searched with --region
+    run('gc', '--region', 'ap-south-1')
+    assert not regions['ap-south-1'].instances
+
+
+def test_busy_node_kept(fake_clouds):
+    _, _, jenkins = fake_clouds
+    jenkins.nodes['busy'] = {'description': 'Running on AWS (10.0.0.1, i-1, ec2)',
+                             'labels': '', 'offline': False, 'idle': False}
+    jenkins.nodes['idle'] = dict(jenkins.nodes['busy'], idle=True)
+    run('gc')
+    assert list(jenkins.nodes) == ['busy']
@@ -0,0 +1,275 @@
+import errno
+import hashlib
+import lzma
+import os
+
+import pytest
+
+import imageserver
+from jcs import cache, image, obs
+
+SIZE = 4 * 1024 * 1024
+
+
+def _obs_image(server, name='image.raw.xz'):
+    return obs.OBSImage('{}/{}'.format(server.url, name), workers=2,
+                        image_cache=cache.ImageCache(cache.CACHE_DIR))
+
+
+def _write_xz(server, name, data):
+    """serve data as name (with its .sha256 file)"""
+    path = os.path.join(server.root, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    with open(path + '.sha256', 'w') as f:
+        f.write('{}  {}\n'.format(hashlib.sha256(data).hexdigest(), name))
+    return path
+
+
+def _allocated(path):
+    return os.stat(path).st_blocks * 512
+
+
+def test_xz_chunks(tmp_path):
+    data = os.urandom(100000) + bytes(300000)
+    path = str(tmp_path / 'image.raw.xz')
+    with lzma.open(path, 'wb') as f:
+        f.write(data)
+    chunks = list(image.xz_chunks(path, chunk_size=65536))
+    assert b''.join(chunks) == data
+    assert all(len(chunk) == 65536 for chunk in chunks[:-1])
+
+
+def test_write_sparse(tmp_path):
+    block = image.SPARSE_BLOCK_SIZE
+    data = bytes(4 * block) + os.urandom(2 * block) + bytes(4 * block) + b'tail'
+    path = str(tmp_path / 'image.raw')
+    extent_map = image.ExtentMap()
+    # chunks which do not end on a block boundary
+    chunks = [data[i:i + 3 * block + 5] for i in range(0, len(data), 3 * block + 5)]
+    written = image.write_sparse(chunks, path, extent_map)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert written == extent_map.data_bytes
+    assert extent_map.size == len(data)
+    assert _allocated(path) < len(data) // 2
+
+
+def test_write_sparse_zeros(tmp_path):
+    path = str(tmp_path / 'image.raw')
+    assert image.write_sparse([bytes(SIZE)], path) == 0
+    assert os.path.getsize(path) == SIZE and _allocated(path) == 0
+
+
+def test_decompress(image_server):
+    path = imageserver.make_image(image_server.root, 'image.raw.xz', SIZE)
+    with lzma.open(path) as f:
+        data = f.read()
+    raw = _obs_image(image_server).decompress()
+    with open(raw, 'rb') as f:
+        assert f.read() == data
+    assert os.path.basename(raw) == 'image.raw'
+    # half of the image are zero blocks which are not allocated
+    assert _allocated(raw) <= SIZE // 2 + image.SPARSE_BLOCK_SIZE
+    sha256, extent_map = image.analyze(raw)
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert extent_map.data_bytes == SIZE // 2
+    # the raw image is kept in the cache
+    assert _obs_image(image_server).decompress() == raw
+    assert cache.ImageCache().ls()[0]['size'] >= os.path.getsize(path) + _allocated(raw)
+
+
+@pytest.mark.parametrize('damage', ['truncated', 'corrupt'])
+def test_decompress_damaged(image_server, damage):
+    data = lzma.compress(os.urandom(SIZE), preset=0)
+    if damage == 'truncated':
+        data = data[:len(data) // 2]
+    else:
+        data = data[:len(data) // 2] + bytes(1024) + data[len(data) // 2 + 1024:]
+    _write_xz(image_server, 'image.raw.xz', data)
+    img = _obs_image(image_server)
+    with pytest.raises(Exception, match='is corrupt'):
+        img.decompress()
+    # no (partial) raw image is left
+    names = os.listdir(os.path.dirname(img.download()))
+    assert names == ['image.raw.xz']
+
+
+def _sparse_image(path, data_at=((1024 * 1024, 100000),), zeros_at=()):
+    """a sparse SIZE image with random data and allocated zeros at (offset, length)"""
+    with open(path, 'wb') as f:
+        f.truncate(SIZE)
+        for offset, length in data_at:
+            f.seek(offset)
+            f.write(os.urandom(length))
+        for offset, length in zeros_at:
+            f.seek(offset)
+            f.write(bytes(length))
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_allocated(tmp_path):
+    path = str(tmp_path / 'image.raw')
+    _sparse_image(path)
+    with open(path, 'rb') as f:
+        regions = image._allocated(f.fileno(), SIZE)
+    if regions == [(0, SIZE)]:
+        pytest.skip('no SEEK_DATA/SEEK_HOLE support')
+    # the region with data, rounded to file system blocks
+    [(start, end)] = regions
+    assert start <= 1024 * 1024 and end >= 1024 * 1024 + 100000 and end - start < SIZE // 2
+
+
+def test_allocated_empty(tmp_path):
+    path = str(tmp_path / 'image.raw')
+    with open(path, 'wb') as f:
+        f.truncate(SIZE)
+    with open(path, 'rb') as f:
+        assert image._allocated(f.fileno(), SIZE) in ([], [(0, SIZE)])
+
+
+@pytest.mark.parametrize('seek', ['seek_data', 'no_seek_data', 'lseek_fails'])
+def test_scan(tmp_path, monkeypatch, seek):
+    block = image.SPARSE_BLOCK_SIZE
+    path = str(tmp_path / 'image.raw')
+    data = _sparse_image(path, data_at=((block + 10, 100), (3 * block, 2 * block), (SIZE - 1, 1)),
+                         zeros_at=((1024 * 1024, 1024 * 1024),))
+    if seek == 'no_seek_data':
+        monkeypatch.delattr(os, 'SEEK_DATA')
+    elif seek == 'lseek_fails':
+        def _lseek(fd, pos, how):
+            raise OSError(errno.EINVAL, 'not supported')
+        monkeypatch.setattr(os, 'lseek', _lseek)
+    sha256 = hashlib.sha256()
+    extent_map = image.scan(path, sha256)
+    assert sha256.hexdigest() == hashlib.sha256(data).hexdigest()
+    # the allocated zeros are not data
+    assert extent_map.extents == [(block, block), (3 * block, 2 * block), (SIZE - block, block)]
+    assert extent_map.size == SIZE
+
+
+def test_scan_small_blocks(tmp_path):
+    path = str(tmp_path / 'image.raw')
+    with open(path, 'wb') as f:
+        f.write(bytes(100) + b'x' + bytes(50))
+    assert image.scan(path, block_size=10).extents == [(100, 10)]
+    # the last block is shorter
+    assert image.scan(path, block_size=100).extents == [(100, 51)]
+
+
+def test_analyze_sidecar(tmp_path, monkeypatch):
+    path = str(tmp_path / 'image.raw')
+    data = _sparse_image(path)
+    sha256, extent_map = image.analyze(path)
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert image.sidecar_load(path)['sha256'] == sha256
+    assert image.extents_cached(path).extents == extent_map.extents
+    # the sidecar is used, the image is not scanned again
+    with monkeypatch.context() as m:
+        m.setattr(image, 'scan', None)
+        cached_sha256, cached_map = image.analyze(path)
+    assert cached_sha256 == sha256 and cached_map.extents == extent_map.extents
+    image.sidecar_store(path, other=1)
+    assert image.sidecar_load(path)['sha256'] == sha256
+
+
+@pytest.mark.parametrize('change', ['mtime', 'size', 'moved'])
+def test_sidecar_invalidated(tmp_path, change):
+    path = str(tmp_path / 'image.raw')
+    _sparse_image(path)
+    sha256, _ = image.analyze(path)
+    if change == 'mtime':
+        # the same size, but written again
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    elif change == 'size':
+        with open(path, 'ab') as f:
+            f.write(b'x')
+    else:
+        os.rename(path, path + '.moved')
+        os.rename(image._sidecar_path(path), image._sidecar_path(path + '.moved'))
+        path += '.moved'
+    assert image.sidecar_load(path) == {}
+    assert image.extents_cached(path) is None
+    # analyzed again
+    with open(path, 'rb') as f:
+        assert image.analyze(path)[0] == hashlib.sha256(f.read()).hexdigest()
+    assert image.sidecar_load(path)
+
+
+@pytest.fixture(params=['numpy', 'fallback'])
+def nonzero_blocks(request, monkeypatch):
+    """image.nonzero_blocks with and without numpy"""
+    if request.param == 'numpy':
+        numpy = pytest.importorskip('numpy')
+        monkeypatch.setattr(image, '_numpy', lambda: numpy)
+    else:
+        monkeypatch.setattr(image, '_numpy', lambda: None)
+    return image.nonzero_blocks
+
+
+def test_nonzero_blocks(nonzero_blocks):
+    block = image.SPARSE_BLOCK_SIZE
+    buf = bytearray(4 * block + 100)
+    buf[block] = 1
+    buf[4 * block - 1] = 1
+    for b in (bytes(buf), memoryview(buf)):
+        assert nonzero_blocks(b) == [False, True, False, True, False]
+    buf[-1] = 1
+    assert nonzero_blocks(bytes(buf)) == [False, True, False, True, True]
+    assert nonzero_blocks(b'') == []
+    # blocks which are no multiple of 64 bit words
+    assert nonzero_blocks(bytes(10) + b'x' + bytes(10), block_size=7) == [False, True, False]
+    assert nonzero_blocks(bytes(16) + b'x', block_size=8) == [False, False, True]
+
+
+def test_extent_map(tmp_path):
+    extent_map = image.ExtentMap(100, [(10, 10), (20, 5), (30, 0), (50, 10)])
+    assert extent_map.extents == [(10, 15), (50, 10)]
+    assert extent_map.data_bytes == 25
+    assert extent_map.holes() == [(0, 10), (25, 25), (60, 40)]
+    assert list(extent_map.blocks(16)) == [0, 1, 3]
+    assert list(extent_map.blocks(1000)) == [0]
+    assert image.ExtentMap(10).holes() == [(0, 10)]
+    extent_map.add(100, 20)
+    assert extent_map.size == 120 and extent_map.holes()[-1] == (60, 40)
+
+    path = str(tmp_path / 'image.raw')
+    with open(path, 'wb') as f:
+        f.write(bytes(range(120)))
+    content = b''.join(extent_map.chunks(path, chunk_size=8))
+    # only the extents are read, the holes are zeros
+    assert content == (bytes(10) + bytes(range(10, 25)) + bytes(25) + bytes(range(50, 60)) +
+                       bytes(40) + bytes(range(100, 120)))
+    with pytest.raises(Exception, match='shorter than its extent map'):
+        list(image.ExtentMap(200, [(150, 50)]).chunks(path))
+
+
+def test_raw_chunks(tmp_path, monkeypatch):
+    path = str(tmp_path / 'image.raw')
+    data = _sparse_image(path)
+    assert b''.join(image.raw_chunks(path)) == data
+    image.analyze(path)
+    # with the extent map, only the data is read
+    reads = []
+    chunks = image.ExtentMap.chunks
+    monkeypatch.setattr(image.ExtentMap, 'chunks',
+                        lambda self, *args: reads.append(self.extents) or chunks(self, *args))
+    assert b''.join(image.raw_chunks(path)) == data
+    assert reads == [image.extents_cached(path).extents]
+
+
+def test_punch_holes(tmp_path):
+    path = str(tmp_path / 'image.raw')
+    data = _sparse_image(path, zeros_at=((0, 1024 * 1024), (2 * 1024 * 1024, 2 * 1024 * 1024)))
+    allocated = _allocated(path)
+    _, extent_map = image.analyze(path)
+    freed = image.punch_holes(path, extent_map)
+    if not freed:
+        pytest.skip('the file system can not punch holes')
+    assert freed >= 3 * 1024 * 1024 and _allocated(path) == allocated - freed
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    # the content did not change, but the sidecar is outdated
+    assert image.extents_cached(path) is None
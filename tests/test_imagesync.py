@@ -0,0 +1,75 @@
+import subprocess
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import imageserver
+from jcs import aws, image
+
+from tests.conftest import run
+
+
+@pytest.fixture
+def ec2(aws_env, monkeypatch):
+    """moto EC2. ec2uploadimg registers the image (and fails for images named bad*)"""
+    with mock_aws():
+        def _check_output(cmd, **kwargs):
+            name = cmd[cmd.index('-n') + 1]
+            if name.startswith('bad'):
+                raise subprocess.CalledProcessError(1, cmd, output=b'upload failed\n')
+            client = boto3.client('ec2', region_name=cmd[cmd.index('-r') + 1])
+            client.register_image(Name=name, RootDeviceName='/dev/sda1')
+            return b''
+        monkeypatch.setattr(aws.subprocess, 'check_output', _check_output)
+        yield boto3.client('ec2', region_name='us-east-1')
+
+
+def _urls(server, *names):
+    for name in names:
+        imageserver.make_image(server.root, name, 1024 * 1024)
+    return ['{}/{}'.format(server.url, name) for name in names]
+
+
+def _sync(*urls):
+    run('image', 'sync', '--target', 'ec2:us-east-1', *urls)
+
+
+def _images(ec2):
+    return {i['Name']: {t['Key']: t['Value'] for t in i.get('Tags', [])}
+            for i in ec2.describe_images(Owners=['self'])['Images']}
+
+
+def test_sync(ec2, image_server, capsys):
+    [url] = _urls(image_server, 'good.raw.xz')
+    _sync(url)
+    assert 'Image {} ec2:us-east-1: uploaded'.format(url) in capsys.readouterr().out
+    assert _images(ec2)['good']['jcs-source-url'] == url
+    # the image exists now
+    _sync(url)
+    assert 'Image {} ec2:us-east-1: exists'.format(url) in capsys.readouterr().out
+
+
+def test_sync_upload_failed(ec2, image_server, capsys):
+    with pytest.raises(Exception, match='Failed to sync 1 of 2 images'):
+        _sync(*_urls(image_server, 'bad.raw.xz', 'good.raw.xz'))
+    out = capsys.readouterr().out
+    assert 'ec2:us-east-1: failed: Failed to call "ec2uploadimg" (rc: 1): upload failed' in out
+    assert 'good.raw.xz ec2:us-east-1: uploaded' in out
+    assert list(_images(ec2)) == ['good']
+
+
+def test_sync_step_exits(ec2, image_server, monkeypatch, capsys):
+    create = aws.AWSClient.ec2_image_create
+
+    def _create(self, image_path, *args, **kwargs):
+        if image.image_name(image_path).startswith('bad'):
+            sys.exit(1)
+        return create(self, image_path, *args, **kwargs)
+    monkeypatch.setattr(aws.AWSClient, 'ec2_image_create', _create)
+    with pytest.raises(Exception, match='Failed to sync 1 of 2 images'):
+        _sync(*_urls(image_server, 'bad.raw.xz', 'good.raw.xz'))
+    out = capsys.readouterr().out
+    assert 'bad.raw.xz ec2:us-east-1: failed: Step ec2-source:' in out
+    assert 'good.raw.xz ec2:us-east-1: uploaded' in out
@@ -0,0 +1,102 @@
+import pytest
+
+from jcs import jen
+
+from tests.jenkinsserver import CREDENTIAL_DESCRIPTION, CREDENTIAL_ID
+
+
+@pytest.fixture
+def client(jenkins_server):
+    return jen.JenkinsClient(jenkins_server.url, 'user', 'password').connect()
+
+
+def _nodes(count, prefix='agent'):
+    return [{'hostname': '10.0.0.{}'.format(i), 'name': '{}-{}'.format(prefix, i),
+             'description': 'Running on AWS (10.0.0.{}, i-{}, ec2)'.format(i, i),
+             'credential': CREDENTIAL_DESCRIPTION, 'labels': 'a b'} for i in range(count)]
+
+
+def test_create_nodes(client, jenkins_server):
+    results = client.create_nodes(_nodes(10))
+    assert results == {'agent-{}'.format(i): None for i in range(10)}
+    assert jenkins_server.requests['create'] == 10
+    # the nodes are polled together, not one by one
+    assert jenkins_server.requests['node'] == 0
+    assert jenkins_server.requests['nodes'] <= 3
+    node = jenkins_server.nodes['agent-3']
+    assert (node['host'], node['credential'], node['labels']) == ('10.0.0.3', CREDENTIAL_ID,
+                                                                  'a b')
+    assert not any(n['offline'] for n in jenkins_server.nodes.values())
+    assert client.node_index()['agent-3']['labels'] == ['a', 'b']
+
+
+def test_create_nodes_replace(client, jenkins_server):
+    jenkins_server.add_node('agent-0', description='old')
+    client.create_nodes(_nodes(2))
+    assert jenkins_server.nodes['agent-0']['description'].startswith('Running on AWS')
+    assert jenkins_server.requests['doDelete'] == 1
+
+
+def test_create_nodes_created_meanwhile(client, jenkins_server):
+    client.node_index()
+    # created by another client after the index got fetched
+    jenkins_server.add_node('agent-0', description='other')
+    assert client.create_nodes(_nodes(1)) == {'agent-0': None}
+    assert jenkins_server.nodes['agent-0']['description'].startswith('Running on AWS')
+
+
+def test_create_node(client, jenkins_server):
+    client.create_node('10.0.0.1', 'agent', 'desc', CREDENTIAL_DESCRIPTION, '')
+    assert not jenkins_server.nodes['agent']['offline']
+    assert client.node_index()['agent']['offline'] is False
+
+
+def test_offline_node_stale_index(client, jenkins_server):
+    jenkins_server.add_node('agent')
+    assert client.node_index()['agent']['offline'] is False
+    # taken offline by another client: toggling would bring it back online
+    jenkins_server.nodes['agent']['offline'] = True
+    client.offline_node('agent')
+    assert jenkins_server.nodes['agent']['offline']
+    assert jenkins_server.requests['toggleOffline'] == 0
+    assert client.node_index()['agent']['offline']
+
+
+def test_offline_node(client, jenkins_server):
+    jenkins_server.add_node('agent', offline=True)
+    client.node_index()
+    jenkins_server.nodes['agent']['offline'] = False
+    client.offline_node('agent', 'bye')
+    assert jenkins_server.nodes['agent']['offline']
+    with pytest.raises(Exception, match='not found'):
+        client.offline_node('missing')
+
+
+def test_drain_nodes(client, jenkins_server):
+    jenkins_server.add_node('idle')
+    jenkins_server.add_node('busy', idle=False)
+    jenkins_server.add_node('busy-offline', idle=False, offline=True)
+    assert client.drain_nodes(['idle', 'busy', 'busy-offline', 'missing'],
+                              timeout=0) == {'idle', 'missing'}
+    assert jenkins_server.nodes['idle']['offline']
+    # the busy nodes are kept as they were
+    assert not jenkins_server.nodes['busy']['offline']
+    assert jenkins_server.nodes['busy-offline']['offline']
+
+
+def test_online_node(client, jenkins_server):
+    jenkins_server.add_node('agent', offline=True)
+    assert client.online_node('agent')
+    assert not client.online_node('agent')
+    assert not jenkins_server.nodes['agent']['offline']
+    assert jenkins_server.requests['toggleOffline'] == 1
+
+
+def test_delete_nodes(client, jenkins_server):
+    for i in range(5):
+        jenkins_server.add_node('agent-{}'.format(i))
+    client.delete_nodes(['agent-{}'.format(i) for i in range(4)])
+    client.delete_node('agent-4')
+    client.delete_node('missing')
+    assert not jenkins_server.nodes and not client.node_index()
+    assert jenkins_server.requests['doDelete'] == 5
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+import imageserver
+from jcs import cache, obs
+
+SIZE = 4 * 1024 * 1024
+
+
+def _obs_image(server, name='image.raw.xz'):
+    return obs.OBSImage('{}/{}'.format(server.url, name), workers=2,
+                        image_cache=cache.ImageCache(cache.CACHE_DIR))
+
+
+def _sizes(server, name='image.raw.xz'):
+    """bytes of the image and of its .sha256 file"""
+    path = os.path.join(server.root, name)
+    return os.path.getsize(path), os.path.getsize(path + '.sha256')
+
+
+def test_download_once(image_server):
+    imageserver.make_image(image_server.root, 'image.raw.xz', SIZE)
+    image_size, sha256_size = _sizes(image_server)
+    path = _obs_image(image_server).download()
+    assert image_server.bytes_sent == image_size + sha256_size
+    # the next run revalidates with a conditional HEAD request (304)
+    assert _obs_image(image_server).download() == path
+    assert image_server.bytes_sent == image_size + sha256_size
+
+
+def test_head_not_allowed(tmp_path):
+    with imageserver.ImageServer(str(tmp_path), allow_head=False) as server:
+        server.root = str(tmp_path)
+        imageserver.make_image(server.root, 'image.raw.xz', SIZE)
+        path = _obs_image(server).download()
+        sent = server.bytes_sent
+        # revalidated with a conditional GET instead of HEAD
+        assert _obs_image(server).download() == path
+        assert server.bytes_sent == sent
+
+
+def test_sha256_mismatch_is_not_cached(image_server):
+    imageserver.make_image(image_server.root, 'image.raw.xz', SIZE)
+    image_size, _ = _sizes(image_server)
+    with open(os.path.join(image_server.root, 'image.raw.xz.sha256'), 'w') as f:
+        f.write('{}  image.raw.xz\n'.format('0' * 64))
+    image = _obs_image(image_server)
+    with pytest.raises(Exception, match='is expected'):
+        image.download()
+    assert image.url_local is None
+    sent = image_server.bytes_sent
+    # no validators were stored, so the corrupt file is never revalidated
+    with pytest.raises(Exception, match='is expected'):
+        _obs_image(image_server).download()
+    assert image_server.bytes_sent - sent >= image_size
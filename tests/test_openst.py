@@ -0,0 +1,51 @@
+import pytest
+
+from jcs import openst
+
+
+class _Conn:
+    """the openstacksdk calls of os_instance_create. create_server fails with error"""
+    def __init__(self, error=None):
+        self.error = error
+        self.gets = 0
+
+    def _get(self, name):
+        self.gets += 1
+        return {'id': '{}-id'.format(name), 'name': name}
+
+    get_image = get_flavor = get_network = _get
+
+    def get_server(self, name):
+        return None
+
+    def create_server(self, name, **kwargs):
+        raise self.error
+
+
+def _client(conn):
+    client = openst.OpenstClient('cloud')
+    client._OpenstClient__conn = conn
+    return client
+
+
+def _create(client):
+    client.os_instance_create('jcs-agent', 'flavor', 'image', 'key', 'network', 'public', [])
+
+
+def test_lookup_cached():
+    conn = _Conn(Exception('No valid host was found'))
+    client = _client(conn)
+    for _ in range(2):
+        with pytest.raises(openst.CapacityError):
+            _create(client)
+    assert conn.gets == 3
+
+
+def test_lookup_invalidated_on_failure():
+    conn = _Conn(Exception('Image image-id could not be found'))
+    client = _client(conn)
+    for _ in range(2):
+        with pytest.raises(Exception, match='could not be found'):
+            _create(client)
+    # image, flavor and network are resolved again
+    assert conn.gets == 6
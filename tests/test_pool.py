@@ -0,0 +1,84 @@
+import pytest
+
+from jcs import inventory
+from jcs.placement import CapacityError
+
+from tests.conftest import run
+
+
+def _create(*argv):
+    # --pool-size 0: no background refill
+    run('create', '--capacity-cooldown', '0', '--ssh-timeout', '0', '--from-pool',
+        '--pool-size', '0', *argv)
+
+
+def test_fill_ls_reap(fake_clouds, capsys):
+    aws, _, _ = fake_clouds
+    run('pool', 'fill', '--size', '2', 'image-name')
+    run('pool', 'fill', '--size', '2', 'image-name')
+    assert len(aws.instances) == 2
+    # pool instances are not agents
+    assert not aws.ec2_jcs_instances()
+    capsys.readouterr()
+    run('pool', 'ls')
+    lines = capsys.readouterr().out.splitlines()
+    assert sorted(line.split()[0] for line in lines) == sorted(aws.instances)
+    assert all(line.endswith('ec2:image-name:t2.micro:x86_64') for line in lines)
+    run('pool', 'reap')
+    assert 'Pool reaped 0 instance(s)' in capsys.readouterr().out
+    run('pool', 'reap', '--max-idle', '-1')
+    assert 'Pool reaped 2 instance(s)' in capsys.readouterr().out
+    assert not aws.instances
+
+
+def test_create_from_pool(fake_clouds):
+    aws, _, jenkins = fake_clouds
+    run('pool', 'fill', '--size', '2', 'image-name')
+    pooled = set(aws.instances)
+    _create('--count', '3', 'image-name', 'agent')
+    assert sorted(jenkins.nodes) == ['agent-1', 'agent-2', 'agent-3']
+    # only the third instance got launched
+    assert len(aws.instances) == 3 and pooled < set(aws.instances)
+    assert not aws.ec2_pool_instances()
+    agents = {a['jenkins_name']: a['instance_id']
+              for a in inventory.default().ls('http://jenkins.invalid')}
+    assert {agents['agent-1'], agents['agent-2']} == pooled
+    assert {i['jenkins_name'] for i in aws.ec2_jcs_instances()} == set(agents)
+
+
+def test_create_from_pool_launch_failed(fake_clouds, monkeypatch):
+    aws, _, jenkins = fake_clouds
+    run('pool', 'fill', '--size', '1', 'image-name')
+    [pooled] = aws.instances
+
+    def _run(*args, **kwargs):
+        raise CapacityError('EC2 fake: no capacity')
+    monkeypatch.setattr(aws, 'ec2_instances_run', _run)
+    with pytest.raises(Exception, match='Failed to create agents'):
+        _create('--count', '2', 'image-name', 'agent')
+    # the agent of the claimed instance is created anyway, and the instance is tagged
+    assert list(jenkins.nodes) == ['agent-1']
+    assert [(i['id'], i['jenkins_name']) for i in aws.ec2_jcs_instances()] == [
+        (pooled, 'agent-1')]
+    assert [a['instance_id'] for a in inventory.default().ls()] == [pooled]
+
+
+def test_create_from_empty_pool(fake_clouds):
+    aws, _, jenkins = fake_clouds
+    _create('image-name', 'agent')
+    assert list(jenkins.nodes) == ['agent'] and len(aws.instances) == 1
+
+
+def test_create_from_pool_openstack(fake_clouds, capsys):
+    _, openstack, jenkins = fake_clouds
+    run('pool', 'fill', '--cloud', 'openstack', '--size', '1', 'image-name')
+    [pooled] = openstack.servers
+    assert not openstack.os_jcs_servers()
+    _create('--cloud', 'openstack', '--count', '2', 'image-name', 'agent')
+    assert sorted(jenkins.nodes) == ['agent-1', 'agent-2'] and len(openstack.servers) == 2
+    assert not openstack.os_pool_servers()
+    servers = {s['name']: s['id'] for s in openstack.os_jcs_servers()}
+    assert servers['jcs-agent-1'] == pooled
+    run('pool', 'ls', '--cloud', 'openstack')
+    run('pool', 'reap', '--cloud', 'openstack', '--max-idle', '-1')
+    assert 'Pool reaped 0 instance(s)' in capsys.readouterr().out
@@ -0,0 +1,82 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from jcs import ready
+
+
+@pytest.fixture
+def listen():
+    """start a local TCP listener sending banner on every connection. Returns the port"""
+    sockets = []
+
+    def _listen(banner=None, delay=0, host='127.0.0.1'):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, 0))
+        sockets.append(sock)
+
+        def _serve():
+            # like sshd starting late
+            time.sleep(delay)
+            sock.listen(256)
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except OSError:
+                    return
+                if banner:
+                    conn.sendall(banner)
+                conn.close()
+
+        threading.Thread(target=_serve, daemon=True).start()
+        return sock.getsockname()[1]
+
+    yield _listen
+    for sock in sockets:
+        sock.close()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_banner(listen):
+    port = listen(b'SSH-2.0-OpenSSH_9.0\r\n')
+    assert ready.wait_ssh(['127.0.0.1'], port=port, timeout=5, interval=0.1) == {'127.0.0.1'}
+
+
+def test_banner_after_other_lines(listen):
+    port = listen(b'hello\r\nSSH-2.0-OpenSSH_9.0\r\n')
+    assert ready.wait_ssh(['127.0.0.1'], port=port, timeout=5, interval=0.1) == {'127.0.0.1'}
+
+
+def test_late_sshd(listen):
+    port = listen(b'SSH-2.0-OpenSSH_9.0\r\n', delay=0.5)
+    start = time.monotonic()
+    assert ready.wait_ssh(['127.0.0.1'], port=port, timeout=5, interval=0.1) == {'127.0.0.1'}
+    assert time.monotonic() - start >= 0.5
+
+
+def test_open_port_without_banner(listen):
+    # the port is open, but sshd does not answer yet
+    port = listen()
+    assert ready.wait_ssh(['127.0.0.1'], port=port, timeout=1, interval=0.1) == set()
+
+
+def test_nothing_listening():
+    start = time.monotonic()
+    assert ready.wait_ssh(['127.0.0.1'], port=_free_port(), timeout=0.5, interval=0.1) == set()
+    assert time.monotonic() - start < 2
+
+
+def test_many_hosts(listen):
+    # 127.0.0.0/8 is loopback, so every address reaches the listener
+    port = listen(b'SSH-2.0-OpenSSH_9.0\r\n', host='0.0.0.0')
+    hosts = ['127.0.1.{}'.format(i) for i in range(1, 101)]
+    assert ready.wait_ssh(hosts + ['127.0.0.1'], port=port, timeout=10) == set(hosts) | {
+        '127.0.0.1'}
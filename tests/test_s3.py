@@ -0,0 +1,89 @@
+import os
+
+import pytest
+from moto import mock_aws
+
+from tests.conftest import parse
+from jcs import aws
+
+PART = aws.S3_MIN_PART_SIZE
+
+
+@pytest.fixture
+def client(aws_env):
+    with mock_aws():
+        c = aws.AWSClient(None, None, 'us-east-1')
+        c._s3_client.create_bucket(Bucket='bucket')
+        yield c
+
+
+def _chunks(data, size=1024 * 1024):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def _uploaded(client, monkeypatch, fail=None):
+    """count the uploaded part numbers. The part number fail raises"""
+    parts = []
+    upload_part = aws.AWSClient._s3_upload_part
+
+    def _upload_part(self, bucket, key, upload_id, part_number, data):
+        if part_number == fail:
+            raise Exception('part {} failed'.format(part_number))
+        parts.append(part_number)
+        return upload_part(self, bucket, key, upload_id, part_number, data)
+    monkeypatch.setattr(aws.AWSClient, '_s3_upload_part', _upload_part)
+    return parts
+
+
+def _object(client):
+    return client._s3_client.get_object(Bucket='bucket', Key='image.raw')['Body'].read()
+
+
+def test_upload(client, monkeypatch):
+    data = os.urandom(3 * PART + 1024)
+    parts = _uploaded(client, monkeypatch)
+    client.s3_upload('bucket', 'image.raw', _chunks(data), part_size=PART, concurrency=2)
+    assert sorted(parts) == [1, 2, 3, 4]
+    assert _object(client) == data
+
+
+def test_upload_resume(client, monkeypatch):
+    data = os.urandom(3 * PART + 1024)
+    with monkeypatch.context() as m:
+        _uploaded(client, m, fail=3)
+        with pytest.raises(Exception, match='part 3 failed'):
+            client.s3_upload('bucket', 'image.raw', _chunks(data), part_size=PART,
+                             concurrency=1)
+    parts = _uploaded(client, monkeypatch)
+    client.s3_upload('bucket', 'image.raw', _chunks(data), part_size=PART, concurrency=2)
+    assert sorted(parts) == [3, 4]
+    assert _object(client) == data
+
+
+def test_upload_resume_changed_part(client, monkeypatch):
+    data = os.urandom(3 * PART)
+    with monkeypatch.context() as m:
+        _uploaded(client, m, fail=3)
+        with pytest.raises(Exception):
+            client.s3_upload('bucket', 'image.raw', _chunks(data), part_size=PART,
+                             concurrency=1)
+    # part 2 has a different md5 (ETag) now and is uploaded again
+    data = data[:PART] + os.urandom(PART) + data[2 * PART:]
+    parts = _uploaded(client, monkeypatch)
+    client.s3_upload('bucket', 'image.raw', _chunks(data), part_size=PART, concurrency=2)
+    assert sorted(parts) == [2, 3]
+    assert _object(client) == data
+
+
+def test_part_size_minimum(client):
+    with pytest.raises(Exception, match='minimum'):
+        client.s3_upload('bucket', 'image.raw', _chunks(b'x'), part_size=PART - 1)
+
+
+def test_part_size_option():
+    assert parse('ec2-image-create', 'image.raw').s3_part_size == 32 * 1024 * 1024
+    assert parse('image', 'sync', '--s3-part-size', '5M', 'url').s3_part_size == PART
+    for argv in (['ec2-image-create', '--s3-part-size', '1M', 'image.raw'],
+                 ['image', 'sync', '--s3-part-size', 'big', 'url']):
+        with pytest.raises(SystemExit):
+            parse(*argv)
@@ -0,0 +1,87 @@
+import datetime
+
+import pytest
+from botocore.stub import Stubber
+
+from jcs import aws, inventory, spot
+
+from tests.conftest import parse, run
+
+URL = 'http://jenkins.invalid'
+
+
+def _interrupt(fake_aws, jenkins_name):
+    instance_id = inventory.default().get(URL, jenkins_name)['instance_id']
+    fake_aws.interruptions = [{'id': instance_id, 'jenkins_name': jenkins_name,
+                               'jenkins_url': URL, 'code': 'marked-for-termination'}]
+    return instance_id
+
+
+def _watch():
+    spot.watch(parse('spot-watch', '--ssh-timeout', '0', '--interval', '0'), iterations=1)
+
+
+def test_replace(fake_clouds):
+    aws_fake, _, jenkins = fake_clouds
+    run('create', '--spot', '--ssh-timeout', '0', '--labels', 'label', 'image-name', 'agent')
+    interrupted = _interrupt(aws_fake, 'agent')
+    _watch()
+    agent = inventory.default().get(URL, 'agent')
+    assert agent['instance_id'] != interrupted and agent['labels'] == 'label'
+    assert aws_fake.instances[agent['instance_id']]['spot']
+    assert aws_fake.instances[agent['instance_id']]['tags']['jcs-jenkins-name'] == 'agent'
+    # the interrupted instance is no agent anymore
+    assert 'jcs-jenkins-name' not in aws_fake.instances[interrupted]['tags']
+    assert list(jenkins.nodes) == ['agent'] and not jenkins.nodes['agent']['offline']
+
+
+def test_replace_on_demand(fake_clouds):
+    aws_fake, _, _ = fake_clouds
+    run('create', '--spot', '--ssh-timeout', '0', 'image-name', 'agent')
+    _interrupt(aws_fake, 'agent')
+    aws_fake.spot_capacity = False
+    _watch()
+    agent = inventory.default().get(URL, 'agent')
+    assert not aws_fake.instances[agent['instance_id']]['spot']
+
+
+def test_not_in_inventory(fake_clouds, capsys):
+    aws_fake, _, jenkins = fake_clouds
+    run('create', '--spot', '--ssh-timeout', '0', 'image-name', 'agent')
+    _interrupt(aws_fake, 'agent')
+    inventory.default().remove(URL, 'agent')
+    _watch()
+    assert 'not in the inventory. Not replaced' in capsys.readouterr().out
+    assert len(aws_fake.instances) == 1 and jenkins.nodes['agent']['offline']
+
+
+@pytest.fixture
+def ec2_stub(aws_env):
+    client = aws.AWSClient(None, None, 'us-east-1')
+    with Stubber(client._ec2_client) as stub:
+        yield client, stub
+
+
+def _instance(instance_id, request_id, lifecycle='spot'):
+    instance = {'InstanceId': instance_id, 'InstanceLifecycle': lifecycle,
+                'LaunchTime': datetime.datetime(2026, 1, 1),
+                'Tags': [{'Key': 'jcs-jenkins-name', 'Value': 'agent-' + instance_id},
+                         {'Key': 'jcs-jenkins-url', 'Value': URL}]}
+    if request_id:
+        instance['SpotInstanceRequestId'] = request_id
+    return instance
+
+
+def test_spot_interruptions(ec2_stub):
+    client, stub = ec2_stub
+    stub.add_response('describe_instances', {'Reservations': [{'Instances': [
+        _instance('i-1', 'sir-1'), _instance('i-2', 'sir-2'),
+        _instance('i-3', None, lifecycle='normal')]}]})
+    stub.add_response('describe_spot_instance_requests', {'SpotInstanceRequests': [
+        {'SpotInstanceRequestId': 'sir-1', 'Status': {'Code': 'marked-for-termination'}},
+        {'SpotInstanceRequestId': 'sir-2', 'Status': {'Code': 'fulfilled'}}]},
+        {'SpotInstanceRequestIds': ['sir-1', 'sir-2']})
+    assert client.ec2_spot_interruptions() == [{
+        'id': 'i-1', 'jenkins_name': 'agent-i-1', 'jenkins_url': URL,
+        'code': 'marked-for-termination'}]
+    stub.assert_no_pending_responses()
@@ -0,0 +1,35 @@
+import json
+
+import requests
+
+from jcs import trace
+
+
+def test_export_otlp_attributes(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    trace.export_to(path)
+    try:
+        with trace.span('step', url='http://x', count=3, ratio=0.5, dry_run=False, none=None):
+            trace.count('calls', 2)
+    finally:
+        trace.export_to(None)
+    with open(path) as f:
+        span = json.loads(f.readline())
+    assert span['name'] == 'step' and span['status'] == {'code': 'STATUS_CODE_OK'}
+    assert span['attributes'] == [
+        {'key': 'url', 'value': {'stringValue': 'http://x'}},
+        {'key': 'count', 'value': {'intValue': '3'}},
+        {'key': 'ratio', 'value': {'doubleValue': 0.5}},
+        {'key': 'dry_run', 'value': {'boolValue': False}},
+        {'key': 'none', 'value': {'stringValue': ''}},
+        {'key': 'calls', 'value': {'intValue': '2'}},
+    ]
+
+
+def test_requests_hooks(image_server):
+    session = requests.Session()
+    trace.requests_hooks(session)
+    with trace.span('requests') as span:
+        for _ in range(3):
+            session.head(image_server.url + '/missing')
+    assert span['counters'] == {'calls': 3, 'attempts': 3}
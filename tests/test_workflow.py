@@ -0,0 +1,127 @@
+import pytest
+
+from jcs import clients, inventory, ready
+
+from tests.conftest import run
+
+
+def _create(*argv):
+    run('create', '--capacity-cooldown', '0', '--ssh-timeout', '0', *argv)
+
+
+def test_create_count(fake_clouds):
+    aws, _, jenkins = fake_clouds
+    _create('--count', '3', 'image-name', 'agent')
+    assert sorted(jenkins.nodes) == ['agent-1', 'agent-2', 'agent-3']
+    assert len(aws.instances) == 3
+    agents = inventory.default().ls('http://jenkins.invalid')
+    assert sorted(a['jenkins_name'] for a in agents) == ['agent-1', 'agent-2', 'agent-3']
+    assert {a['instance_id'] for a in agents} == set(aws.instances)
+
+
+def test_create_delete_openstack(fake_clouds):
+    _, openstack, jenkins = fake_clouds
+    _create('--cloud', 'openstack', 'image-name', 'agent')
+    assert list(jenkins.nodes) == ['agent'] and len(openstack.servers) == 1
+    run('delete', '--cloud', 'openstack', 'agent')
+    assert not jenkins.nodes and not openstack.servers
+    assert not inventory.default().ls()
+
+
+def test_delete_many(fake_clouds):
+    aws, _, jenkins = fake_clouds
+    _create('--count', '4', 'image-name', 'agent')
+    run('delete', 'agent-*')
+    assert not jenkins.nodes and not aws.instances
+    assert not inventory.default().ls()
+
+
+def test_create_nodes_together(fake_clouds, monkeypatch):
+    _, _, jenkins = fake_clouds
+    create_nodes = jenkins.create_nodes
+    calls = []
+
+    def _create_nodes(nodes, **kwargs):
+        calls.append(sorted(node['name'] for node in nodes))
+        return create_nodes(nodes, **kwargs)
+    monkeypatch.setattr(jenkins, 'create_nodes', _create_nodes)
+    _create('--count', '3', 'image-name', 'agent')
+    assert calls == [['agent-1', 'agent-2', 'agent-3']]
+
+
+def test_create_failure_reported(fake_clouds):
+    aws, _, jenkins = fake_clouds
+    jenkins._backend.failure_rate = 1
+    with pytest.raises(Exception, match='Failed to create agents'):
+        _create('image-name', 'agent')
+
+
+def test_create_instance_terminated(fake_clouds, monkeypatch):
+    aws, _, jenkins = fake_clouds
+    wait_running = aws.ec2_instances_wait_running
+
+    def _wait_running(instance_ids):
+        ips = wait_running(instance_ids)
+        ips[instance_ids[0]] = Exception('EC2 instance "{}" is terminated'.format(
+            instance_ids[0]))
+        return ips
+    monkeypatch.setattr(aws, 'ec2_instances_wait_running', _wait_running)
+    with pytest.raises(Exception, match='Failed to create agents'):
+        _create('--count', '3', 'image-name', 'agent')
+    # only the agent of the terminated instance failed
+    assert sorted(jenkins.nodes) == ['agent-2', 'agent-3']
+
+
+def test_create_ssh_not_reachable(fake_clouds, monkeypatch):
+    aws, _, jenkins = fake_clouds
+    monkeypatch.setattr(ready, 'wait_ssh', lambda hosts, timeout: set(list(hosts)[1:]))
+    with pytest.raises(Exception, match='Failed to create agents'):
+        run('create', '--capacity-cooldown', '0', '--ssh-timeout', '1', '--count', '2',
+            'image-name', 'agent')
+    # the instance without sshd is terminated, not left running without an agent
+    assert list(jenkins.nodes) == ['agent-2'] and len(aws.instances) == 1
+    assert [a['jenkins_name'] for a in inventory.default().ls()] == ['agent-2']
+
+
+def test_create_ssh_not_reachable_openstack(fake_clouds, monkeypatch):
+    _, openstack, jenkins = fake_clouds
+    monkeypatch.setattr(ready, 'wait_ssh', lambda hosts, timeout: set())
+    with pytest.raises(Exception, match='Failed to create agents'):
+        run('create', '--cloud', 'openstack', '--capacity-cooldown', '0', '--ssh-timeout', '1',
+            'image-name', 'agent')
+    assert not jenkins.nodes and not openstack.servers and not inventory.default().ls()
+
+
+def test_delete_instance_gone(fake_clouds, capsys):
+    aws, _, jenkins = fake_clouds
+    _create('--count', '2', 'image-name', 'agent')
+    # terminated outside of jcs
+    aws.instances.pop(inventory.default().get('http://jenkins.invalid', 'agent-1')['instance_id'])
+    run('delete', 'agent-1', 'agent-2')
+    assert 'No instance found for agent "agent-1"' in capsys.readouterr().out
+    assert not jenkins.nodes and not aws.instances
+    assert not inventory.default().ls()
+
+
+def test_delete_recreated(fake_clouds):
+    aws, _, jenkins = fake_clouds
+    _create('image-name', 'agent')
+    # recreated (eg. by jcs on another host): the recorded instance is gone
+    agent = inventory.default().get('http://jenkins.invalid', 'agent')
+    aws.instances['i-recreated'] = aws.instances.pop(agent['instance_id'])
+    run('delete', 'agent')
+    assert not jenkins.nodes and not aws.instances
+
+
+def test_delete_openstack_recorded_cloud(fake_clouds, monkeypatch):
+    _, openstack, jenkins = fake_clouds
+    clouds = []
+    monkeypatch.setattr(clients, 'openstack',
+                        lambda args, os_cloud=None: clouds.append(os_cloud or args.os_cloud)
+                        or openstack)
+    run('--os-cloud', 'cloud-a', 'create', '--ssh-timeout', '0', '--cloud', 'openstack',
+        'image-name', 'agent')
+    assert inventory.default().get('http://jenkins.invalid', 'agent')['region'] == 'cloud-a'
+    clouds.clear()
+    run('--os-cloud', 'cloud-b', 'delete', '--cloud', 'openstack', 'agent')
+    assert clouds == ['cloud-a'] and not openstack.servers